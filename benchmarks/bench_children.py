@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Compare building children from directory entries one by one and in bulk
+
+The directory entries of a library are listed once up front; then the children of every
+directory are created with :meth:`~cherrymusic.media.data.Path.make_child` per entry, like
+scans did, and with :meth:`~cherrymusic.media.data.Path.children_from_scandir`, for both
+:class:`~cherrymusic.media.data.Path` and :class:`~cherrymusic.media.tree.PathNode` parents.
+Finally, a full :func:`~cherrymusic.media.files.recursive_scandir` gets timed, which uses the
+bulk constructor.
+
+Usage: python -m benchmarks.bench_children [FILE_COUNT]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from cherrymusic.media.data import Path
+from cherrymusic.media.files import recursive_scandir
+from cherrymusic.media.tree import PathTree
+
+FILES_PER_DIR = 20
+ROUNDS = 5
+
+
+def make_tree(root, count):
+    for number in range(count // FILES_PER_DIR):
+        directory = os.path.join(root, f'Artist {number // 5}', f'Album {number % 5}')
+        os.makedirs(directory)
+        for track in range(FILES_PER_DIR):
+            open(os.path.join(directory, f'{track:02} Track.mp3'), 'wb').close()
+
+
+def list_tree(root, start):
+    """Return ``(directory, entries)`` for every directory below ``start``"""
+    listings, dirstack = [], [start]
+    while dirstack:
+        directory = dirstack.pop()
+        with os.scandir(os.path.join(root, directory.path)) as dir_entries:
+            entries = list(dir_entries)
+        for entry in entries:
+            entry.is_dir(), entry.is_symlink()  # let the entries cache their types
+        listings.append((directory, entries))
+        dirstack.extend(directory.make_child(entry.name, is_dir=True)
+                        for entry in entries if entry.is_dir())
+    return listings
+
+
+def one_by_one(listings):
+    for directory, entries in listings:
+        for entry in entries:
+            directory.make_child(entry.name, is_dir=entry.is_dir(),
+                                 is_symlink=entry.is_symlink())
+
+
+def in_bulk(listings):
+    for directory, entries in listings:
+        type(directory).children_from_scandir(directory, entries)
+
+
+def best_time(function, *args):
+    times = []
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main(count=100_000):
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, count)
+        print(f'{count} files, best of {ROUNDS} rounds')
+        print(f"{'parents':<10}{'make_child ns':>15}{'bulk ns':>10}{'speedup':>9}")
+        for name, start in (('Path', Path('.', is_dir=True)), ('PathNode', PathTree().root)):
+            listings = list_tree(root, start)
+            entries = sum(len(entries) for _, entries in listings)
+            single, bulk = best_time(one_by_one, listings), best_time(in_bulk, listings)
+            print(f'{name:<10}{single / entries * 1e9:>15.0f}{bulk / entries * 1e9:>10.0f}'
+                  f'{single / bulk:>8.1f}x')
+        scan = best_time(lambda: sum(1 for _ in recursive_scandir(root)))
+        print(f'recursive_scandir: {scan * 1000:.0f} ms, {count / scan:.0f} files/s')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Compare the cost of filtering scan results with separate filter functions and FilterRules
+
+The filters keep visible audio files and skip ``*.tmp`` files. The previous filter path
+checked every component of a path's parent for hidden names, and ran the filters through a
+generator expression for every child; it is reproduced here as ``legacy``. ``combined`` runs
+the same filter functions through the scanner's current loop, and ``rules`` compiles the same
+rules into a single function.
+
+Each artist directory also holds a hidden ``.cache`` directory with many files. All modes
+prune it, since rejected directories are never scanned.
+
+Usage: python -m benchmarks.bench_filters [FILE_COUNT]
+"""
+import fnmatch
+import os
+import pathlib
+import sys
+import tempfile
+import time
+
+from cherrymusic.media.data import Path
+from cherrymusic.media.files import combine_filters, hidden_file_filter, recursive_scandir
+from cherrymusic.media.filters import FilterRules
+
+FILES_PER_DIR = 20
+EXTENSIONS = ('.mp3', '.flac', '.ogg')
+
+
+def make_tree(root, count):
+    """Create about ``count`` audio files in artist/album directories, plus other files"""
+    for number in range(count // FILES_PER_DIR):
+        artist = os.path.join(root, f'Artist {number // 5}')
+        directory = os.path.join(artist, f'Album {number % 5}')
+        os.makedirs(directory)
+        for track in range(FILES_PER_DIR):
+            extension = EXTENSIONS[track % len(EXTENSIONS)]
+            open(os.path.join(directory, f'{track:02} Track{extension}'), 'wb').close()
+        for name in ('cover.jpg', 'notes.txt', '.DS_Store', 'part.tmp'):
+            open(os.path.join(directory, name), 'wb').close()
+        if number % 5 == 0:
+            os.makedirs(os.path.join(artist, '.cache'))
+            for item in range(FILES_PER_DIR):
+                open(os.path.join(artist, '.cache', f'{item}.mp3'), 'wb').close()
+
+
+def legacy_hidden_file_filter():
+    return lambda path: (
+        path.name[0:1] != '.' and
+        all(part[0] != '.' for part in pathlib.PurePath(path.parent).parts)
+    )
+
+
+def extension_filter(path):
+    return path.is_dir or os.path.splitext(path.name)[1].lower() in EXTENSIONS
+
+
+def exclude_filter(path):
+    return not fnmatch.fnmatch(path.name, '*.tmp')
+
+
+def legacy_recursive_scandir(root, filters):
+    """Scan like recursive_scandir did before FilterRules, with filter functions only"""
+    root = os.path.abspath(root)
+    dirstack = [Path('.', is_dir=True)]
+    while dirstack:
+        current = dirstack.pop()
+        for entry in os.scandir(os.path.join(root, current.path)):
+            child = current.make_child(entry.name, is_dir=entry.is_dir(),
+                                       is_symlink=entry.is_symlink())
+            if not all(accept(child) for accept in filters):
+                continue
+            if child.is_dir:
+                dirstack.append(child)
+            yield child
+
+
+def main(count=20_000, repeat=5):
+    rules = FilterRules(hidden=True, extensions=EXTENSIONS, exclude=['*.tmp'])
+    modes = {
+        'legacy': lambda root: legacy_recursive_scandir(
+            root, (legacy_hidden_file_filter(), extension_filter, exclude_filter)),
+        'combined': lambda root: recursive_scandir(
+            root, filters=(hidden_file_filter(), extension_filter, exclude_filter)),
+        'rules': lambda root: recursive_scandir(root, filters=[rules]),
+    }
+    with tempfile.TemporaryDirectory() as tmp_path:
+        root = os.path.join(tmp_path, 'music')
+        make_tree(root, count)
+        all_paths = list(recursive_scandir(root))
+        expected = None
+        print(f'{len(all_paths)} paths in the tree')
+        print(f"{'mode':<10}{'accepted':>9}{'scan s':>9}{'filter s':>10}{'filter ns/path':>16}")
+        for name, scan in modes.items():
+            accepted = sorted(str(path) for path in scan(root))
+            assert expected is None or accepted == expected, name
+            expected = accepted
+
+            scan_times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for _ in scan(root):
+                    pass
+                scan_times.append(time.perf_counter() - start)
+
+            # the filters alone, on every path of the tree, without pruning
+            predicate = _predicate(name, rules)
+            filter_times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                for path in all_paths:
+                    predicate(path)
+                filter_times.append(time.perf_counter() - start)
+            best_filter = min(filter_times)
+            print(f'{name:<10}{len(accepted):>9}{min(scan_times):>9.3f}{best_filter:>10.3f}'
+                  f'{best_filter / len(all_paths) * 1e9:>16.0f}')
+
+
+def _predicate(mode, rules):
+    if mode == 'rules':
+        return rules.compile()
+    hidden = legacy_hidden_file_filter() if mode == 'legacy' else hidden_file_filter()
+    filters = (hidden, extension_filter, exclude_filter)
+    if mode == 'legacy':
+        return lambda path: all(accept(path) for accept in filters)
+    return combine_filters(filters)
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
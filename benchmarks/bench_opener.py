@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Compare ways to open the files of a library for serving, with and without jail checks
+
+Every track of a library (artist/album directories, one artist in ten behind a symlink into
+another allowed root) is opened, in shuffled order like requests come in, by:
+
+- ``open``: a plain :func:`os.open` of the joined path, without any checks
+- ``realpath``: :func:`~cherrymusic.media.files.canonical_path`, a check that the result is
+  inside an allowed root, and :func:`os.open`
+- ``resolver``: the same with a :class:`~cherrymusic.media.files.PathResolver`
+- ``opener``: :meth:`~cherrymusic.media.opener.SecureOpener.open`, with its default cache size
+
+Usage: python -m benchmarks.bench_opener [FILE_COUNT]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from cherrymusic.media.files import PathResolver, canonical_path
+from cherrymusic.media.opener import SecureOpener
+
+FILES_PER_DIR = 12
+LINKED_ARTISTS_EVERY = 10
+ROUNDS = 3
+
+
+def make_tree(root, count):
+    """Create a library and another allowed root below root; return them and the track paths"""
+    library, elsewhere = os.path.join(root, 'library'), os.path.join(root, 'elsewhere')
+    paths = []
+    for number in range(count // FILES_PER_DIR):
+        artist = f'Artist {number // 5}'
+        if number // 5 % LINKED_ARTISTS_EVERY == 0:
+            if not os.path.lexists(os.path.join(library, artist)):
+                os.makedirs(os.path.join(elsewhere, artist))
+                os.makedirs(library, exist_ok=True)
+                os.symlink(os.path.join(elsewhere, artist), os.path.join(library, artist))
+        directory = os.path.join(library, artist, f'Album {number % 5}')
+        os.makedirs(directory, exist_ok=True)
+        for track in range(FILES_PER_DIR):
+            name = os.path.join(artist, f'Album {number % 5}', f'{track:02} Track.mp3')
+            open(os.path.join(library, name), 'wb').close()
+            paths.append(name)
+    return library, elsewhere, paths
+
+
+def checked_open(resolve, library, roots):
+    prefixes = tuple(os.path.join(root, '') for root in roots)
+
+    def open_path(path):
+        real = resolve(path, root=library)
+        if not real.startswith(prefixes):
+            raise PermissionError(path)
+        return os.open(real, os.O_RDONLY)
+
+    return open_path
+
+
+def secure_open(library, elsewhere, openers):
+    opener = SecureOpener(library, allowed_roots=[elsewhere])
+    openers.append(opener)
+    return opener.open
+
+
+def main(count=20_000):
+    with tempfile.TemporaryDirectory() as tmp_path:
+        library, elsewhere, paths = make_tree(tmp_path, count)
+        random.seed(0)
+        random.shuffle(paths)
+        roots = [os.path.realpath(library), os.path.realpath(elsewhere)]
+        secure_openers = []
+        methods = {
+            'open': lambda: lambda path: os.open(os.path.join(library, path), os.O_RDONLY),
+            'realpath': lambda: checked_open(canonical_path, library, roots),
+            'resolver': lambda: checked_open(PathResolver().resolve, library, roots),
+            'opener': lambda: secure_open(library, elsewhere, secure_openers),
+        }
+        print(f"{'method':<10}{'ms':>9}{'us/open':>9}")
+        for name, make_opener in methods.items():
+            best = float('inf')
+            for _ in range(ROUNDS):
+                open_path = make_opener()
+                start = time.perf_counter()
+                for path in paths:
+                    os.close(open_path(path))
+                best = min(best, time.perf_counter() - start)
+            print(f'{name:<10}{best * 1000:>9.1f}{best / len(paths) * 1e6:>9.2f}')
+        print(f"opener directory cache hit rate: {secure_openers[-1].stats()['hit_rate']:.1%}")
+        for opener in secure_openers:
+            opener.close()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Measure the memory used per Path and PathNode, compared to a dict-based namespace
+
+PathNodes share their parent nodes and rebuild full paths on demand, while Path objects cache
+their full path strings.
+
+Paths are created like a scan creates them, as children of their directories, and then get the
+attributes accessed that the file index and search index use. The dict-based class stores the
+same attributes in an instance ``__dict__``, like Path did when it was a FrozenNamespace.
+
+Usage: python -m benchmarks.bench_path_memory [PATH_COUNT]
+"""
+import sys
+import tracemalloc
+
+from cherrymusic.common.types import CachedProperty, FrozenNamespace
+from cherrymusic.media.data import Path
+from cherrymusic.media.tree import PathTree
+
+
+class DictPath(FrozenNamespace):
+    """The attributes of a Path in a ``__dict__``, for comparison"""
+
+    def __init__(self, name, *, parent, **kwargs):
+        if isinstance(parent, DictPath):
+            kwargs.setdefault('depth', parent.depth + 1)
+            parent = parent.path
+        super().__init__(name=sys.intern(name), parent=sys.intern(parent), **kwargs)
+
+    make_child = Path.make_child
+    path = CachedProperty(Path.path.getter)
+    display = CachedProperty(Path.display.getter)
+    as_url = CachedProperty(Path.as_url.getter)
+    __fspath__ = Path.__fspath__
+    __bytes__ = Path.__bytes__
+
+
+def make_paths(root, count):
+    """Create ``count`` file paths in a tree of artist/album directories"""
+    paths = []
+    per_dir = 12
+    artist_no = 0
+    while len(paths) < count:
+        artist_no += 1
+        artist = root.make_child(f'Artist {artist_no}', is_dir=True, is_symlink=False)
+        for album_no in range(1, 5):
+            album = artist.make_child(f'Album {album_no}', is_dir=True, is_symlink=False)
+            for track_no in range(1, per_dir + 1):
+                track = album.make_child(f'{track_no:02} Track.mp3', is_dir=False,
+                                         is_symlink=False)
+                track.path, track.display, track.as_url  # fill caches
+                paths.append(track)
+    return paths[:count]
+
+
+def measure(root, count):
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    paths = make_paths(root, count)
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del paths
+    return (after - before) / count
+
+
+def main(count=200_000):
+    print(f'{"representation":<16}{"bytes/path":>12}')
+    results = {}
+    for name, root in (
+        ('DictPath', DictPath('.', parent='', depth=0, is_dir=True, is_symlink=False)),
+        ('Path', Path('.', is_dir=True, is_symlink=False)),
+        ('PathNode', PathTree().node('.', is_dir=True, is_symlink=False)),
+    ):
+        results[name] = measure(root, count)
+        print(f'{name:<16}{results[name]:>12.0f}')
+    for name in ('Path', 'PathNode'):
+        saved = 1 - results[name] / results['DictPath']
+        print(f'{name} uses {saved:.0%} less memory per instance than DictPath')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Compare resolving the paths of a library with canonical_path and a PathResolver
+
+Every path of a library (artist/album directories of tracks, with one artist directory in ten
+behind a symlink) is resolved relative to the library root: with
+:func:`~cherrymusic.media.files.canonical_path`, which calls ``realpath`` every time, with a new
+:class:`~cherrymusic.media.files.PathResolver` (cold), and with the same resolver again (warm).
+The resolver is big enough for the whole library. All three must agree.
+
+Usage: python -m benchmarks.bench_resolver [FILE_COUNT]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from cherrymusic.media.files import PathResolver, canonical_path
+
+FILES_PER_DIR = 12
+LINKED_ARTISTS_EVERY = 10
+ROUNDS = 3
+
+
+def make_tree(root, count):
+    """Create a library below root and return the relative paths of its files"""
+    paths = []
+    library = os.path.join(root, 'library')
+    for number in range(count // FILES_PER_DIR):
+        artist = f'Artist {number // 5}'
+        if number // 5 % LINKED_ARTISTS_EVERY == 0:  # lives elsewhere, linked into the library
+            artist_dir = os.path.join(root, 'elsewhere', artist)
+            if not os.path.lexists(os.path.join(library, artist)):
+                os.makedirs(artist_dir, exist_ok=True)
+                os.makedirs(library, exist_ok=True)
+                os.symlink(artist_dir, os.path.join(library, artist))
+        directory = os.path.join(library, artist, f'Album {number % 5}')
+        os.makedirs(directory, exist_ok=True)
+        for track in range(FILES_PER_DIR):
+            name = os.path.join(artist, f'Album {number % 5}', f'{track:02} Track.mp3')
+            open(os.path.join(library, name), 'wb').close()
+            paths.append(name)
+    return library, paths
+
+
+def best_of(function):
+    best, result = float('inf'), None
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main(count=100_000):
+    with tempfile.TemporaryDirectory() as tmp_path:
+        library, paths = make_tree(tmp_path, count)
+        max_entries = 2 * len(paths)
+
+        realpath_time, expected = best_of(
+            lambda: [canonical_path(path, root=library) for path in paths])
+
+        def cold():
+            resolver = PathResolver(library, max_entries=max_entries)
+            return [resolver.resolve(path) for path in paths]
+
+        cold_time, cold_result = best_of(cold)
+        resolver = PathResolver(library, max_entries=max_entries)
+        for path in paths:
+            resolver.resolve(path)
+        warm_time, warm_result = best_of(lambda: [resolver.resolve(path) for path in paths])
+        assert expected == cold_result == warm_result
+
+    print(f"{'paths':>8}{'realpath ms':>13}{'cold ms':>9}{'warm ms':>9}{'hit rate':>10}")
+    print(f'{len(paths):>8}{realpath_time * 1000:>13.1f}{cold_time * 1000:>9.1f}'
+          f"{warm_time * 1000:>9.1f}{resolver.stats()['hit_rate']:>10.1%}")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Compare stat calls and runtime of scanning into a FileIndex, with and without stat capture
+
+Without capture, the scan gets file types from the directory listing and the index stats every
+path again by its full path. With ``stat=True``, the scan stats accepted directory entries
+itself and the index uses those results.
+
+Stat calls are counted by wrapping ``os.stat``, ``os.lstat`` and the directory entries
+returned by ``os.scandir``, which counts a ``DirEntry.stat()`` once per entry since its result
+is cached, and ``DirEntry.is_dir()`` for symlinks, which needs a ``stat`` to follow the link. No
+system call tracer is needed, but calls made inside other C code are not counted. Runtimes are
+measured in separate runs without the wrappers.
+
+Usage: python -m benchmarks.bench_scan_stat [FILE_COUNT]
+"""
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from unittest import mock
+
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.media.files import hidden_file_filter, recursive_scandir
+from cherrymusic.media.index import FileIndex
+
+FILES_PER_DIR = 20
+HIDDEN_PER_DIR = 2
+
+
+def make_tree(root, count):
+    """Create about ``count`` files in artist/album directories, plus a few hidden ones"""
+    for number in range(count // FILES_PER_DIR):
+        directory = os.path.join(root, f'Artist {number // 5}', f'Album {number % 5}')
+        os.makedirs(directory)
+        for track in range(FILES_PER_DIR):
+            with open(os.path.join(directory, f'{track:02} Track.mp3'), 'wb') as file:
+                file.write(b'\0' * track)
+        for hidden in range(HIDDEN_PER_DIR):
+            open(os.path.join(directory, f'.hidden{hidden}'), 'wb').close()
+        if number % 10 == 0:
+            os.symlink(f'{FILES_PER_DIR - 1:02} Track.mp3', os.path.join(directory, 'link.mp3'))
+
+
+class CountingEntry:
+    """Wraps a DirEntry to count the calls that need a stat system call"""
+
+    def __init__(self, entry, counter):
+        self._entry = entry
+        self._counter = counter
+        self._stated = False
+
+    name = property(lambda self: self._entry.name)
+    path = property(lambda self: self._entry.path)
+
+    def _count(self):
+        if not self._stated:
+            self._stated = True
+            self._counter['stat'] += 1
+
+    def is_dir(self, *, follow_symlinks=True):
+        if follow_symlinks and self._entry.is_symlink():
+            self._count()
+        return self._entry.is_dir(follow_symlinks=follow_symlinks)
+
+    def is_symlink(self):
+        return self._entry.is_symlink()
+
+    def stat(self, *, follow_symlinks=True):
+        self._count()
+        return self._entry.stat(follow_symlinks=follow_symlinks)
+
+
+class CountingScandir:
+
+    def __init__(self, path, counter):
+        self._scandir = os_scandir(path)
+        self._counter = counter
+        counter['scandir'] += 1
+
+    def __iter__(self):
+        return (CountingEntry(entry, self._counter) for entry in self._scandir)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._scandir.close()
+
+
+os_scandir, os_stat, os_lstat = os.scandir, os.stat, os.lstat
+
+
+def count_calls(function):
+    counter = Counter()
+
+    def counting(original, key):
+        def wrapper(*args, **kwargs):
+            counter[key] += 1
+            return original(*args, **kwargs)
+        return wrapper
+
+    with mock.patch('os.scandir', lambda path: CountingScandir(path, counter)), \
+            mock.patch('os.stat', counting(os_stat, 'stat')), \
+            mock.patch('os.lstat', counting(os_lstat, 'stat')):
+        function()
+    return counter
+
+
+def main(count=20_000, repeat=3):
+    with tempfile.TemporaryDirectory() as tmp_path:
+        root = os.path.join(tmp_path, 'music')
+        make_tree(root, count)
+        index = FileIndex(SqliteDatabase('index', basepath=tmp_path), root)
+        len(index)  # create the database outside of the measurements
+
+        def run(capture):
+            def scan_and_index():
+                scan = recursive_scandir(root, filters=[hidden_file_filter()], stat=capture)
+                return index.update(scan, replace=True)
+            return scan_and_index
+
+        print(f"{'mode':<16}{'paths':>8}{'scandir':>9}{'stat':>8}{'stat/path':>11}{'best s':>9}")
+        for name, capture in (('stat=False', False), ('stat=True', True)):
+            paths = run(capture)()
+            calls = count_calls(run(capture))
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                run(capture)()
+                timings.append(time.perf_counter() - start)
+            print(f"{name:<16}{paths:>8}{calls['scandir']:>9}{calls['stat']:>8}"
+                  f"{calls['stat'] / paths:>11.2f}{min(timings):>9.3f}")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Benchmark full-text search queries on a synthetic index
+
+The synthetic library uses a vocabulary with a Zipf-like word distribution, so queries range
+from words that appear in half of all paths to words that appear only a few times.
+
+Usage: python -m benchmarks.bench_search [ENTRY_COUNT]
+"""
+import itertools
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.search.fts import SearchIndex
+
+SYLLABLES = 'ka lo mi ra ne to su vi da be ro an el is or um ta ge fu ly'.split()
+
+
+def vocabulary(size=8000, *, rng):
+    words = {''.join(rng.choices(SYLLABLES, k=rng.randint(2, 4))) for _ in range(size)}
+    words = sorted(words)
+    rng.shuffle(words)  # position in list == frequency rank
+    return words
+
+
+def synthetic_paths(count, words, *, rng):
+    cum_weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+    def title(word_count):
+        chosen = rng.choices(words, cum_weights=cum_weights, k=word_count)
+        return ' '.join(word.title() for word in chosen)
+
+    produced = 0
+    for artist_no in itertools.count(1):
+        artist = f'{title(2)} {artist_no}'  # numbered to keep paths unique
+        for album_no in range(1, rng.randint(2, 6)):
+            album = f'{album_no:02} {title(rng.randint(1, 3))}'
+            for track_no in range(1, rng.randint(8, 16)):
+                yield f'{artist}/{album}/{track_no:02} {title(rng.randint(1, 4))}.mp3'
+                produced += 1
+                if produced == count:
+                    return
+
+
+def queries(words):
+    """Return queries for words of different frequency ranks, as words, prefixes and pairs"""
+    return (
+        words[0],  # most frequent word
+        words[10][:3],
+        words[50],
+        words[500],
+        words[5000],
+        f'{words[5]} {words[20][:2]}',
+        f'{words[100]} {words[30]}',
+        'xyzzy',
+    )
+
+
+def main(count=500_000, repeat=50):
+    rng = random.Random(0)
+    words = vocabulary(rng=rng)
+    with tempfile.TemporaryDirectory() as tmp_path:
+        index = SearchIndex(SqliteDatabase('search', basepath=tmp_path))
+        start = time.perf_counter()
+        index.update(synthetic_paths(count, words, rng=rng), replace=True)
+        print(f'Indexed {count} paths in {time.perf_counter() - start:.1f}s')
+        print(f"{'query':<24}{'matches':>10}{'median ms':>12}{'p95 ms':>10}")
+        for query in queries(words):
+            timings = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                index.search(query)
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            p95 = timings[int(0.95 * (len(timings) - 1))]
+            print(f'{query!r:<24}{index.count(query):>10}{statistics.median(timings):>12.2f}'
+                  f'{p95:>10.2f}')
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
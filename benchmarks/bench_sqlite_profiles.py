@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Benchmark concurrent read throughput during a write-heavy scan, for PRAGMA profiles
+
+A writer thread keeps inserting rows in batches, like a scan feeding the file index, while
+reader threads run point queries. Each scenario runs on a fresh database file.
+
+Usage: python -m benchmarks.bench_sqlite_profiles [SECONDS] [READERS]
+"""
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from cherrymusic.database.sqlite import ISOLATION, SqliteDatabase
+
+SCENARIOS = (
+    # (database profile, writer transaction profile)
+    ('default', None),
+    ('read-heavy', None),
+    ('read-heavy', 'bulk-import'),
+)
+
+BATCH_SIZE = 500
+INITIAL_ROWS = 50_000
+
+
+def run_scenario(db_profile, writer_profile, *, seconds, readers):
+    with tempfile.TemporaryDirectory() as tmp_path:
+        db = SqliteDatabase('bench', basepath=tmp_path, profile=db_profile, pool_size=readers + 1)
+        with db.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            tx.execute('CREATE TABLE files(id INTEGER PRIMARY KEY, name TEXT, size INTEGER)')
+            tx.executemany('INSERT INTO files(name, size) VALUES (?, ?)',
+                           ((f'file {i}', i) for i in range(INITIAL_ROWS)))
+        stop = threading.Event()
+        counts = {'reads': 0, 'read errors': 0, 'rows written': 0, 'write errors': 0}
+        lock = threading.Lock()
+
+        def count(key, amount=1):
+            with lock:
+                counts[key] += amount
+
+        def write():
+            rows = [(f'new file {i}', i) for i in range(BATCH_SIZE)]
+            while not stop.is_set():
+                try:
+                    with db.transaction(isolation=ISOLATION.IMMEDIATE,
+                                        profile=writer_profile) as tx:
+                        count('rows written', tx.executemany(
+                            'INSERT INTO files(name, size) VALUES (?, ?)', rows))
+                except sqlite3.OperationalError:
+                    count('write errors')
+
+        def read():
+            rng = random.Random()
+            while not stop.is_set():
+                try:
+                    with db.transaction() as tx:
+                        tx.execute('SELECT name, size FROM files WHERE id = ?',
+                                   (rng.randrange(INITIAL_ROWS),))
+                        tx.execute('SELECT name FROM files WHERE id BETWEEN ? AND ?', (100, 200))
+                    count('reads')
+                except sqlite3.OperationalError:
+                    count('read errors')
+
+        threads = [threading.Thread(target=write)]
+        threads += [threading.Thread(target=read) for _ in range(readers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        db.close()
+        return {key: value / seconds for key, value in counts.items()}
+
+
+def main(seconds=5, readers=4):
+    print(f'{seconds}s per scenario, {readers} reader threads, 1 writer thread; rates per second')
+    print(f"{'profile':<14}{'writer':<14}{'reads':>10}{'errors':>8}{'rows written':>14}"
+          f"{'errors':>8}")
+    for db_profile, writer_profile in SCENARIOS:
+        rates = run_scenario(db_profile, writer_profile, seconds=seconds, readers=readers)
+        print(f"{db_profile:<14}{writer_profile or '-':<14}{rates['reads']:>10.0f}"
+              f"{rates['read errors']:>8.1f}{rates['rows written']:>14.0f}"
+              f"{rates['write errors']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
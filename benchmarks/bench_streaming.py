@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Load-test the streaming server with concurrent streams on localhost
+
+The server runs in its own process. For every concurrency level, that many clients keep
+requesting whole files (and, for a quarter of the requests, a range from the middle of a file,
+like a seek) on persistent connections for a fixed time. Time to first byte is measured from
+sending a request to receiving the first byte of the response.
+
+Usage: python -m benchmarks.bench_streaming [SECONDS_PER_LEVEL]
+"""
+import asyncio
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+from cherrymusic.media.data import Path
+from cherrymusic.server.streaming import StreamingServer
+
+FILE_COUNT = 16
+FILE_SIZE = 8 * 1024 * 1024
+CONCURRENCY_LEVELS = (1, 8, 32, 128)
+
+
+def run_server(root, address_queue):
+    loop = asyncio.new_event_loop()
+    server = StreamingServer(root)
+    loop.run_until_complete(server.start())
+    address_queue.put(server.address)
+    loop.run_forever()
+
+
+async def stream(address, urls, deadline, ttfbs, counts):
+    reader, writer = await asyncio.open_connection(*address)
+    try:
+        while time.perf_counter() < deadline:
+            url = random.choice(urls)
+            headers = ''
+            if random.random() < 0.25:
+                start = random.randrange(FILE_SIZE // 2)
+                headers = f'Range: bytes={start}-\r\n'
+            sent = time.perf_counter()
+            writer.write(f'GET {url} HTTP/1.1\r\nHost: bench\r\n{headers}\r\n'.encode())
+            head = await reader.readuntil(b'\r\n\r\n')
+            ttfbs.append(time.perf_counter() - sent)
+            length = next(int(line.split(b':')[1]) for line in head.split(b'\r\n')
+                          if line.lower().startswith(b'content-length:'))
+            counts['bytes'] += length
+            while length:
+                length -= len(await reader.read(min(length, 1024 * 1024)))
+            counts['requests'] += 1
+    finally:
+        writer.close()
+
+
+async def load(address, urls, concurrency, seconds):
+    ttfbs, counts = [], {'requests': 0, 'bytes': 0}
+    deadline = time.perf_counter() + seconds
+    await asyncio.gather(*(stream(address, urls, deadline, ttfbs, counts)
+                           for _ in range(concurrency)))
+    return ttfbs, counts
+
+
+def main(seconds=3.0):
+    with tempfile.TemporaryDirectory() as root:
+        urls = []
+        for number in range(FILE_COUNT):
+            name = f'Track {number:02}.mp3'
+            with open(os.path.join(root, name), 'wb') as file:
+                file.write(os.urandom(FILE_SIZE))
+            urls.append('/stream/' + Path(name).as_url)
+        address_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=run_server, args=(root, address_queue),
+                                         daemon=True)
+        server.start()
+        address = address_queue.get(timeout=10)
+        try:
+            print(f'{os.cpu_count()} CPUs, {FILE_COUNT} files of {FILE_SIZE >> 20} MiB')
+            print(f"{'streams':>8}{'requests':>10}{'MiB/s':>9}{'ttfb p50 ms':>13}"
+                  f"{'ttfb p99 ms':>13}")
+            for concurrency in CONCURRENCY_LEVELS:
+                start = time.perf_counter()
+                loop = asyncio.new_event_loop()
+                ttfbs, counts = loop.run_until_complete(load(address, urls, concurrency, seconds))
+                loop.close()
+                elapsed = time.perf_counter() - start
+                ttfbs.sort()
+                p50, p99 = (ttfbs[int(len(ttfbs) * q)] * 1000 for q in (0.5, 0.99))
+                print(f"{concurrency:>8}{counts['requests']:>10}"
+                      f"{counts['bytes'] / elapsed / 2 ** 20:>9.0f}{p50:>13.2f}{p99:>13.2f}")
+        finally:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main(*map(float, sys.argv[1:2]))
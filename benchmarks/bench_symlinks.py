@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Measure how circular symlink detection scales with the number of symlinked directories
+
+The scanned library holds two "view" directories with a symlink to every album of a collection
+outside the library, like a "Various Artists" view. The first view's symlinks are accepted, the
+second view's are rejected since their targets are known already. ``legacy`` is the previous
+filter, which compared every target with all known targets and resolved every symlink with
+``realpath``.
+
+Both filters get the paths of a scan with captured stat results, and must accept the same
+paths.
+
+Usage: python -m benchmarks.bench_symlinks [MAX_ALBUM_COUNT]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from cherrymusic.media.files import canonical_path, circular_symlink_filter, recursive_scandir
+
+
+def legacy_circular_symlink_filter(root):
+    root = os.fspath(root)
+    known_roots = {os.path.join(canonical_path(root), '')}
+
+    def is_noncircular_symlink(path):
+        if path.is_symlink and path.is_dir:
+            testpath = os.path.join(canonical_path(path, root=root), '')
+            if any(r.startswith(testpath) or testpath.startswith(r) for r in known_roots):
+                return False
+            known_roots.add(testpath)
+        return True
+
+    return is_noncircular_symlink
+
+
+def make_tree(root, count):
+    """Create albums below root and a library with views of them; return the library"""
+    library = os.path.join(root, 'library')
+    for view in ('view1', 'view2'):
+        os.makedirs(os.path.join(library, view))
+    for number in range(count):
+        album = os.path.join(root, 'albums', f'Artist {number // 10}', f'Album {number % 10}')
+        os.makedirs(album)
+        for view in ('view1', 'view2'):
+            os.symlink(album, os.path.join(library, view, f'{number}'))
+    return library
+
+
+def main(max_count=4000, repeat=3):
+    print(f"{'albums':>8}{'paths':>8}{'legacy s':>10}{'trie s':>9}{'speedup':>9}")
+    count = 500
+    while count <= max_count:
+        with tempfile.TemporaryDirectory() as tmp_path:
+            library = make_tree(tmp_path, count)
+            paths = list(recursive_scandir(library, stat=True))
+            timings = {}
+            results = {}
+            for name, make_filter in (('legacy', legacy_circular_symlink_filter),
+                                      ('trie', circular_symlink_filter)):
+                best = float('inf')
+                for _ in range(repeat):
+                    accept = make_filter(library)
+                    start = time.perf_counter()
+                    results[name] = [path for path in paths if accept(path)]
+                    best = min(best, time.perf_counter() - start)
+                timings[name] = best
+            assert results['legacy'] == results['trie']
+            print(f"{count:>8}{len(paths):>8}{timings['legacy']:>10.3f}{timings['trie']:>9.3f}"
+                  f"{timings['legacy'] / timings['trie']:>9.1f}")
+        count *= 2
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Measure tag extraction throughput for different numbers of worker processes
+
+The synthetic collection mixes MP3 (ID3v2.3/2.4), FLAC, Ogg Vorbis, Opus and M4A files, most
+of them with embedded cover art for the parsers to skip. Every run starts with an empty cache;
+a final run shows the cost of checking an up-to-date cache.
+
+Usage: python -m benchmarks.bench_tags [FILE_COUNT]
+"""
+import os
+import sys
+import tempfile
+import time
+
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.media.files import recursive_scandir
+from cherrymusic.media.tags import TagCache
+from cherrymusic.media.test import audiofiles
+
+
+def make_collection(root, count):
+    makers = (
+        ('mp3', lambda n: audiofiles.mp3({'TIT2': f'Track {n}', 'TPE1': 'Artist', 'TRCK': str(n)},
+                                         version=3 + n % 2, picture_size=30_000)),
+        ('flac', lambda n: audiofiles.flac({'TITLE': f'Track {n}', 'ARTIST': 'Artist'},
+                                           picture_size=30_000)),
+        ('ogg', lambda n: audiofiles.ogg({'TITLE': f'Track {n}', 'ARTIST': 'Artist'})),
+        ('opus', lambda n: audiofiles.ogg({'TITLE': f'Track {n}'}, codec='opus')),
+        ('m4a', lambda n: audiofiles.mp4({b'\xa9nam': f'Track {n}'}, track=n % 20 + 1)),
+    )
+    for number in range(count):
+        directory = os.path.join(root, f'Album {number // 20}')
+        os.makedirs(directory, exist_ok=True)
+        extension, make = makers[number % len(makers)]
+        with open(os.path.join(directory, f'{number:05}.{extension}'), 'wb') as file:
+            file.write(make(number))
+
+
+def main(count=5000):
+    cpus = os.cpu_count() or 1
+    worker_counts = sorted({1, 2, 4, cpus} | ({cpus // 2} if cpus > 4 else set()))
+    with tempfile.TemporaryDirectory() as tmp_path:
+        root = os.path.join(tmp_path, 'music')
+        make_collection(root, count)
+        paths = list(recursive_scandir(root, stat=True))
+        print(f'{count} files, {cpus} CPUs')
+        print(f"{'workers':>8}{'seconds':>10}{'files/s':>10}{'speedup':>9}")
+        baseline = None
+        for workers in worker_counts:
+            cache = TagCache(SqliteDatabase(f'tags{workers}', basepath=tmp_path), root)
+            len(cache)  # create the database outside of the measurement
+            start = time.perf_counter()
+            assert cache.update(paths, max_workers=workers) == count
+            seconds = time.perf_counter() - start
+            baseline = baseline or seconds
+            print(f'{workers:>8}{seconds:>10.2f}{count / seconds:>10.0f}'
+                  f'{baseline / seconds:>9.2f}')
+        start = time.perf_counter()
+        assert cache.update(paths) == 0
+        seconds = time.perf_counter() - start
+        print(f"{'cached':>8}{seconds:>10.2f}{count / seconds:>10.0f}")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:2]))
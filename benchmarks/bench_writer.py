@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Benchmark concurrent writers: own IMMEDIATE transactions vs. the single-writer queue
+
+Every writer thread inserts rows one at a time, as separate write jobs. With their own
+transactions, writers wait on SQLite's busy timeout for each other and may fail with "database
+is locked"; with the writer queue, their jobs get committed in batches on one thread.
+
+Usage: python -m benchmarks.bench_writer [SECONDS] [WRITERS]
+"""
+import itertools
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+from cherrymusic.database.sqlite import ISOLATION, SqliteDatabase
+
+SCENARIOS = ('default', 'read-heavy')  # PRAGMA profiles
+MODES = (('transactions', False), ('writer queue', True))
+INSERT = 'INSERT INTO files(name, size) VALUES (?, ?)'
+
+
+def run_scenario(profile, use_writer, *, seconds, writers):
+    with tempfile.TemporaryDirectory() as tmp_path:
+        db = SqliteDatabase('bench', basepath=tmp_path, profile=profile,
+                            pool_size=writers + 1)
+        db.execute('CREATE TABLE files(id INTEGER PRIMARY KEY, name TEXT, size INTEGER)')
+        stop = threading.Event()
+        counts = {'rows': 0, 'errors': 0}
+        latencies = []
+        lock = threading.Lock()
+
+        def write(number):
+            row = 0
+            while not stop.is_set():
+                row += 1
+                params = (f'file {number}.{row}', row)
+                start = time.perf_counter()
+                try:
+                    if use_writer:
+                        db.writer.execute(INSERT, params).result()
+                    else:
+                        with db.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+                            tx.execute(INSERT, params)
+                    key = 'rows'
+                except sqlite3.OperationalError:
+                    key = 'errors'
+                with lock:
+                    counts[key] += 1
+                    latencies.append(time.perf_counter() - start)
+
+        threads = [threading.Thread(target=write, args=(number,)) for number in range(writers)]
+        for thread in threads:
+            thread.start()
+        time.sleep(seconds)
+        stop.set()
+        for thread in threads:
+            thread.join()
+        batches = db.writer.batches if use_writer else counts['rows']
+        db.close()
+        latencies.sort()
+        p50, p99 = (latencies[int(len(latencies) * q)] * 1000 for q in (0.5, 0.99))
+        return {
+            'rows': counts['rows'] / seconds,
+            'errors': counts['errors'] / seconds,
+            'commits': batches / seconds,
+            'p50': p50,
+            'p99': p99,
+            'max': latencies[-1] * 1000,
+        }
+
+
+def main(seconds=5, writers=8):
+    print(f'{seconds}s per scenario, {writers} writer threads; rates per second, latencies in ms')
+    print(f"{'profile':<12}{'mode':<14}{'rows':>8}{'errors':>8}{'commits':>9}{'p50':>7}"
+          f"{'p99':>7}{'max':>8}")
+    for profile, (name, use_writer) in itertools.product(SCENARIOS, MODES):
+        r = run_scenario(profile, use_writer, seconds=seconds, writers=writers)
+        print(f"{profile:<12}{name:<14}{r['rows']:>8.0f}{r['errors']:>8.1f}{r['commits']:>9.0f}"
+              f"{r['p50']:>7.2f}{r['p99']:>7.2f}{r['max']:>8.1f}")
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:3]))
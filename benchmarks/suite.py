@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+"""Benchmark the scan, path and database hot paths, and save the results as JSON
+
+For every library size, a synthetic library of about that many entries gets created with the
+``tempdir`` test helper: artist/album directories of tracks with a hidden file each, plus a
+directory of symlinks to albums, like playlists made of links. On it, the suite measures:
+
+- ``scan/<filters>``: :func:`~cherrymusic.media.files.recursive_scandir` throughput without
+  filters, with :func:`~cherrymusic.media.files.hidden_file_filter`, with
+  :func:`~cherrymusic.media.files.circular_symlink_filter`, and with both; without the symlink
+  filter, the linked albums get scanned twice
+- ``scan/encode-str`` and ``scan/encode-bytes``: scanning with the hidden file filter and
+  getting :func:`bytes` and :attr:`~cherrymusic.media.data.Path.as_url` of every path, like
+  indexing and serving do, once for a ``str`` root and once for a ``bytes`` root, which yields
+  :class:`~cherrymusic.media.data.BytesPath` objects; one track in ten has a name that is not
+  valid UTF-8
+- ``path/construct``: creating a :class:`~cherrymusic.media.data.Path` from every path string
+- ``path/make_child``: creating every path as the child of its directory's path
+- ``path/url_roundtrip``: :attr:`~cherrymusic.media.data.Path.as_url` and
+  :meth:`~cherrymusic.media.data.Path.from_url` for every path
+- ``sqlite/transaction`` and ``sqlite/transaction-unpooled``: the latency of opening a
+  :class:`~cherrymusic.database.sqlite.SqliteTransaction`, running a point query and closing
+  it, with and without the connection pool
+
+Every benchmark runs for a number of rounds. The results record the round times and CPU times,
+the operations per second of the fastest round, and for latencies, percentiles over all
+operations. With ``--compare``, the fastest round times are compared to an earlier results file,
+and the exit status is 1 if any benchmark got slower by more than the threshold.
+
+Usage: python -m benchmarks.suite [--sizes 10000,100000,1000000] [--rounds N] [--output FILE]
+                                  [--compare BASELINE] [--threshold FRACTION]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.media.data import Path
+from cherrymusic.media.files import circular_symlink_filter, hidden_file_filter, recursive_scandir
+
+DEFAULT_SIZES = (10_000, 100_000)
+DEFAULT_ROUNDS = 5
+DEFAULT_THRESHOLD = 0.1
+TRACKS_PER_ALBUM = 12
+ALBUMS_PER_ARTIST = 5
+LINKED_ALBUMS_EVERY = 10  # one album in this many is linked from the playlists directory
+UNDECODABLE_TRACKS_EVERY = 10  # one track in this many has a name that is not valid UTF-8
+MAX_SQLITE_OPERATIONS = 10_000
+
+SCAN_FILTERS = {
+    'none': lambda root: (),
+    'hidden': lambda root: (hidden_file_filter(),),
+    'circular': lambda root: (circular_symlink_filter(root),),
+    'hidden+circular': lambda root: (hidden_file_filter(), circular_symlink_filter(root)),
+}
+
+
+def library_paths(size):
+    """Return the paths of a library with about ``size`` entries, and its symlinks"""
+    paths, links = [], {}
+    entries_per_album = TRACKS_PER_ALBUM + 2  # tracks, a hidden file and the album directory
+    for number in range(max(1, size // entries_per_album)):
+        album = f'Artist {number // ALBUMS_PER_ARTIST:05}/Album {number % ALBUMS_PER_ARTIST}'
+        paths.extend(f'{album}/{track:02} Track.mp3' for track in range(TRACKS_PER_ALBUM))
+        if number % UNDECODABLE_TRACKS_EVERY == 0:
+            paths[-1] = os.fsdecode(f'{album}/Caf'.encode() + b'\xe9.mp3')
+        paths.append(f'{album}/.cover.jpg')
+        if number % LINKED_ALBUMS_EVERY == 0:
+            links[f'Playlists/Mix {number:06}/'] = f'{album}/'
+    return paths, links
+
+
+@contextmanager
+def library(size):
+    paths, links = library_paths(size)
+    with tempdir(*paths, links=links) as root:
+        yield str(root), paths
+
+
+def measure(function, rounds):
+    """Call ``function()`` for a number of rounds; it returns the ops it did, or ``(ops, time)``
+
+    Returns:
+        The result record of the benchmark
+    """
+    times, cpu_times = [], []
+    for _ in range(rounds):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        result = function()
+        elapsed = time.perf_counter() - start
+        cpu_times.append(time.process_time() - cpu_start)
+        ops, elapsed = result if isinstance(result, tuple) else (result, elapsed)
+        times.append(elapsed)
+    return {
+        'rounds': times,
+        'cpu': cpu_times,
+        'min': min(times),
+        'median': statistics.median(times),
+        'stdev': statistics.stdev(times) if len(times) > 1 else 0.0,
+        'ops': ops,
+        'ops_per_sec': ops / min(times),
+    }
+
+
+def bench_scans(root, rounds):
+    results = {}
+    for name, make_filters in SCAN_FILTERS.items():
+        def scan():
+            count = 0
+            for _ in recursive_scandir(root, filters=make_filters(root)):
+                count += 1
+            return count
+
+        results[f'scan/{name}'] = measure(scan, rounds)
+
+    for name, scan_root in (('str', root), ('bytes', os.fsencode(root))):
+        def scan_and_encode():
+            count = 0
+            for path in recursive_scandir(scan_root, filters=(hidden_file_filter(),)):
+                bytes(path)
+                path.as_url
+                count += 1
+            return count
+
+        results[f'scan/encode-{name}'] = measure(scan_and_encode, rounds)
+    return results
+
+
+def bench_paths(paths, rounds):
+    results = {}
+
+    def construct():
+        for path in paths:
+            Path(path)
+        return len(paths)
+
+    directories = {}
+    split_paths = [path.rsplit('/', 1) for path in paths]
+    for parent, _ in split_paths:
+        if parent not in directories:
+            directories[parent] = Path(parent, is_dir=True)
+
+    def make_child():
+        for parent, name in split_paths:
+            directories[parent].make_child(name)
+        return len(paths)
+
+    def url_roundtrip():
+        fresh = [Path(path) for path in paths]  # as_url is cached per Path
+        start = time.perf_counter()
+        for path in fresh:
+            Path.from_url(path.as_url)
+        return len(fresh), time.perf_counter() - start
+
+    results['path/construct'] = measure(construct, rounds)
+    results['path/make_child'] = measure(make_child, rounds)
+    results['path/url_roundtrip'] = measure(url_roundtrip, rounds)
+    return results
+
+
+def bench_sqlite(size, rounds):
+    results = {}
+    operations = min(size, MAX_SQLITE_OPERATIONS)
+    for name, pool_size in (('sqlite/transaction', 5), ('sqlite/transaction-unpooled', 0)):
+        with tempdir() as tmp_path:
+            db = SqliteDatabase('bench', basepath=tmp_path, pool_size=pool_size)
+            with db.transaction() as tx:
+                tx.execute('CREATE TABLE files(id INTEGER PRIMARY KEY, name TEXT)')
+                tx.executemany('INSERT INTO files VALUES (?, ?)',
+                               ((number, f'file {number}') for number in range(size)))
+            latencies = []
+
+            def transactions():
+                for number in range(operations):
+                    start = time.perf_counter()
+                    with db.transaction() as tx:
+                        tx.execute('SELECT name FROM files WHERE id = ?', (number * 7 % size,))
+                    latencies.append(time.perf_counter() - start)
+                return operations
+
+            result = results[name] = measure(transactions, rounds)
+            db.close()
+        latencies.sort()
+        result['latency'] = {
+            f'p{percent}': latencies[min(len(latencies) - 1, len(latencies) * percent // 100)]
+            for percent in (50, 90, 99)
+        }
+        result['latency']['mean'] = statistics.mean(latencies)
+    return results
+
+
+def run(sizes, rounds):
+    results = {}
+    for size in sizes:
+        print(f'Creating a library of {size} entries...', file=sys.stderr)
+        with library(size) as (root, paths):
+            size_results = {}
+            size_results.update(bench_scans(root, rounds))
+            size_results.update(bench_paths(paths, rounds))
+            size_results.update(bench_sqlite(size, rounds))
+        for name, result in size_results.items():
+            results[f'{name}/{size}'] = result
+            print(f"{name + '/' + str(size):<40}{result['median'] * 1000:>12.1f} ms"
+                  f"{min(result['cpu']) * 1000:>12.1f} ms cpu"
+                  f"{result['ops_per_sec']:>14.0f} ops/s", file=sys.stderr)
+    return results
+
+
+def metadata():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(os.path.abspath(__file__)), check=True,
+        ).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'date': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    """Print the change of the fastest rounds against a baseline; return the regressions"""
+    regressions = []
+    print(f"{'benchmark':<40}{'baseline ms':>13}{'current ms':>12}{'change':>9}")
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before, after = baseline[name]['min'], result['min']
+        change = after / before - 1
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<40}{before * 1000:>13.1f}{after * 1000:>12.1f}{change:>+9.1%}{flag}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        type=lambda sizes: [int(size) for size in sizes.split(',')],
+                        help='comma-separated library sizes')
+    parser.add_argument('--rounds', type=int, default=DEFAULT_ROUNDS)
+    parser.add_argument('--output', help='file to save the results to, as JSON')
+    parser.add_argument('--compare', metavar='BASELINE', help='results file to compare to')
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='slowdown that counts as a regression, as a fraction')
+    args = parser.parse_args(argv)
+
+    report = {'metadata': metadata(), 'results': run(args.sizes, args.rounds)}
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        if compare(report['results'], baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -42,3 +42,32 @@ def test_cachedproperty():
 
     with pytest.raises(AttributeError):
         del Class().value       # instance attribute does not exist before descriptor call
+
+
+def test_cachedslotproperty():
+    class Class:
+        __slots__ = ('callcount', '_value')
+
+        def __init__(self):
+            self.callcount = 0
+
+        @types.CachedSlotProperty
+        def value(self):
+            self.callcount += 1
+            return self.callcount
+
+    instance = Class()
+    assert instance.value == 1  # first access: descriptor calls property function, fills slot
+    assert instance.value == 1  # following accesses: value comes from slot
+    assert instance.callcount == 1
+
+    del instance._value         # emptying the slot makes the descriptor call the function again
+    assert instance.value == 2
+
+    preset = Class()
+    Class._value.__set__(preset, 'preset')
+    assert preset.value == 'preset'
+    assert preset.callcount == 0
+
+    with pytest.raises(AttributeError):
+        instance.value = 3      # no __set__, and no __dict__ to fall back on
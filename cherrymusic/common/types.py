@@ -53,6 +53,41 @@ class CachedProperty:
             return result
 
 
+class CachedSlotProperty:
+    """Like :class:`CachedProperty`, but for classes with ``__slots__`` instead of a ``__dict__``
+
+    The result of the first access is stored in a slot named like the property with a leading
+    underscore, which the class or one of its base classes must declare in its ``__slots__``.
+    Other code can also fill that slot beforehand, e.g. with a value that is known at
+    initialization.
+
+    Args:
+        getter: A function to determine the value of the property; it will receive the instance
+                as its sole argument.
+    """
+
+    def __init__(self, getter):
+        assert callable(getter)
+        self.getter = getter
+        self.__doc__ = getter.__doc__
+
+    def __set_name__(self, owner, name):
+        # called by Py3.6+, after the slot descriptors have been created
+        self.name = name
+        self.slot = getattr(owner, '_' + name)
+
+    def __get__(self, instance, owner):
+        if instance is None:  # pragma: no cover
+            return self
+        slot = self.slot
+        try:
+            return slot.__get__(instance, owner)
+        except AttributeError:
+            result = self.getter(instance)
+            slot.__set__(instance, result)
+            return result
+
+
 def sentinel(name):
     """Create a unique, one-off object with a useful repr"""
     def __repr__(_):
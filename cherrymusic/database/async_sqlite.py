@@ -0,0 +1,203 @@
+# -*- coding: UTF-8 -*-
+"""Asyncio facade for :class:`~cherrymusic.database.sqlite.SqliteDatabase`"""
+import asyncio
+import functools
+import itertools
+import logging
+import sqlite3
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .sqlite import DEFAULT_FETCH_SIZE, ISOLATION, TransactionError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_WORKERS = 4
+
+_get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)  # Python 3.7+
+
+
+class AsyncSqliteDatabase:
+    """Run the transactions of a SqliteDatabase on worker threads, without blocking the event loop
+
+    Every transaction runs all of its statements on one worker thread, so it keeps its
+    connection like a :class:`~cherrymusic.database.sqlite.SqliteTransaction` does, and has the
+    same isolation semantics. There is a fixed number of workers; a transaction waits for a free
+    one before it begins, so callers get back-pressure instead of an unbounded queue of work.
+
+    Args:
+        database: The :class:`~cherrymusic.database.sqlite.SqliteDatabase`
+        max_workers: The number of worker threads, and so of concurrent transactions
+    """
+
+    def __init__(self, database, *, max_workers=DEFAULT_MAX_WORKERS):
+        assert max_workers > 0
+        self.database = database
+        self.max_workers = max_workers
+        self._workers = [
+            ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'{database.qualname}-{number}')
+            for number in range(max_workers)
+        ]
+        self._idle = None  # asyncio.Queue of idle workers, created on the event loop
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.database!r}, max_workers={self.max_workers!r})'
+
+    def transaction(self, **kwargs):
+        """Return an :class:`AsyncSqliteTransaction`; arguments as for ``SqliteTransaction``"""
+        return AsyncSqliteTransaction(self, **kwargs)
+
+    async def execute(self, sql, params=(), **kwargs):
+        async with self.transaction(isolation=ISOLATION.DEFAULT) as tx:
+            return await tx.execute(sql, params, **kwargs)
+
+    async def close(self):
+        """Wait for running transactions' work, stop the workers and close idle connections"""
+        loop = _get_running_loop()
+        for worker in self._workers:
+            await loop.run_in_executor(None, functools.partial(worker.shutdown, wait=True))
+        self.database.close()
+
+    async def _acquire_worker(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for worker in self._workers:
+                self._idle.put_nowait(worker)
+        return await self._idle.get()
+
+    def _release_worker(self, worker):
+        self._idle.put_nowait(worker)
+
+
+class AsyncSqliteTransaction:
+    """Async context manager for a SqliteTransaction that runs on a single worker thread
+
+    Leaving the context commits, or rolls back if an exception occurred. Like
+    :class:`~cherrymusic.database.sqlite.SqliteTransaction`, transactions can't be nested.
+    """
+
+    def __init__(self, database, **kwargs):
+        self.database = database
+        self._kwargs = kwargs
+        self._transaction = None  # the SqliteTransaction; thread-local, so made on the worker
+        self._worker = None
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.database!r})'
+
+    async def __aenter__(self):
+        if self._worker is not None:
+            raise TransactionError(f'Transactions cannot be nested! ({self})')
+        self._worker = await self.database._acquire_worker()
+        try:
+            await self._run(self._begin)
+        except BaseException:
+            # the worker runs one job at a time, so this runs after the transaction's BEGIN,
+            # even if the caller got cancelled before the BEGIN was done
+            self._worker.submit(self._abort)
+            self._release()
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            # shielded, so a cancelled caller can't leave the transaction open on the worker
+            await asyncio.shield(self._call('__exit__', exc_type, exc_val, exc_tb))
+        finally:
+            self._release()
+
+    async def commit(self):
+        """Manually commit any pending changes during the transaction"""
+        await self._call('commit')
+
+    async def execute(self, sql, params=(), cursor_callback=sqlite3.Cursor.fetchall):
+        """Execute SQL with given params and return (by default: all) results
+
+        The cursor callback runs on the worker thread.
+        """
+        return await self._call('execute', sql, params, cursor_callback)
+
+    async def executemany(self, sql, seq_of_params):
+        """Execute SQL for every item in a sequence or iterator of params; return the row count
+
+        An iterator of params is consumed on the worker thread.
+        """
+        return await self._call('executemany', sql, seq_of_params)
+
+    def iterate(self, sql, params=(), *, fetch_size=DEFAULT_FETCH_SIZE):
+        """Return an asynchronous iterator over the rows of a query
+
+        The query runs when the first row is requested, and rows are fetched ``fetch_size`` at
+        a time only when the consumer asks for more. Like with
+        :meth:`~cherrymusic.database.sqlite.SqliteTransaction.iterate`, the rows must be
+        consumed within the transaction.
+        """
+        return AsyncRowIterator(self, sql, params, fetch_size)
+
+    async def _call(self, method, *args):
+        """Call a method of the SqliteTransaction on the worker thread"""
+        if self._transaction is None:
+            raise TransactionError(f'Do not call outside of transaction context! ({self})')
+        return await self._run(getattr(self._transaction, method), *args)
+
+    async def _run(self, function, *args):
+        if self._worker is None:
+            raise TransactionError(f'Do not call outside of transaction context! ({self})')
+        loop = _get_running_loop()
+        return await loop.run_in_executor(self._worker, functools.partial(function, *args))
+
+    def _begin(self):
+        self._transaction = self.database.database.transaction(**self._kwargs)
+        self._transaction.__enter__()
+
+    def _abort(self):
+        if self._transaction is not None:
+            self._transaction.close()
+
+    def _release(self):
+        worker, self._worker = self._worker, None
+        self.database._release_worker(worker)
+
+
+class AsyncRowIterator:
+    """Asynchronous iterator over the result rows of a query in an AsyncSqliteTransaction"""
+
+    def __init__(self, transaction, sql, params, fetch_size):
+        self._transaction = transaction
+        self._query = (sql, params)
+        self._fetch_size = fetch_size
+        self._rows = None  # the SqliteTransaction's RowIterator, once the query has run
+        self._batch = deque()
+        self._exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._transaction._worker is None and not self._exhausted:
+            raise TransactionError('Rows are not available after the transaction has ended')
+        if not self._batch:
+            if self._exhausted:
+                raise StopAsyncIteration
+            self._batch.extend(await self._transaction._run(self._fetch))
+            if not self._batch:
+                self._exhausted = True
+                raise StopAsyncIteration
+        return self._batch.popleft()
+
+    async def aclose(self):
+        """Close the query; rows that have not been consumed will not be available"""
+        self._batch.clear()
+        self._exhausted = True
+        if self._rows is not None:
+            await self._transaction._run(self._rows.close)
+
+    def _fetch(self):
+        """Return the next batch of rows; runs on the transaction's worker thread"""
+        if self._rows is None:
+            sql, params = self._query
+            self._rows = self._transaction._transaction.iterate(
+                sql, params, fetch_size=self._fetch_size)
+        return list(itertools.islice(self._rows, self._fetch_size))
@@ -0,0 +1,167 @@
+# -*- coding: UTF-8 -*-
+import logging
+import random
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+perf_counter_ns = getattr(time, 'perf_counter_ns', None) or (  # pragma: no cover
+    lambda: int(time.perf_counter() * 1e9)  # Python 3.6
+)
+
+DEFAULT_RESERVOIR_SIZE = 1024
+
+# Active query hooks. Queries only get timed while this list is not empty, so instrumentation
+# costs nothing when no hooks are installed.
+hooks = []
+
+
+def install(hook):
+    """Call ``hook(sql, params, duration_ns, rows)`` after every query, until uninstalled
+
+    ``rows`` is the number of rows returned or changed, or ``None`` if unknown. Hooks run on
+    the thread executing the query.
+    """
+    if hook not in hooks:
+        hooks.append(hook)
+    return hook
+
+
+def uninstall(hook):
+    """Stop calling a hook; does nothing if the hook is not installed"""
+    try:
+        hooks.remove(hook)
+    except ValueError:
+        pass
+
+
+def emit(sql, params, duration_ns, rows):
+    """Pass a query's measurements to all hooks"""
+    for hook in list(hooks):
+        try:
+            hook(sql, params, duration_ns, rows)
+        except Exception:
+            log.exception('Error in query hook %r', hook)
+
+
+class QueryLogger:
+    """Query hook that logs every query with its runtime"""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger or logging.getLogger('cherrymusic.database.sqlite.queries')
+        self.level = level
+
+    def __call__(self, sql, params, duration_ns, rows):
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, 'Query:\n\t%s\nParams:\n\t%r\nRuntime: %.3fs, rows: %s',
+                            sql, params, duration_ns / 1e9, rows)
+
+
+class SlowQueryLog:
+    """Query hook that logs a warning for queries taking at least ``threshold_ms``"""
+
+    def __init__(self, threshold_ms, logger=None):
+        self.threshold_ns = int(threshold_ms * 1e6)
+        self.logger = logger or logging.getLogger('cherrymusic.database.sqlite.slow_queries')
+
+    def __call__(self, sql, params, duration_ns, rows):
+        if duration_ns >= self.threshold_ns:
+            self.logger.warning('Slow query (%.1fms, rows: %s):\n\t%s\nParams:\n\t%r',
+                                duration_ns / 1e6, rows, sql, params)
+
+
+class StatementStats:
+    """Aggregated measurements of a single SQL statement
+
+    Runtimes for percentiles are kept in a reservoir sample of bounded size, so percentiles are
+    exact up to ``reservoir_size`` executions, and estimates after that.
+    """
+
+    __slots__ = ('count', 'total_ns', 'max_ns', 'rows', 'reservoir_size', '_samples', '_random')
+
+    def __init__(self, reservoir_size=DEFAULT_RESERVOIR_SIZE, *, seed=None):
+        self.count = 0
+        self.total_ns = 0
+        self.max_ns = 0
+        self.rows = 0
+        self.reservoir_size = reservoir_size
+        self._samples = []
+        self._random = random.Random(seed)
+
+    def add(self, duration_ns, rows):
+        self.count += 1
+        self.total_ns += duration_ns
+        self.max_ns = max(self.max_ns, duration_ns)
+        self.rows += rows or 0
+        samples = self._samples
+        if len(samples) < self.reservoir_size:
+            samples.append(duration_ns)
+        else:
+            index = self._random.randrange(self.count)
+            if index < self.reservoir_size:
+                samples[index] = duration_ns
+
+    def percentile(self, percent):
+        """Return the runtime in ns below which ``percent`` percent of executions fall"""
+        samples = sorted(self._samples)
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(len(samples) * percent / 100))
+        return samples[index]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total_ns / 1e6,
+            'max_ms': self.max_ns / 1e6,
+            'p50_ms': self.percentile(50) / 1e6,
+            'p95_ms': self.percentile(95) / 1e6,
+            'p99_ms': self.percentile(99) / 1e6,
+            'rows': self.rows,
+        }
+
+
+class QueryStats:
+    """Query hook that aggregates runtimes and row counts per SQL statement
+
+    Statements are grouped by their SQL string, so use parameters instead of formatting values
+    into statements to keep the number of groups small.
+    """
+
+    def __init__(self, reservoir_size=DEFAULT_RESERVOIR_SIZE):
+        self.reservoir_size = reservoir_size
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, sql, params, duration_ns, rows):
+        with self._lock:
+            try:
+                stats = self._stats[sql]
+            except KeyError:
+                stats = self._stats[sql] = StatementStats(self.reservoir_size)
+            stats.add(duration_ns, rows)
+
+    def snapshot(self):
+        """Return a dict of ``{sql: {'count': ..., 'p50_ms': ..., ...}}`` for all statements"""
+        with self._lock:
+            return {sql: stats.as_dict() for sql, stats in self._stats.items()}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def dump(self, file=None, *, top=20, sort_by='total_ms'):
+        """Write a table of the ``top`` statements, sorted by a key of :meth:`snapshot` values"""
+        file = file or sys.stdout
+        items = sorted(self.snapshot().items(), key=lambda item: item[1][sort_by], reverse=True)
+        columns = ('count', 'total_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms', 'rows')
+        print(''.join(f'{column:>11}' for column in columns), ' statement', file=file)
+        for sql, stats in items[:top]:
+            values = ''.join(
+                f'{stats[column]:>11}' if isinstance(stats[column], int) else
+                f'{stats[column]:>11.3f}'
+                for column in columns
+            )
+            print(values, ' ', ' '.join(sql.split()), file=file)
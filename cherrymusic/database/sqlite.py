@@ -2,21 +2,37 @@
 import logging
 import os
 import pathlib
+import re
 import sqlite3
 import threading
 import time
+import weakref
+from collections import OrderedDict, deque
 from contextlib import closing
 from enum import Enum
 
 from cherrymusic.common.types import sentinel
 
+from . import instrumentation
+from .instrumentation import perf_counter_ns
+
 DB_BASEDIR = '/tmp/data/cherrymusic/db'
 
+DEFAULT_POOL_SIZE = 8  # room for the async workers and the writer, plus a few threads
+DEFAULT_POOL_IDLE_SECS = 60
+DEFAULT_STATEMENT_CACHE_SIZE = 128  # default of sqlite3.connect in Python 3.11+
+DEFAULT_FETCH_SIZE = 256
+SQLITE3_DEFAULT_TIMEOUT_SECS = 5.0  # default of sqlite3.connect
+
 
 class TransactionError(Exception):
     pass
 
 
+class PoolTimeoutError(TransactionError):
+    """All pooled connections stayed in use for longer than the timeout"""
+
+
 class ISOLATION(Enum):
     DEFAULT = sentinel('DEFAULT')
     AUTOCOMMIT = None
@@ -25,19 +41,185 @@ class ISOLATION(Enum):
     EXCLUSIVE = "EXCLUSIVE"
 
 
-query_logger = logging.getLogger(__name__ + '.queries').info
+log = logging.getLogger(__name__)
+
+_pragma_value = re.compile(r'^[\w.+-]+$').match
+
+
+# Named sets of PRAGMAs for connections, selectable per database or per transaction.
+# See https://sqlite.org/pragma.html and https://sqlite.org/wal.html
+PRAGMA_PROFILES = {
+    'default': {},
+    'read-heavy': {
+        'journal_mode': 'WAL',  # readers and the writer don't block each other
+        'synchronous': 'NORMAL',  # durable enough with WAL: only checkpoints wait for fsync
+        'mmap_size': 256 * 2 ** 20,  # bytes
+        'cache_size': -64 * 2 ** 10,  # negative values are KiB
+        'temp_store': 'MEMORY',
+    },
+    'bulk-import': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',  # the last transactions may get lost on power failure or OS crash
+        'mmap_size': 256 * 2 ** 20,
+        'cache_size': -256 * 2 ** 10,
+        'temp_store': 'MEMORY',
+    },
+}
+
+
+def profile_pragmas(profile):
+    """Return the PRAGMAs for a profile name from :data:`PRAGMA_PROFILES`"""
+    try:
+        return PRAGMA_PROFILES[profile]
+    except KeyError:
+        raise ValueError(f'Unknown PRAGMA profile: {profile!r}') from None
+
+
+def pragma_statement(name, value=None):
+    """Return a statement to query or set a PRAGMA, since PRAGMAs don't accept parameters"""
+    if not name.isidentifier():
+        raise ValueError(f'Invalid PRAGMA name: {name!r}')
+    if value is None:
+        return f'PRAGMA {name}'
+    value = str(value)
+    if not _pragma_value(value):
+        raise ValueError(f'Invalid PRAGMA value: {name!r} = {value!r}')
+    return f'PRAGMA {name} = {value}'
+
+
+class StatementCache:
+    """Hit and miss statistics for the prepared statement cache of a connection
+
+    sqlite3 keeps an LRU cache of prepared statements for every connection, keyed by SQL string
+    and limited to ``cached_statements`` entries, but keeps no statistics. This class applies the
+    same LRU policy to the statements executed with a :class:`Connection` to count them.
+
+    Args:
+        size: The size of the connection's statement cache
+        totals: :class:`StatementCacheTotals` to count hits and misses in as well
+    """
+
+    def __init__(self, size, totals=None):
+        self.size = size
+        self.totals = totals
+        self.hits = 0
+        self.misses = 0
+        self._statements = OrderedDict()
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}(size={self.size}, hits={self.hits}, misses={self.misses})'
+
+    def __len__(self):
+        return len(self._statements)
+
+    def record(self, sql):
+        statements = self._statements
+        hit = sql in statements
+        if hit:
+            self.hits += 1
+            statements.move_to_end(sql)
+        else:
+            self.misses += 1
+            if self.size:
+                statements[sql] = None
+                if len(statements) > self.size:
+                    statements.popitem(last=False)
+        if self.totals is not None:
+            self.totals.count(hit)
+
+
+class StatementCacheTotals:
+    """Statement cache hits and misses, summed up over connections that may be used by any thread"""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}(hits={self.hits}, misses={self.misses})'
+
+    def count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def as_dict(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses}
+
+
+class Connection(sqlite3.Connection):
+    """A sqlite3.Connection that keeps track of PRAGMAs, cached statements and open cursors
+
+    This way, pooled connections can switch between sets of PRAGMAs, and only changed values
+    need to be set.
+    """
+
+    # properties of the database file rather than the connection: they are never reverted
+    PERSISTENT_PRAGMAS = frozenset({'journal_mode'})
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pragmas = {}
+        self._original_pragmas = {}
+        self.statement_cache = StatementCache(
+            kwargs.get('cached_statements', DEFAULT_STATEMENT_CACHE_SIZE))
+        self.open_iterators = weakref.WeakSet()  # to be closed with the transaction
+
+    def execute(self, sql, *args):
+        self.statement_cache.record(sql)
+        return super().execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        self.statement_cache.record(sql)
+        return super().executemany(sql, *args)
+
+    def set_pragmas(self, pragmas):
+        """Set PRAGMAs to match a mapping; PRAGMAs set earlier, but missing now, are reverted"""
+        for name in [name for name in self.pragmas if name not in pragmas]:
+            original = self._original_pragmas[name]
+            if name not in self.PERSISTENT_PRAGMAS and original is not None:
+                self.execute(pragma_statement(name, original)).close()
+            del self.pragmas[name]
+        for name, value in pragmas.items():
+            if name in self.pragmas and self.pragmas[name] == value:
+                continue
+            if name not in self._original_pragmas:
+                row = self.execute(pragma_statement(name)).fetchone()
+                self._original_pragmas[name] = row[0] if row else None
+            self.execute(pragma_statement(name, value)).close()
+            self.pragmas[name] = value
 
 
 class SqliteDatabase:
     """Simple OOP Wrapper for a SQLite database.
 
+    Transactions borrow their connections from a :class:`ConnectionPool`, unless the pool is
+    disabled. In-memory databases never use a pool, since every connection to ':memory:' opens
+    a separate, empty database.
+
     Args:
         qualname: The qualified name of the database consists of a number of names separated by
             dots. It gets translated to the file path like by replacing the dots with path
             separators and appending `.sqlite`. Use ':memory:' for an in-memory database.
+        profile: The name of a PRAGMA profile (see :data:`PRAGMA_PROFILES`) for all connections
+        pragmas: A mapping of PRAGMA names to values for all connections, in addition to the
+            profile; these take precedence over the profile's values
+        pool_size: The maximum number of open connections, idle or in use; when all of them are
+            in use, transactions wait for one to be released. 0 disables the pool.
+        pool_idle_secs: Idle connections are closed after this many seconds
+        statement_cache_size: The number of prepared statements to cache per connection; the
+            hits and misses of all connections are counted in :meth:`statement_cache_stats`
     """
 
-    def __init__(self, qualname, *, basepath=None):
+    def __init__(self, qualname, *, basepath=None, profile='default', pragmas=None,
+                 pool_size=DEFAULT_POOL_SIZE, pool_idle_secs=DEFAULT_POOL_IDLE_SECS,
+                 statement_cache_size=DEFAULT_STATEMENT_CACHE_SIZE):
         basepath = basepath or DB_BASEDIR
         self.qualname = qualname
         if qualname == ':memory:':
@@ -45,6 +227,20 @@ class SqliteDatabase:
         else:
             subpath = qualname.replace('.', os.path.sep) + '.sqlite'
             self.db_path = os.path.join(basepath, subpath)
+        self.profile = profile
+        self.pragmas = dict(profile_pragmas(profile), **(pragmas or {}))
+        self.statement_cache_size = statement_cache_size
+        self._statement_cache_totals = StatementCacheTotals()
+        if self.db_path == ':memory:' or not pool_size:
+            self.pool = None
+        else:
+            self.pool = ConnectionPool(
+                lambda: self.connect(check_same_thread=False),
+                max_size=pool_size,
+                max_idle_secs=pool_idle_secs,
+            )
+        self._writer = None
+        self._writer_lock = threading.Lock()
 
     def __repr__(self):
         clsname = type(self).__name__
@@ -53,12 +249,28 @@ class SqliteDatabase:
     def transaction(self, **kwargs):
         return SqliteTransaction(self, **kwargs)
 
-    def connect(self, *, isolation=ISOLATION.DEFAULT, timeout_secs=None):
+    @property
+    def writer(self):
+        """The :class:`~cherrymusic.database.writer.SqliteWriter` for this database
+
+        It is created on first use. Writes submitted to it are serialized on one thread and
+        committed in batches, so concurrent writers don't contend for the database lock.
+        """
+        with self._writer_lock:
+            if self._writer is None:
+                from .writer import SqliteWriter  # the writer module depends on this one
+                self._writer = SqliteWriter(self)
+            return self._writer
+
+    def connect(self, *, isolation=ISOLATION.DEFAULT, timeout_secs=None, check_same_thread=True):
         """Create a connection to the SQLite database represented by this instance.
 
+        The connection is not pooled, and the database's pragmas are already set.
+
         Args:
             isolation: Isolation mode; same default as sqlite3.connect
             timeout_secs: Seconds to wait on a locked database; same defaults as sqlite3.connect
+            check_same_thread: Same as for sqlite3.connect
 
         Returns:
             A sqlite3.Connection object for this database
@@ -77,7 +289,78 @@ class SqliteDatabase:
             kwargs['isolation_level'] = isolation.value
         if timeout_secs is not None:
             kwargs['timeout'] = timeout_secs
-        return sqlite3.connect(target, **kwargs)
+        connection = sqlite3.connect(
+            target,
+            check_same_thread=check_same_thread,
+            factory=Connection,
+            cached_statements=self.statement_cache_size,
+            **kwargs,
+        )
+        connection.statement_cache.totals = self._statement_cache_totals
+        try:
+            connection.set_pragmas(self.pragmas)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    def acquire(self, *, isolation=ISOLATION.DEFAULT, timeout_secs=None, profile=None):
+        """Get a connection set up for a transaction, from the pool if possible
+
+        Connections must be handed back with :meth:`release` instead of being closed.
+
+        Args:
+            isolation, timeout_secs: Same as for :meth:`connect`
+            profile: The name of a PRAGMA profile to use on top of the database's PRAGMAs; the
+                database's own PRAGMAs are restored when the next transaction gets the connection.
+                The journal mode is a property of the database file and does not get restored.
+        """
+        pragmas = self.pragmas
+        if profile is not None:
+            pragmas = dict(pragmas, **profile_pragmas(profile))
+        if self.pool is None:
+            connection = self.connect(isolation=isolation, timeout_secs=timeout_secs)
+        else:
+            if timeout_secs is None:
+                timeout_secs = SQLITE3_DEFAULT_TIMEOUT_SECS
+            connection = self.pool.acquire(timeout_secs=timeout_secs)
+        try:
+            connection.set_pragmas(pragmas)
+            if self.pool is not None:
+                connection.isolation_level = (
+                    '' if isolation is ISOLATION.DEFAULT else isolation.value)
+                connection.execute(pragma_statement('busy_timeout', int(timeout_secs * 1000)))
+        except Exception:
+            if self.pool is None:
+                connection.close()
+            else:
+                self.pool.discard(connection)
+            raise
+        return connection
+
+    def release(self, connection):
+        """Hand back a connection from :meth:`acquire`, discarding any uncommitted changes"""
+        if self.pool is None:
+            connection.close()
+        else:
+            self.pool.release(connection)
+
+    def statement_cache_stats(self):
+        """Return the statement cache hits and misses of all connections this database created
+
+        Every statement executed with a connection counts, including PRAGMAs and the health
+        checks of pooled connections, whether the connection is idle, in use or closed by now.
+        """
+        return self._statement_cache_totals.as_dict()
+
+    def close(self):
+        """Finish pending writes and stop the writer, if any; close all idle pooled connections"""
+        with self._writer_lock:
+            writer, self._writer = self._writer, None
+        if writer is not None:
+            writer.close()
+        if self.pool is not None:
+            self.pool.clear()
 
     def execute(self, sql, params=(), **kwargs):
         with self.transaction(isolation=ISOLATION.DEFAULT) as tx:
@@ -89,16 +372,233 @@ class SqliteDatabase:
             pathlib.Path(db_dir).mkdir(mode=0o700, parents=True, exist_ok=True)
 
 
+class ConnectionPool:
+    """Thread-safe pool of sqlite3 connections with a maximum size
+
+    Connections are handed out to one thread at a time, but may be used by different threads
+    over their lifetime, so they must be created with ``check_same_thread=False``. A thread gets
+    back the connection it last released, if that one is still idle; otherwise, the most recently
+    used one, which is most likely to have a warm page cache.
+
+    No more than ``max_size`` connections are open at a time, counting idle connections and the
+    ones in use. If all of them are in use, :meth:`acquire` waits for one to be released.
+    Connections from the pool must be handed back with :meth:`release`, or :meth:`discard`
+    instead of being closed.
+
+    Args:
+        connect: A callable that creates a new connection
+        max_size: The maximum number of open connections, idle or in use
+        max_idle_secs: Idle connections are closed after this many seconds
+    """
+
+    def __init__(self, connect, *, max_size=DEFAULT_POOL_SIZE,
+                 max_idle_secs=DEFAULT_POOL_IDLE_SECS):
+        assert max_size > 0
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle_secs = max_idle_secs
+        self._idle = deque()  # (connection, release_time, thread_id), most recently released last
+        self._open = 0  # connections from this pool that are not closed, idle or in use
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}(max_size={self.max_size!r}, max_idle_secs={self.max_idle_secs!r})'
+
+    def __len__(self):
+        return len(self._idle)
+
+    def acquire(self, *, timeout_secs=None):
+        """Return a healthy connection: an idle one, or a new one if there is room for it
+
+        Args:
+            timeout_secs: How long to wait for a connection if all are in use; ``None`` waits
+                as long as it takes
+
+        Raises:
+            PoolTimeoutError: If no connection became available in time
+        """
+        deadline = None if timeout_secs is None else time.monotonic() + timeout_secs
+        while True:
+            connection = self._take_idle(deadline)
+            if connection is None:  # room for a new one has been reserved
+                try:
+                    return self.connect()
+                except BaseException:
+                    self._forget(1)
+                    raise
+            if self._is_healthy(connection):
+                return connection
+            log.warning('Discarding broken pooled connection %r', connection)
+            self.discard(connection)
+
+    def release(self, connection):
+        """Return a connection to the pool, rolling back any open transaction"""
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except sqlite3.Error as error:
+            log.warning('Discarding pooled connection %r: %s', connection, error)
+            self.discard(connection)
+            return
+        entry = (connection, time.monotonic(), threading.get_ident())
+        with self._lock:
+            expired = self._evict_expired()
+            self._idle.append(entry)
+            self._released.notify(1 + len(expired))
+        for conn in expired:
+            conn.close()
+
+    def discard(self, connection):
+        """Close a connection from :meth:`acquire` instead of returning it to the pool"""
+        connection.close()
+        self._forget(1)
+
+    def connections(self):
+        """Return a list of the idle connections"""
+        with self._lock:
+            return [connection for connection, _, _ in self._idle]
+
+    def clear(self):
+        """Close all idle connections"""
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+            self._open -= len(idle)
+            self._released.notify_all()
+        for connection, _, _ in idle:
+            connection.close()
+
+    def _take_idle(self, deadline):
+        """Return an idle connection, or ``None`` after reserving room for a new one"""
+        thread_id = threading.get_ident()
+        expired = []
+        try:
+            with self._lock:
+                while True:
+                    expired += self._evict_expired()
+                    idle = self._idle
+                    for index in range(len(idle) - 1, -1, -1):
+                        if idle[index][2] == thread_id:
+                            connection = idle[index][0]
+                            del idle[index]
+                            return connection
+                    if idle:
+                        return idle.pop()[0]
+                    if self._open < self.max_size:
+                        self._open += 1
+                        return None
+                    timeout = None if deadline is None else deadline - time.monotonic()
+                    if timeout is not None and timeout <= 0:
+                        raise PoolTimeoutError(
+                            f'All {self.max_size} pooled connections are in use')
+                    self._released.wait(timeout)
+        finally:
+            for conn in expired:
+                conn.close()
+
+    def _forget(self, count):
+        """Make room for new connections after closing some that were open"""
+        with self._lock:
+            self._open -= count
+            self._released.notify(count)
+
+    def _evict_expired(self):
+        """Remove expired connections from the pool and return them; lock must be held"""
+        idle = self._idle
+        deadline = time.monotonic() - self.max_idle_secs
+        expired = []
+        while idle and idle[0][1] < deadline:
+            expired.append(idle.popleft()[0])
+        self._open -= len(expired)
+        return expired
+
+    @staticmethod
+    def _is_healthy(connection):
+        try:
+            connection.execute('SELECT 1').close()
+        except sqlite3.Error:
+            return False
+        return True
+
+
+class RowIterator:
+    """Iterator over the result rows of a cursor, fetching them in chunks of ``fetch_size``
+
+    Args:
+        cursor: The cursor of an executed query
+        fetch_size: The number of rows to fetch at a time
+        query: For instrumentation, the ``(sql, params)`` of the query; if given, its runtime
+            and row count are measured and reported to the query hooks when the rows run out
+        elapsed_ns: Time already spent on the query before the iterator was created
+    """
+
+    def __init__(self, cursor, fetch_size=DEFAULT_FETCH_SIZE, *, query=None, elapsed_ns=0):
+        self._cursor = cursor
+        self._fetch_size = fetch_size
+        self._rows = iter(())
+        self._interrupted = False
+        self._query = query
+        self._elapsed_ns = elapsed_ns
+        self._rowcount = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._rows)
+        except StopIteration:
+            pass
+        if self._cursor is None:
+            if self._interrupted:
+                raise TransactionError('Rows are not available after the transaction has ended')
+            raise StopIteration
+        if self._query is None:
+            rows = self._cursor.fetchmany(self._fetch_size)
+        else:
+            start_ns = perf_counter_ns()
+            rows = self._cursor.fetchmany(self._fetch_size)
+            self._elapsed_ns += perf_counter_ns() - start_ns
+            self._rowcount += len(rows)
+        if not rows:
+            self._finish()
+            raise StopIteration
+        self._rows = iter(rows)
+        return next(self._rows)
+
+    def close(self):
+        """Close the underlying cursor; rows that have not been consumed will not be available"""
+        if self._cursor is not None:
+            self._interrupted = True
+            self._rows = iter(())
+            self._finish()
+
+    def _finish(self):
+        cursor, self._cursor = self._cursor, None
+        cursor.close()
+        if self._query is not None:
+            sql, params = self._query
+            instrumentation.emit(sql, params, self._elapsed_ns, self._rowcount)
+
+
+def _rowcount(cursor):
+    """Return the number of rows changed by a cursor's last statement, or None if unknown"""
+    rowcount = cursor.rowcount
+    return rowcount if rowcount >= 0 else None
+
+
 class SqliteTransaction:
     """Context manager that wraps an sqlite3.Connection, with commit or rollback on exit.
 
     ..note:: Session contexts can not be nested.
     """
 
-    def __init__(self, database, *, isolation=ISOLATION.DEFAULT, timeout_secs=3):
+    def __init__(self, database, *, isolation=ISOLATION.DEFAULT, timeout_secs=3, profile=None):
         self.database = database
         self.isolation = isolation
         self.timeout_secs = timeout_secs
+        self.profile = profile
         self.__local = threading.local()  # we'll cache the connection thead-locally
         self.__local.connection = None  # only the current thread will have this attribute
 
@@ -139,7 +639,9 @@ class SqliteTransaction:
         conn = self._connection(may_be_none=True)
         self.__local.connection = None
         if conn:
-            conn.close()
+            for rows in list(conn.open_iterators):
+                rows.close()
+            self.database.release(conn)
 
     def commit(self):
         """Manually commit any pending changes during the transaction"""
@@ -147,17 +649,52 @@ class SqliteTransaction:
 
     def execute(self, sql, params=(), cursor_callback=sqlite3.Cursor.fetchall):
         """Execute SQL with given params and return (by default: all) results"""
-        if query_logger:
-            query_start_time = time.time()
-            query_logger(f'Query:\n\t{sql}\nParams:\n\t{params!r}')
+        connection = self._connection()
+        if not instrumentation.hooks:
+            with closing(connection.execute(sql, params)) as cursor:
+                return cursor_callback(cursor) if cursor_callback else None
+        start_ns = perf_counter_ns()
+        rows = None
         try:
-            with closing(self._connection().execute(sql, params)) as cursor:
-                if cursor_callback:
-                    return cursor_callback(cursor)
+            with closing(connection.execute(sql, params)) as cursor:
+                result = cursor_callback(cursor) if cursor_callback else None
+                rows = len(result) if isinstance(result, list) else _rowcount(cursor)
+                return result
         finally:
-            if query_logger:
-                runtime = time.time() - query_start_time
-                query_logger(f'Runtime: {round(runtime, 3):.3f}s')
+            instrumentation.emit(sql, params, perf_counter_ns() - start_ns, rows)
+
+    def executemany(self, sql, seq_of_params):
+        """Execute SQL for every item in a sequence or iterator of params; return the row count"""
+        connection = self._connection()
+        if not instrumentation.hooks:
+            with closing(connection.executemany(sql, seq_of_params)) as cursor:
+                return cursor.rowcount
+        start_ns = perf_counter_ns()
+        rows = None
+        try:
+            with closing(connection.executemany(sql, seq_of_params)) as cursor:
+                rows = cursor.rowcount
+                return rows
+        finally:
+            instrumentation.emit(sql, (), perf_counter_ns() - start_ns, rows)
+
+    def iterate(self, sql, params=(), *, fetch_size=DEFAULT_FETCH_SIZE):
+        """Execute SQL with given params and return an iterator over the resulting rows
+
+        Rows are fetched from the database lazily, ``fetch_size`` rows at a time. The iterator
+        must be consumed within the transaction context; closing the transaction closes it.
+        For instrumentation, the query counts as finished when the iterator runs out of rows.
+        """
+        connection = self._connection()
+        if not instrumentation.hooks:
+            rows = RowIterator(connection.execute(sql, params), fetch_size)
+        else:
+            start_ns = perf_counter_ns()
+            cursor = connection.execute(sql, params)
+            elapsed_ns = perf_counter_ns() - start_ns
+            rows = RowIterator(cursor, fetch_size, query=(sql, params), elapsed_ns=elapsed_ns)
+        connection.open_iterators.add(rows)
+        return rows
 
     def _connection(self, *, may_be_none=False):
         """Return the active transaction's db connection, or raise appropriate errors"""
@@ -174,8 +711,9 @@ class SqliteTransaction:
         conn = self._connection(may_be_none=True)
         if conn is not None:
             raise TransactionError(f'Transactions cannot be nested! ({self})')
-        conn = self.__local.connection = self.database.connect(
+        conn = self.__local.connection = self.database.acquire(
             isolation=self.isolation,
             timeout_secs=self.timeout_secs,
+            profile=self.profile,
         )
         return conn
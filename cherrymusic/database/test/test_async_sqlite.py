@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import sqlite3
+import threading
+
+import pytest
+
+from cherrymusic.common.test import helpers
+from cherrymusic.database import sqlite
+from cherrymusic.database.async_sqlite import AsyncSqliteDatabase
+from cherrymusic.database.sqlite import ISOLATION
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+
+@pytest.fixture
+def database():
+    with helpers.tempdir() as tmp_path:
+        db = sqlite.SqliteDatabase('test', basepath=tmp_path)
+        db.execute('CREATE TABLE test(a)')
+        yield db
+        db.close()
+
+
+def test_transaction_runs_on_one_thread(database):
+    adb = AsyncSqliteDatabase(database, max_workers=2)
+
+    def thread_id(cursor):
+        return threading.get_ident()
+
+    async def main():
+        async with adb.transaction() as tx:
+            await tx.executemany('INSERT INTO test VALUES (?)', ((i,) for i in range(5)))
+            threads = {await tx.execute('SELECT 1', cursor_callback=thread_id) for _ in range(5)}
+            rows = await tx.execute('SELECT a FROM test')
+        await adb.close()
+        return threads, rows
+
+    threads, rows = run(main())
+
+    assert len(threads) == 1 and threading.get_ident() not in threads
+    assert rows == [(i,) for i in range(5)]
+    assert database.execute('SELECT count(*) FROM test') == [(5,)]
+
+
+def test_transaction_commit_and_rollback(database):
+    adb = AsyncSqliteDatabase(database)
+
+    async def main():
+        async with adb.transaction() as tx:
+            await tx.execute('INSERT INTO test VALUES (1)')
+        with pytest.raises(ZeroDivisionError):
+            async with adb.transaction() as tx:
+                await tx.execute('INSERT INTO test VALUES (2)')
+                1 / 0
+        with pytest.raises(sqlite.TransactionError):
+            await adb.transaction().execute('SELECT 1')
+        async with adb.transaction() as tx:
+            with pytest.raises(sqlite.TransactionError):
+                async with tx:
+                    pass  # pragma: no cover
+        with pytest.raises(sqlite.TransactionError):
+            await tx.execute('SELECT 1')
+        return await adb.execute('SELECT a FROM test')
+
+    assert run(main()) == [(1,)]
+
+
+def test_iterate_fetches_rows_on_demand(database):
+    database.execute('INSERT INTO test VALUES (1), (2), (3), (4), (5)')
+    adb = AsyncSqliteDatabase(database)
+
+    async def main():
+        async with adb.transaction() as tx:
+            produced = []
+            await tx._run(lambda: tx._transaction._connection().create_function(
+                'produce', 1, lambda a: produced.append(a) or a))
+            rows = tx.iterate('SELECT produce(a) FROM test', fetch_size=2)
+            assert produced == []
+            assert await rows.__anext__() == (1,)
+            assert len(produced) < 5
+            assert [row async for row in rows] == [(2,), (3,), (4,), (5,)]
+
+            unfinished = tx.iterate('SELECT a FROM test', fetch_size=2)
+            await unfinished.__anext__()
+        with pytest.raises(sqlite.TransactionError):
+            await unfinished.__anext__()
+
+    run(main())
+
+
+def test_workers_bound_concurrent_transactions(database):
+    adb = AsyncSqliteDatabase(database, max_workers=1)
+    events = []
+
+    async def transaction(name):
+        async with adb.transaction():
+            events.append(f'begin {name}')
+            await asyncio.sleep(0.01)
+            events.append(f'end {name}')
+
+    async def main():
+        await asyncio.gather(transaction('a'), transaction('b'))
+
+    run(main())
+    assert events == ['begin a', 'end a', 'begin b', 'end b']
+
+
+def test_waiting_for_locks_does_not_block_the_loop(database):
+    adb = AsyncSqliteDatabase(database, max_workers=2)
+    ticks = []
+
+    async def ticker(done):
+        while not done.is_set():
+            ticks.append(None)
+            await asyncio.sleep(0.005)
+
+    async def main():
+        done = asyncio.Event()
+        ticking = asyncio.ensure_future(ticker(done))
+        async with adb.transaction(isolation=ISOLATION.IMMEDIATE) as writer:
+            await writer.execute('INSERT INTO test VALUES (1)')
+            other = adb.transaction(isolation=ISOLATION.IMMEDIATE, timeout_secs=0.1)
+            with pytest.raises(sqlite3.OperationalError, match='locked'):
+                async with other:
+                    pass  # pragma: no cover
+        done.set()
+        await ticking
+        async with adb.transaction(isolation=ISOLATION.IMMEDIATE) as other:
+            return await other.execute('SELECT a FROM test')
+
+    assert run(main()) == [(1,)]
+    assert len(ticks) > 5  # the loop kept running while the worker waited for the lock
@@ -0,0 +1,130 @@
+# -*- coding: UTF-8 -*-
+import io
+import logging
+from unittest import mock
+
+import pytest
+
+from cherrymusic.database import instrumentation, sqlite
+
+
+@pytest.fixture
+def install():
+    installed = []
+
+    def install_hook(hook):
+        installed.append(instrumentation.install(hook))
+        return hook
+
+    yield install_hook
+    for hook in installed:
+        instrumentation.uninstall(hook)
+
+
+@pytest.fixture
+def db():
+    return sqlite.SqliteDatabase(':memory:')
+
+
+def test_no_timing_without_hooks(db):
+    assert instrumentation.hooks == []
+    with mock.patch.object(sqlite, 'perf_counter_ns', side_effect=AssertionError):
+        with db.transaction() as tx:
+            tx.execute('CREATE TABLE test(a)')
+            tx.executemany('INSERT INTO test VALUES (?)', [(1,)])
+            list(tx.iterate('SELECT a FROM test'))
+
+
+def test_hooks_receive_measurements(db, install):
+    hook = install(mock.Mock())
+    with db.transaction() as tx:
+        tx.execute('CREATE TABLE test(a)')
+        tx.executemany('INSERT INTO test VALUES (?)', [(1,), (2,), (3,)])
+        tx.execute('SELECT a FROM test WHERE a > ?', (1,))
+        list(tx.iterate('SELECT a FROM test', fetch_size=2))
+
+    calls = [call[0] for call in hook.call_args_list]
+    assert [(sql, params, rows) for sql, params, _, rows in calls] == [
+        ('CREATE TABLE test(a)', (), 0),
+        ('INSERT INTO test VALUES (?)', (), 3),
+        ('SELECT a FROM test WHERE a > ?', (1,), 2),
+        ('SELECT a FROM test', (), 3),
+    ]
+    assert all(isinstance(duration_ns, int) for _, _, duration_ns, _ in calls)
+
+
+def test_hooks_uninstall(install):
+    hook = install(mock.Mock())
+    instrumentation.uninstall(hook)
+    instrumentation.uninstall(hook)
+    assert hook not in instrumentation.hooks
+
+
+def test_hook_errors_do_not_break_queries(db, install):
+    install(mock.Mock(side_effect=Exception))
+    assert db.execute('SELECT 1') == [(1,)]
+
+
+def test_query_stats(db, install):
+    stats = install(instrumentation.QueryStats())
+    for _ in range(10):
+        db.execute('SELECT 1, 2')
+    db.execute('SELECT 3')
+
+    snapshot = stats.snapshot()
+    assert snapshot.keys() == {'SELECT 1, 2', 'SELECT 3'}
+    assert snapshot['SELECT 1, 2']['count'] == 10
+    assert snapshot['SELECT 1, 2']['rows'] == 10
+    assert 0 < snapshot['SELECT 1, 2']['p50_ms'] <= snapshot['SELECT 1, 2']['p99_ms']
+    assert snapshot['SELECT 1, 2']['p99_ms'] <= snapshot['SELECT 1, 2']['max_ms']
+
+    out = io.StringIO()
+    stats.dump(out, top=1, sort_by='count')
+    lines = out.getvalue().splitlines()
+    assert len(lines) == 2
+    assert lines[0].split() == ['count', 'total_ms', 'p50_ms', 'p95_ms', 'p99_ms', 'max_ms',
+                                'rows', 'statement']
+    assert lines[1].split()[0] == '10'
+    assert lines[1].endswith('SELECT 1, 2')
+
+    stats.reset()
+    assert stats.snapshot() == {}
+
+
+def test_statement_stats_percentiles():
+    stats = instrumentation.StatementStats(reservoir_size=1000)
+    for duration in range(1, 101):
+        stats.add(duration * 10 ** 6, None)
+
+    assert stats.percentile(50) == 51 * 10 ** 6
+    assert stats.percentile(99) == 100 * 10 ** 6
+    assert stats.as_dict()['p95_ms'] == 96.0
+
+    small = instrumentation.StatementStats(reservoir_size=10, seed=0)
+    for duration in range(1000):
+        small.add(duration, 1)
+    assert small.count == 1000
+    assert small.rows == 1000
+    assert len(small._samples) == 10
+
+
+def test_slow_query_log(db, install, caplog):
+    install(instrumentation.SlowQueryLog(threshold_ms=0))
+    with caplog.at_level(logging.WARNING):
+        db.execute('SELECT 1')
+    assert 'Slow query' in caplog.text
+    assert 'SELECT 1' in caplog.text
+
+    caplog.clear()
+    instrumentation.uninstall(instrumentation.hooks[-1])
+    install(instrumentation.SlowQueryLog(threshold_ms=10 ** 6))
+    db.execute('SELECT 1')
+    assert caplog.text == ''
+
+
+def test_query_logger(db, install, caplog):
+    install(instrumentation.QueryLogger())
+    with caplog.at_level(logging.INFO):
+        db.execute('SELECT ?', (42,))
+    assert 'SELECT ?' in caplog.text
+    assert '(42,)' in caplog.text
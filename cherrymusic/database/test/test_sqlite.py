@@ -1,5 +1,6 @@
 # -*- coding: UTF-8 -*-
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 from functools import wraps
 from unittest import mock
@@ -62,7 +63,6 @@ def test_transaction_errors_when_nesting():
 
 
 def test_transaction_enforces_threadlocal():
-    from concurrent.futures import ThreadPoolExecutor
     db = _testdb()
     session = db.transaction()
 
@@ -129,3 +129,194 @@ def test_transaction_isolation():
 def test_database_execute():
     db = _testdb()
     assert db.execute('SELECT 1') == [(1,)]
+
+
+def test_transaction_executemany():
+    db = _testdb()
+    with db.transaction() as session:
+        session.execute('CREATE TABLE test(a)')
+        assert session.executemany('INSERT INTO test VALUES (?)', ((i,) for i in range(3))) == 3
+        assert session.execute('SELECT a FROM test') == [(0,), (1,), (2,)]
+
+
+@_temp_db_dir
+def test_transactions_reuse_pooled_connections():
+    db = _testdb('pooled')
+
+    with db.transaction() as tx:
+        first = tx._connection()
+    with db.transaction() as tx:
+        assert tx._connection() is first
+    with db.transaction() as tx, db.transaction() as other:
+        assert other._connection() is not first
+    assert len(db.pool) == 2
+
+    db.close()
+    assert len(db.pool) == 0
+
+
+def test_memory_databases_are_not_pooled():
+    assert _testdb().pool is None
+    assert sqlite.SqliteDatabase('unpooled', pool_size=0).pool is None
+
+
+@_temp_db_dir
+def test_connection_pool_prefers_connection_of_same_thread():
+    db = _testdb('affinity')
+    main_conn = db.acquire()
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        other_conn = executor.submit(db.acquire).result()
+        db.release(main_conn)
+        executor.submit(db.release, other_conn).result()
+
+        assert executor.submit(db.acquire).result() is other_conn
+    assert db.acquire() is main_conn
+
+
+def test_connection_pool_max_size_and_idle_eviction():
+    connections = [mock.Mock(in_transaction=False) for _ in range(3)]
+    pool = sqlite.ConnectionPool(iter(connections).__next__, max_size=2, max_idle_secs=10)
+
+    first, second = pool.acquire(), pool.acquire()
+    with pytest.raises(sqlite.PoolTimeoutError):
+        pool.acquire(timeout_secs=0.01)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        waiting = executor.submit(pool.acquire, timeout_secs=5)
+        pool.release(first)
+        assert waiting.result() is first
+    pool.release(first)
+    pool.release(second)
+    assert len(pool) == 2
+
+    with mock.patch('time.monotonic', return_value=sqlite.time.monotonic() + 11):
+        assert pool.acquire() is connections[2]  # the expired ones make room for it
+    assert len(pool) == 0
+    connections[0].close.assert_called_once_with()
+    connections[1].close.assert_called_once_with()
+
+
+def test_connection_pool_health_check():
+    broken = mock.Mock(in_transaction=False, execute=mock.Mock(side_effect=sqlite3.Error))
+    fresh = mock.Mock()
+    pool = sqlite.ConnectionPool(iter([broken, fresh]).__next__, max_size=1)
+    pool.release(pool.acquire())
+
+    assert pool.acquire(timeout_secs=0) is fresh  # the broken one doesn't count anymore
+    broken.close.assert_called_once_with()
+
+
+@_temp_db_dir
+def test_transactions_wait_for_a_pooled_connection():
+    db = sqlite.SqliteDatabase('testdb.capped', pool_size=1)
+    with db.transaction():
+        with pytest.raises(sqlite.PoolTimeoutError):
+            with db.transaction(timeout_secs=0.01):
+                pass  # pragma: no cover
+        with mock.patch.object(sqlite.Connection, 'set_pragmas', side_effect=sqlite3.Error):
+            with pytest.raises(sqlite.PoolTimeoutError):
+                db.acquire(timeout_secs=0.01)
+    with mock.patch.object(sqlite.Connection, 'set_pragmas', side_effect=sqlite3.Error):
+        with pytest.raises(sqlite3.Error):
+            db.acquire()
+    with db.transaction(timeout_secs=0.01) as tx:  # the failed one was discarded
+        assert tx.execute('SELECT 1') == [(1,)]
+
+
+@_temp_db_dir
+def test_connection_pool_rolls_back_on_release():
+    db = _testdb('rollback', 'CREATE TABLE test(a)')
+    tx = db.transaction()
+    with tx:
+        tx.execute('INSERT INTO test VALUES (1)')
+        tx.close()
+    assert db.execute('SELECT * FROM test') == []
+
+
+@_temp_db_dir
+def test_database_pragmas():
+    db = sqlite.SqliteDatabase('testdb.pragmas', pragmas={'cache_size': -1024, 'temp_store': 2})
+    with db.transaction() as tx:
+        assert tx.execute('PRAGMA cache_size') == [(-1024,)]
+        assert tx.execute('PRAGMA temp_store') == [(2,)]
+    with db.connect() as conn:
+        assert conn.execute('PRAGMA cache_size').fetchall() == [(-1024,)]
+
+    with pytest.raises(ValueError):
+        sqlite.pragma_statement('cache_size; DROP TABLE x', 1)
+    with pytest.raises(ValueError):
+        sqlite.pragma_statement('cache_size', '1; DROP TABLE x')
+
+
+@_temp_db_dir
+def test_database_pragma_profile():
+    db = sqlite.SqliteDatabase('testdb.profile', profile='read-heavy', pragmas={'cache_size': 99})
+    with db.transaction() as tx:
+        assert tx.execute('PRAGMA journal_mode') == [('wal',)]
+        assert tx.execute('PRAGMA synchronous') == [(1,)]  # NORMAL
+        assert tx.execute('PRAGMA cache_size') == [(99,)]
+
+    with pytest.raises(ValueError):
+        sqlite.SqliteDatabase('testdb.profile', profile='NO SUCH PROFILE')
+
+
+@_temp_db_dir
+def test_transaction_pragma_profile_is_reverted_for_next_transaction():
+    db = _testdb('txprofile')
+    with db.transaction() as tx:
+        default_synchronous = tx.execute('PRAGMA synchronous')
+
+    with db.transaction(profile='bulk-import') as tx:
+        assert tx.execute('PRAGMA synchronous') == [(0,)]  # OFF
+        assert tx.execute('PRAGMA temp_store') == [(2,)]  # MEMORY
+        bulk_connection = tx._connection()
+
+    with db.transaction() as tx:
+        assert tx._connection() is bulk_connection
+        assert tx.execute('PRAGMA synchronous') == default_synchronous
+        assert tx.execute('PRAGMA temp_store') == [(0,)]
+        assert tx.execute('PRAGMA journal_mode') == [('wal',)]  # persistent
+
+
+def test_transaction_iterate():
+    db = _testdb()
+    with db.transaction() as session:
+        session.execute('CREATE TABLE test(a)')
+        session.executemany('INSERT INTO test VALUES (?)', ((i,) for i in range(10)))
+
+        produced = []
+        session._connection().create_function('produce', 1, lambda a: produced.append(a) or a)
+
+        rows = session.iterate('SELECT produce(a) FROM test', fetch_size=4)
+        assert next(rows) == (0,)
+        assert len(produced) < 10  # fetch_size rows, plus one that sqlite3 reads ahead
+        assert list(rows) == [(i,) for i in range(1, 10)]
+
+        unfinished = session.iterate('SELECT a FROM test')
+        next(unfinished)
+
+    with pytest.raises(sqlite.TransactionError):  # closed with transaction
+        next(unfinished)
+
+    with pytest.raises(sqlite.TransactionError):
+        session.iterate('SELECT 1')
+
+
+@_temp_db_dir
+def test_statement_cache_stats():
+    db = sqlite.SqliteDatabase('testdb.statements', statement_cache_size=2)
+    with db.transaction() as tx:
+        cache = tx._connection().statement_cache
+        before = (cache.hits, cache.misses)
+        assert db.statement_cache_stats()['misses'] > 0  # PRAGMAs count as well
+        totals_before = db.statement_cache_stats()
+        for sql in ('SELECT 1', 'SELECT 2', 'SELECT 1', 'SELECT 3', 'SELECT 2'):
+            tx.execute(sql)
+
+        assert (cache.hits - before[0], cache.misses - before[1]) == (1, 4)
+        totals = db.statement_cache_stats()  # while the connection is in use
+        assert totals['hits'] - totals_before['hits'] == 1
+        assert totals['misses'] - totals_before['misses'] == 4
+    assert (cache.size, len(cache)) == (2, 2)
+
+    db.close()  # closed connections still count
+    assert db.statement_cache_stats() == totals
@@ -0,0 +1,110 @@
+# -*- coding: UTF-8 -*-
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from cherrymusic.common.test import helpers
+from cherrymusic.database import sqlite
+from cherrymusic.database.sqlite import ISOLATION
+from cherrymusic.database.writer import SqliteWriter
+
+
+@pytest.fixture
+def database():
+    with helpers.tempdir() as tmp_path:
+        db = sqlite.SqliteDatabase('test', basepath=tmp_path)
+        db.execute('CREATE TABLE test(a UNIQUE)')
+        yield db
+        db.close()
+
+
+def test_database_writer(database):
+    writer = database.writer
+    assert database.writer is writer
+
+    assert writer.execute('INSERT INTO test VALUES (1)').result() == []
+    assert writer.executemany('INSERT INTO test VALUES (?)', [(2,), (3,)]).result() == 2
+    assert writer.submit(lambda tx, a: tx.execute('SELECT ?', (a,)), 4).result() == [(4,)]
+    database.close()
+
+    assert database.execute('SELECT a FROM test') == [(1,), (2,), (3,)]
+    with pytest.raises(RuntimeError):
+        writer.execute('INSERT INTO test VALUES (5)')
+    assert database.writer is not writer
+
+
+def test_jobs_are_committed_in_batches(database):
+    writer = SqliteWriter(database, max_batch=3)
+    started, release = threading.Event(), threading.Event()
+
+    def first(tx):  # holds the writer in its first batch while the other jobs queue up
+        started.set()
+        assert release.wait(5)
+        return tx.execute('INSERT INTO test VALUES (0)')
+
+    futures = [writer.submit(first)]
+    assert started.wait(5)
+    futures += [writer.execute('INSERT INTO test VALUES (?)', (i,)) for i in range(1, 8)]
+    release.set()
+    writer.close()
+
+    assert [future.result() for future in futures] == [[]] * 8
+    assert writer.jobs == 8
+    assert writer.batches == 4  # 1 + 3 + 3 + 1
+    assert database.execute('SELECT count(*) FROM test') == [(8,)]
+
+
+def test_failed_job_rolls_back_only_its_own_changes(database):
+    writer = SqliteWriter(database)
+
+    def fail(tx):
+        tx.execute('INSERT INTO test VALUES (10)')
+        raise ValueError('job failed')
+
+    with database.transaction(isolation=ISOLATION.IMMEDIATE):
+        futures = [
+            writer.execute('INSERT INTO test VALUES (1)'),
+            writer.submit(fail),
+            writer.execute('INSERT INTO test VALUES (1)'),  # violates UNIQUE
+            writer.execute('INSERT INTO test VALUES (2)'),
+        ]
+    writer.close()
+
+    assert futures[0].result() == futures[3].result() == []
+    with pytest.raises(ValueError):
+        futures[1].result()
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[2].result()
+    assert database.execute('SELECT a FROM test') == [(1,), (2,)]
+
+
+def test_failed_batch_fails_all_its_jobs(database):
+    writer = SqliteWriter(database, timeout_secs=0)
+    with database.transaction(isolation=ISOLATION.IMMEDIATE):
+        future = writer.execute('INSERT INTO test VALUES (1)')
+        with pytest.raises(sqlite3.OperationalError, match='locked'):
+            future.result()
+    assert writer.execute('INSERT INTO test VALUES (2)').result() == []
+    writer.close()
+
+    assert database.execute('SELECT a FROM test') == [(2,)]
+
+
+def test_concurrent_writers_do_not_contend_for_the_lock(database):
+    writer = SqliteWriter(database, timeout_secs=0)
+    start = threading.Barrier(8)
+
+    def write(number):
+        start.wait()
+        futures = [writer.execute('INSERT INTO test VALUES (?)', (number * 100 + i,))
+                   for i in range(100)]
+        return [future.result() for future in futures]
+
+    with ThreadPoolExecutor(8) as threads:
+        list(threads.map(write, range(8)))
+    writer.close()
+
+    assert database.execute('SELECT count(*) FROM test') == [(800,)]
+    assert writer.batches < 800
@@ -0,0 +1,141 @@
+# -*- coding: UTF-8 -*-
+"""Serialize the writes to a SQLite database on a single thread, with group commit"""
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+
+from .sqlite import ISOLATION
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_BATCH = 256
+DEFAULT_TIMEOUT_SECS = 30
+
+_STOP = object()
+
+
+class SqliteWriter:
+    """A thread that runs all write jobs for a database, committing them in batches
+
+    SQLite allows only one writer at a time. Threads that write through their own transactions
+    wait on the database lock, with a busy timeout that only postpones failure under heavy
+    contention. Here, writers submit jobs instead, and get a :class:`~concurrent.futures.Future`
+    of the job's result. The writer thread runs all jobs that have queued up since the last
+    commit in a single ``IMMEDIATE`` transaction, up to ``max_batch`` of them, so there is one
+    commit (and fsync) per batch instead of per job.
+
+    Every job runs in its own SAVEPOINT: a job that raises an exception only rolls back its own
+    changes, and its future gets the exception. The futures of the other jobs in the batch are
+    resolved once the batch is committed, or get the exception if the commit fails.
+
+    Readers keep using their own transactions; with the ``read-heavy`` PRAGMA profile (WAL),
+    they don't block the writer and vice versa.
+
+    Args:
+        database: The :class:`~cherrymusic.database.sqlite.SqliteDatabase`
+        max_batch: The maximum number of jobs per transaction
+        timeout_secs: Seconds to wait for the database lock, e.g. held by another process
+    """
+
+    def __init__(self, database, *, max_batch=DEFAULT_MAX_BATCH,
+                 timeout_secs=DEFAULT_TIMEOUT_SECS):
+        assert max_batch > 0
+        self.database = database
+        self.max_batch = max_batch
+        self.timeout_secs = timeout_secs
+        self.batches = 0
+        self.jobs = 0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.database!r}, max_batch={self.max_batch!r})'
+
+    def submit(self, job, *args):
+        """Queue ``job(transaction, *args)`` to run on the writer thread; return its Future
+
+        The job gets the batch's :class:`~cherrymusic.database.sqlite.SqliteTransaction`. It must
+        neither commit nor close it, and must not return rows that are still to be fetched.
+        """
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f'Cannot submit jobs after close ({self})')
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name=f'{self.database.qualname}-writer', daemon=True)
+                self._thread.start()
+            self._queue.put((future, job, args))
+        return future
+
+    def execute(self, sql, params=()):
+        """Queue a statement; the Future's result is its result rows"""
+        return self.submit(_execute, sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        """Queue a statement for a sequence of params; the Future's result is the row count"""
+        return self.submit(_executemany, sql, seq_of_params)
+
+    def close(self):
+        """Run the jobs submitted so far, then stop the writer thread"""
+        with self._lock:
+            self._closed = True
+            thread = self._thread
+            if thread is not None:
+                self._queue.put(_STOP)
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is _STOP:
+                stopping = True
+                batch.pop()
+            batch = [item for item in batch if item[0].set_running_or_notify_cancel()]
+            if batch:
+                self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        done = []
+        try:
+            with self.database.transaction(isolation=ISOLATION.IMMEDIATE,
+                                           timeout_secs=self.timeout_secs) as tx:
+                for future, job, args in batch:
+                    tx.execute('SAVEPOINT job', cursor_callback=None)
+                    try:
+                        result = job(tx, *args)
+                    except Exception as error:
+                        tx.execute('ROLLBACK TO job', cursor_callback=None)
+                        future.set_exception(error)
+                    else:
+                        done.append((future, result))
+                    tx.execute('RELEASE job', cursor_callback=None)
+        except Exception as error:
+            log.error('Write batch of %d jobs failed: %s', len(batch), error)
+            for future, _, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        self.batches += 1
+        self.jobs += len(batch)
+        for future, result in done:
+            future.set_result(result)
+
+
+def _execute(transaction, sql, params):
+    return transaction.execute(sql, params)
+
+
+def _executemany(transaction, sql, seq_of_params):
+    return transaction.executemany(sql, seq_of_params)
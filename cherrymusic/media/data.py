@@ -2,9 +2,10 @@
 import os
 import pathlib
 import sys
+from collections import namedtuple
 from urllib.parse import quote_from_bytes, unquote_to_bytes
 
-from cherrymusic.common.types import CachedProperty, FrozenNamespace
+from cherrymusic.common.types import CachedSlotProperty
 
 
 def _pathcodec():
@@ -36,8 +37,47 @@ def _pathcodec():
 encode_path, decode_path = _pathcodec()
 del _pathcodec
 
+# os.path.normcase, unless it returns names unchanged (like on POSIX)
+_normcase = None if os.path.normcase('Aa') == 'Aa' else os.path.normcase
 
-class Path(FrozenNamespace):
+
+class FileStat(namedtuple('FileStat', 'size mtime_ns ino dev')):
+    """The parts of an :func:`os.stat` result that get stored for a path"""
+
+    __slots__ = ()
+
+    @classmethod
+    def from_stat_result(cls, stat):
+        return cls(stat.st_size, stat.st_mtime_ns, stat.st_ino, stat.st_dev)
+
+
+class Path:
+    """Immutable, normalized path, relative to some root directory
+
+    Paths use ``__slots__`` to keep their memory footprint small, since a scan can hold hundreds
+    of thousands of them at once. Derived attributes like :attr:`path` or :attr:`depth` get
+    computed on first access and cached in their own slot; :attr:`depth`, :attr:`is_dir`,
+    :attr:`is_symlink` and :attr:`stat` can also be passed as keyword arguments, if they are
+    already known.
+
+    Note:
+        Paths used to be :class:`~cherrymusic.common.types.FrozenNamespace` instances that
+        stored any keyword argument as an attribute. Now only the keywords listed above are
+        accepted, and others raise ``TypeError``. Paths have no ``__dict__``, so :func:`vars`
+        doesn't work on them, and they are no longer ``FrozenNamespace`` instances. The repr
+        shows only the path, as in ``Path('a/b')``.
+
+    Args:
+        name: The name of the path, or a complete path
+        parent: The parent of ``name``; if it is a :class:`Path` and ``name`` is a simple name,
+            the new path can be constructed without normalizing the parent again
+    """
+
+    __slots__ = ('name', 'parent', '_depth', '_is_dir', '_is_symlink', '_stat', '_path',
+                 '_display', '_as_url')
+
+    _presettable = ('depth', 'is_dir', 'is_symlink', 'stat')
+    _intern = staticmethod(sys.intern)  # for names and parents; None if they can't be interned
 
     def __init__(self, name, *, parent=None, **kwargs):
         is_simple_name = (
@@ -60,11 +100,44 @@ class Path(FrozenNamespace):
             normpath = os.path.normcase(os.path.normpath(path))
             parent, name = os.path.split(normpath)
         # intern strings for quick comparisons and dict lookups
-        parent = sys.intern(parent)
-        name = sys.intern(name)
-        super().__init__(name=name, parent=parent, **kwargs)
+        object.__setattr__(self, 'parent', sys.intern(parent))
+        object.__setattr__(self, 'name', sys.intern(name))
+        self._preset(**kwargs)
+
+    def _preset(self, **kwargs):
+        """Set cached attributes passed to ``__init__``; only to be used during initialization"""
+        for key, value in kwargs.items():
+            if key not in self._presettable:
+                clsname = type(self).__name__
+                raise TypeError(f'{clsname}() got an unexpected keyword argument {key!r}')
+            object.__setattr__(self, '_' + key, value)
+
+    def __setattr__(self, key, *args, **kwargs):
+        raise AttributeError(f"Can't modify {type(self).__name__}.{key}, attributes are read-only.")
 
-    @CachedProperty
+    __delattr__ = __setattr__
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.path!r})'
+
+    def __reduce__(self):
+        state = {}
+        for slot in Path.__slots__:
+            try:
+                state[slot] = object.__getattribute__(self, slot)
+            except AttributeError:
+                pass
+        return type(self)._from_state, (state,)
+
+    @classmethod
+    def _from_state(cls, state):
+        path = cls.__new__(cls)
+        for slot, value in state.items():
+            object.__setattr__(path, slot, value)
+        return path
+
+    @CachedSlotProperty
     def depth(self):
         ppath = pathlib.PurePath(self)
         if ppath.root or ppath.drive:
@@ -73,25 +146,77 @@ class Path(FrozenNamespace):
             pparts = ppath.parts
         return sum(-1 if p == '..' else 1 for p in pparts)  # '.' is never in PurePath.parts
 
-    @CachedProperty
+    @CachedSlotProperty
     def is_dir(self):
         return os.path.isdir(self)
 
-    @CachedProperty
+    @CachedSlotProperty
     def is_symlink(self):
         return os.path.islink(self)
 
+    @CachedSlotProperty
+    def stat(self):
+        """Return the :class:`FileStat` captured while scanning, or ``None``; never computed"""
+        return None
+
     def make_child(self, other, **kwargs):
         return type(self)(other, parent=self, **kwargs)
 
-    @CachedProperty
+    @classmethod
+    def children_from_scandir(cls, parent, entries, *, accept=None, stat_entry=None):
+        """Return a list of children of ``parent`` for its :func:`os.scandir` entries
+
+        This is a faster alternative to :meth:`make_child` for a whole directory listing. The
+        names of directory entries are known to be simple names, so they skip the validation
+        and normalization of arbitrary names; :attr:`depth`, :attr:`is_dir` and
+        :attr:`is_symlink` are set from the parent and the entries.
+
+        Args:
+            parent: The directory that was scanned, as a Path
+            entries: Its :class:`os.DirEntry` objects, from scanning a ``str`` path (or a
+                ``bytes`` path, for a :class:`BytesPath`)
+            accept: A filter function; children it rejects are left out of the list
+            stat_entry: A function that returns the :attr:`stat` of a child for its entry, like
+                :func:`~cherrymusic.media.files.dir_entry_stat`; it is only called for children
+                the filter accepts
+        """
+        slots = Path.__dict__
+        new = cls.__new__
+        set_name, set_parent, set_depth, set_is_dir, set_is_symlink, set_stat = (
+            slots[slot].__set__
+            for slot in ('name', 'parent', '_depth', '_is_dir', '_is_symlink', '_stat')
+        )
+        intern = cls._intern
+        parent_path = parent.parent if parent.name in ('.', b'.') else parent.path
+        depth = parent.depth + 1
+        children = []
+        for entry in entries:
+            name = entry.name
+            if _normcase is not None:
+                name = _normcase(name)
+            if intern is not None:
+                name = intern(name)
+            child = new(cls)
+            set_name(child, name)
+            set_parent(child, parent_path)
+            set_depth(child, depth)
+            set_is_dir(child, entry.is_dir())
+            set_is_symlink(child, entry.is_symlink())
+            if accept is not None and not accept(child):
+                continue
+            if stat_entry is not None:
+                set_stat(child, stat_entry(entry))
+            children.append(child)
+        return children
+
+    @CachedSlotProperty
     def path(self):  # may contain surrogates from errors='surrogateescape'
         # since self.name and self.parent are normalized, we can concat instead of os.path.join
         parent, name = self.parent, self.name
         path = (parent and parent + os.path.sep) + name
         return sys.intern(path)
 
-    @CachedProperty
+    @CachedSlotProperty
     def display(self) -> str:
         """Get a display version of the path with easy-on-the-eye placeholders for decode errors.
 
@@ -102,7 +227,7 @@ class Path(FrozenNamespace):
         bytes_path = encode_path(self.path)  # turn potential surrogate escapes into original bytes
         return decode_path(bytes_path, errors='replace')
 
-    @CachedProperty
+    @CachedSlotProperty
     def as_url(self) -> str:
         """Escape path to make it usable in a URL."""
         return quote_from_bytes(bytes(self))
@@ -138,3 +263,66 @@ class Path(FrozenNamespace):
         if equal is NotImplemented:
             return NotImplemented
         return not equal
+
+
+class BytesPath(Path):
+    """A :class:`Path` that keeps its names as raw ``bytes``, like scanning a ``bytes`` path does
+
+    Regular paths decode every name from the file system, and encode it again for
+    :func:`bytes`, :attr:`as_url` and the file index; names that aren't valid in the file system
+    encoding turn into strings with surrogate escapes. Bytes paths skip those round trips: their
+    :attr:`name`, :attr:`parent` and :attr:`path` are ``bytes``, and so is their
+    :func:`os.fspath`. :func:`bytes` and :attr:`as_url` use them as they are, and only
+    :attr:`display` decodes them, on first access.
+
+    Bytes paths compare equal to other bytes paths and ``bytes`` objects of the same path, but
+    not to regular paths or strings. Their names are not interned.
+
+    Args:
+        name: The name of the path, or a complete path, as ``bytes`` or ``str``
+        parent: The parent of ``name``
+    """
+
+    __slots__ = ()
+
+    _intern = None
+
+    def __init__(self, name, *, parent=None, **kwargs):
+        name = encode_path(name)
+        if isinstance(parent, BytesPath) and name not in (b'', b'.', b'..') and (
+                _bytes_sep not in name and not (_bytes_altsep and _bytes_altsep in name)):
+            kwargs.setdefault('depth', parent.depth + 1)
+            name = os.path.normcase(name)
+            parent = parent.parent if parent.name == b'.' else parent.path
+        else:
+            path = os.path.join(encode_path(parent or b''), name)
+            parent, name = os.path.split(os.path.normcase(os.path.normpath(path)))
+        object.__setattr__(self, 'parent', parent)
+        object.__setattr__(self, 'name', name)
+        self._preset(**kwargs)
+
+    @CachedSlotProperty
+    def depth(self):
+        return Path(self.path).depth
+
+    @CachedSlotProperty
+    def path(self):
+        parent, name = self.parent, self.name
+        return (parent and parent + _bytes_sep) + name
+
+    @CachedSlotProperty
+    def display(self) -> str:
+        """Like :attr:`Path.display`, decoded straight from the raw path"""
+        return decode_path(self.path, errors='replace')
+
+    @CachedSlotProperty
+    def as_url(self) -> str:
+        """Like :attr:`Path.as_url`, escaped straight from the raw path"""
+        return quote_from_bytes(self.path)
+
+    def __bytes__(self):
+        return self.path
+
+
+_bytes_sep = os.fsencode(os.path.sep)
+_bytes_altsep = os.path.altsep and os.fsencode(os.path.altsep)
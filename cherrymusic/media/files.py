@@ -1,30 +1,149 @@
 # -*- coding: UTF-8 -*-
 import logging
 import os
-import pathlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
 
-from .data import Path
+from .data import BytesPath, FileStat, Path
+from .filters import FilterRules
 
 log = logging.getLogger(__name__)
 
+DEFAULT_MAX_RESOLVED = 10_000
 
-def recursive_scandir(path, *, root=None, filters=(), max_depth=None):
+
+def _scan_start(path, root, tree=None):
+    """Return the absolute scan root and the relative start :class:`Path` for a scan
+
+    If a :class:`~cherrymusic.media.tree.PathTree` is given, the start is a node of that tree.
+    If the path is ``bytes``, the root is ``bytes`` and the start is a :class:`BytesPath`.
+    """
+    if isinstance(os.fspath(path), bytes):
+        if tree:
+            raise TypeError('Cannot scan a bytes path into a PathTree')
+        root = os.fsencode(root) if root else root
+        path_type = BytesPath
+    else:
+        path_type = Path
     if not root:
         root = startpath = os.path.abspath(path)
     else:
         root = os.path.abspath(root)
         startpath = os.path.join(root, path)
-    start = Path(os.path.relpath(startpath, root), is_dir=os.path.isdir(startpath))
+    relpath, is_dir = os.path.relpath(startpath, root), os.path.isdir(startpath)
+    start = tree.node(relpath, is_dir=is_dir) if tree else path_type(relpath, is_dir=is_dir)
+    if not start.is_dir and not os.path.exists(startpath):
+        raise FileNotFoundError(f'No such file or directory: {startpath!r}')
+    return root, start
+
+
+def dir_entry_stat(entry):
+    """Return the :class:`~cherrymusic.media.data.FileStat` of a :class:`os.DirEntry`
+
+    Symlinks are followed, like ``entry.is_dir()`` does. On Linux, this costs a ``stat``
+    system call; on Windows, the result comes with the directory listing for free.
+
+    Returns:
+        The FileStat, or ``None`` if the entry can't be stat'ed, e.g. because it is a broken
+        symlink
+    """
+    try:
+        return FileStat.from_stat_result(entry.stat())
+    except OSError as error:
+        log.debug('Cannot stat %r: %s', entry.path, error)
+        return None
+
+
+def list_directory(root, directory, *, accept=None, stat=False, sort=False):
+    """Return the children of a directory that a filter accepts, as a list
+
+    The directory is listed with :func:`os.scandir`, and its children are created in bulk with
+    :meth:`~cherrymusic.media.data.Path.children_from_scandir`, as the same type as
+    ``directory``.
+
+    Args:
+        root: The root directory that the path of ``directory`` is relative to
+        directory: The :class:`Path` of the directory
+        accept: A filter function, like the ones from :func:`combine_filters`
+        stat: If ``True``, capture the :attr:`~cherrymusic.media.data.Path.stat` of accepted
+            children from their directory entries
+        sort: If ``True``, sort the children by name
+
+    Raises:
+        OSError: If the directory can't be listed
+    """
+    entries = _scandir(root, directory, sort=sort)
+    return type(directory).children_from_scandir(
+        directory, entries, accept=accept, stat_entry=dir_entry_stat if stat else None)
+
+
+def _scandir(root, directory, *, sort=False):
+    """Return the :class:`os.DirEntry` objects of a directory as a list"""
+    with os.scandir(os.path.join(root, directory.path)) as dir_entries:
+        entries = list(dir_entries)
+    if sort:
+        entries.sort(key=lambda entry: os.path.normcase(entry.name))
+    return entries
+
+
+def combine_filters(filters, root=None):
+    """Return a single filter function that accepts the paths all filters accept
+
+    :class:`~cherrymusic.media.filters.FilterRules` among the filters get compiled for the
+    root directory.
+
+    Returns:
+        The filter function, or ``None`` if there are no filters
+    """
+    filters = tuple(
+        accept.compile(root) if isinstance(accept, FilterRules) else accept
+        for accept in filters
+    )
+    if len(filters) <= 1:
+        return filters[0] if filters else None
+
+    def accept_all(path):
+        for accept in filters:
+            if not accept(path):
+                return False
+        return True
+
+    return accept_all
+
+
+def recursive_scandir(path, *, root=None, filters=(), max_depth=None, tree=None, stat=False):
+    """Yield a :class:`Path` for every entry below a directory, depth-first
+
+    If ``path`` is ``bytes``, the scan lists directories by their ``bytes`` paths and yields
+    :class:`~cherrymusic.media.data.BytesPath` objects, which keep the raw names instead of
+    decoding them; filters get bytes paths, too. The filters of this module and
+    :class:`~cherrymusic.media.filters.FilterRules` work with either kind.
+
+    Args:
+        path: The directory to scan, relative to root
+        root: The root directory that yielded paths are relative to; defaults to ``path``
+        filters: Callables that accept or reject a path, or
+            :class:`~cherrymusic.media.filters.FilterRules`; rejected directories are not
+            scanned
+        max_depth: Don't scan directories nested deeper than this below ``path``
+        tree: A :class:`~cherrymusic.media.tree.PathTree` to create the paths in, to save memory
+            if a lot of them are kept around
+        stat: If ``True``, capture the :attr:`~cherrymusic.media.data.Path.stat` of paths from
+            their directory entries, so consumers like
+            :class:`~cherrymusic.media.index.FileIndex` don't need to stat them again. Only
+            paths accepted by all filters get stat'ed.
+    """
+    root, start = _scan_start(path, root, tree)
+    accept = combine_filters(filters, root)
 
     # path is not a directory -> no recursion
     if not start.is_dir:
-        if not os.path.exists(startpath):
-            raise FileNotFoundError(f'No such file or directory: {startpath!r}')
         yield start
         return
 
     # path is a directory -> recursive scanning
-    if start != '.':
+    if start.path not in ('.', b'.'):
         # start is not root
         yield start
     dirstack = [start]  # LIFO == depth-first
@@ -32,23 +151,124 @@ def recursive_scandir(path, *, root=None, filters=(), max_depth=None):
         current = dirstack.pop()
         if max_depth and current.depth - start.depth > max_depth:
             continue
-        scanpath = os.path.join(root, current.path)
         try:
-            dir_entries = os.scandir(scanpath)
-            for entry in dir_entries:
-                child = current.make_child(
-                    entry.name,
-                    is_dir=entry.is_dir(),
-                    is_symlink=entry.is_symlink(),
-                )
-                if not all(accept(child) for accept in filters):
-                    continue
-                if child.is_dir:
-                    dirstack.append(child)
-                yield child
+            children = list_directory(root, current, accept=accept, stat=stat)
         except OSError as error:  # pragma: no cover
-            log.error('Error scanning directory %r: %s', scanpath, error)
+            log.error('Error scanning directory %r: %s', os.path.join(root, current.path), error)
             continue
+        for child in children:
+            if child.is_dir:
+                dirstack.append(child)
+            yield child
+
+
+def parallel_recursive_scandir(path, *, root=None, filters=(), max_depth=None, tree=None,
+                               stat=False, max_workers=None, ordered=False):
+    """Like :func:`recursive_scandir`, but list directories concurrently on a thread pool
+
+    Directory listings are fanned out to a bounded pool of worker threads, while filters are
+    applied and results are yielded on the consumer's thread. That means stateful filters like
+    :func:`circular_symlink_filter` work unchanged. Only a limited number of listings is
+    prefetched ahead of the consumer, so memory use does not depend on the size of the tree.
+
+    Closing the generator (or abandoning it) cancels all pending directory listings.
+
+    Args:
+        path, root, filters, max_depth, tree, stat: Same as for :func:`recursive_scandir`;
+            paths get stat'ed on the consumer's thread, after filtering
+        max_workers: Maximum number of worker threads; defaults to the number of CPUs plus 4,
+            since listing directories is I/O bound
+        ordered: If ``True``, yield paths in the deterministic order :func:`recursive_scandir`
+            would produce if every directory listed its entries sorted by name. Otherwise, the
+            children of a directory are yielded as soon as its listing becomes available.
+    """
+    root, start = _scan_start(path, root, tree)
+    accept = combine_filters(filters, root)
+
+    # path is not a directory -> no recursion
+    if not start.is_dir:
+        yield start
+        return
+
+    # path is a directory -> recursive scanning
+    if start.path not in ('.', b'.'):
+        # start is not root
+        yield start
+    max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+    prefetch = 2 * max_workers  # keep all workers busy while the consumer catches up
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def accepted_children(listing):
+        directory, entries = listing.result()
+        return type(directory).children_from_scandir(
+            directory, entries, accept=accept, stat_entry=dir_entry_stat if stat else None)
+
+    def needs_scan(directory):
+        return directory.is_dir and not (max_depth and directory.depth - start.depth > max_depth)
+
+    def submit(directory):
+        return executor.submit(_list_entries, root, directory, sort=ordered)
+
+    try:
+        if ordered:
+            yield from _scan_ordered(start, submit, accepted_children, needs_scan, prefetch)
+        else:
+            yield from _scan_unordered(start, submit, accepted_children, needs_scan, prefetch)
+    finally:
+        executor.shutdown(wait=True)
+
+
+def _scan_ordered(start, submit, accepted_children, needs_scan, prefetch):
+    # The stack holds directories (not submitted yet) and futures of their listings. Only the top
+    # of the stack is prefetched, since that is where the depth-first walk continues.
+    dirstack = [start]  # LIFO == depth-first
+    try:
+        while dirstack:
+            _submit_top(dirstack, submit, prefetch)
+            for child in accepted_children(dirstack.pop()):
+                if needs_scan(child):
+                    dirstack.append(child)
+                yield child
+    finally:
+        for item in dirstack:
+            if isinstance(item, Future):
+                item.cancel()
+
+
+def _submit_top(dirstack, submit, count):
+    for index in range(len(dirstack) - 1, max(len(dirstack) - count, 0) - 1, -1):
+        if not isinstance(dirstack[index], Future):
+            dirstack[index] = submit(dirstack[index])
+
+
+def _scan_unordered(start, submit, accepted_children, needs_scan, prefetch):
+    waiting = [start]  # LIFO: prefer depth-first to keep the backlog small
+    pending = set()
+    try:
+        while waiting or pending:
+            while waiting and len(pending) < prefetch:
+                pending.add(submit(waiting.pop()))
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for listing in done:
+                for child in accepted_children(listing):
+                    if needs_scan(child):
+                        waiting.append(child)
+                    yield child
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _list_entries(root, directory, *, sort=False):
+    """Return a directory and a list of its entries, for use in worker threads
+
+    The entries get turned into paths and filtered on the consumer's thread.
+    """
+    try:
+        return directory, _scandir(root, directory, sort=sort)
+    except OSError as error:  # pragma: no cover
+        log.error('Error scanning directory %r: %s', os.path.join(root, directory.path), error)
+        return directory, []
 
 
 def canonical_path(path, *, root=None):
@@ -62,10 +282,210 @@ def canonical_path(path, *, root=None):
     return os.path.normcase(os.path.realpath(path))  # resolve symlinks and normalize
 
 
-def circular_symlink_filter(root):
+class PathResolver:
+    """Resolve paths like :func:`canonical_path`, with an LRU cache of resolved directories
+
+    :func:`os.path.realpath` checks every component of a path for symlinks, so resolving many
+    paths below the same root repeats the same ``lstat`` calls for their common ancestors. The
+    resolver works its way down one component at a time instead, and caches the real path of
+    every absolute path it resolves, ancestors included, up to ``max_entries`` paths. Resolving
+    a path whose parent is cached costs at most one ``lstat``; a cached path costs none.
+
+    Cached paths don't notice changes to the file system. Pass :meth:`on_changes` as the
+    ``on_changes`` callback of a :class:`~cherrymusic.media.watcher.Watcher`, or the changes of
+    an :class:`~cherrymusic.media.incremental.IncrementalScanner` through :meth:`scan_changes`,
+    or call :meth:`invalidate` directly. Invalidating a path forgets every cached path at or
+    below it, whether it got there through a symlink or not.
+
+    Args:
+        root: The directory that relative paths are resolved from, unless :meth:`resolve`
+            gets another one; defaults to the current working directory
+        max_entries: The maximum number of cached paths
+    """
+
+    def __init__(self, root=None, *, max_entries=DEFAULT_MAX_RESOLVED):
+        self.root = root
+        self.max_entries = max_entries
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+        self._cache = OrderedDict()  # absolute path -> real path, LRU first
+        self._lock = threading.Lock()
+        self._generation = 0  # changes with every invalidation
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.root!r}, max_entries={self.max_entries!r})'
+
+    def __len__(self):
+        return len(self._cache)
+
+    def resolve(self, path, *, root=None):
+        """Return the canonical path of a path, relative to ``root`` if it isn't absolute"""
+        path = self._absolute(path, root)
+        with self._lock:
+            generation = self._generation
+        return os.path.normcase(self._resolve(path, generation, frozenset()))
+
+    def invalidate(self, *paths, root=None):
+        """Forget the cached real paths of paths, relative to ``root``, and of all paths below"""
+        prefixes = {str: [], bytes: []}
+        for path in paths:
+            path = self._absolute(path, root)
+            with self._lock:
+                real_parent = self._cache.get(os.path.dirname(path))
+            locations = [path]
+            if real_parent is not None:  # where the path really is, e.g. behind a symlink
+                locations.append(os.path.join(real_parent, os.path.basename(path)))
+            for location in locations:
+                prefixes[str].append(os.fsdecode(location))
+                prefixes[bytes].append(os.fsencode(location))
+        exact = {kind: frozenset(locations) for kind, locations in prefixes.items()}
+        below = {
+            kind: tuple(os.path.join(location, type(location)()) for location in locations)
+            for kind, locations in prefixes.items()
+        }
+        with self._lock:
+            self._generation += 1
+            stale = [
+                path for path, real in self._cache.items()
+                if path in exact[type(path)] or path.startswith(below[type(path)]) or
+                real in exact[type(real)] or real.startswith(below[type(real)])
+            ]
+            for path in stale:
+                del self._cache[path]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        """Forget all cached paths"""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._cache)
+            self._cache.clear()
+
+    def on_changes(self, changes):
+        """Invalidate the paths affected by a Watcher's :class:`~.watcher.Changes` below root"""
+        if changes.rescanned:
+            self.clear()
+            return
+        moved = [path for pair in changes.moved for path in pair]
+        self.invalidate(*changes.added, *changes.removed, *moved)
+
+    def scan_changes(self, changes):
+        """Pass through a scan's ``(CHANGE, Path)`` pairs, and invalidate the paths they affect
+
+        The paths get invalidated together when the scan is done, which needs one pass over the
+        cache instead of one per change.
+
+        Args:
+            changes: The iterator returned by
+                :meth:`~cherrymusic.media.incremental.IncrementalScanner.scan`
+        """
+        changed = []
+        try:
+            for change, path in changes:
+                changed.append(path)
+                yield change, path
+        finally:
+            if changed:
+                self.invalidate(*changed)
+
+    def stats(self):
+        """Return the cache metrics as a dict
+
+        Hits and misses count lookups of every path the resolver looks up, including the
+        ancestors of uncached paths.
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _absolute(self, path, root):
+        """Join a relative path to the root, like :func:`canonical_path`, without normalizing"""
+        path = os.fspath(path)
+        if os.path.isabs(path):
+            return path
+        root = root or self.root
+        if root:
+            root = os.fsencode(root) if isinstance(path, bytes) else os.fsdecode(root)
+            if not os.path.isabs(root):
+                root = os.path.join(os.getcwdb() if isinstance(path, bytes) else os.getcwd(), root)
+        else:
+            root = os.getcwdb() if isinstance(path, bytes) else os.getcwd()
+        return os.path.join(root, path)
+
+    def _resolve(self, path, generation, links):
+        """Return the real path of an absolute path, resolving uncached parents first
+
+        Args:
+            path: The absolute path
+            generation: The generation at the start of resolving; results from an older
+                generation don't get cached
+            links: The symlinks that are being resolved, to detect symlink loops
+        """
+        with self._lock:
+            real = self._cache.get(path)
+            if real is not None:
+                self._cache.move_to_end(path)
+                self.hits += 1
+                return real
+            self.misses += 1
+        parent, name = os.path.split(path)
+        if parent == path:  # a root directory
+            real = path
+        elif not name or name in ('.', b'.'):
+            real = self._resolve(parent, generation, links)
+        elif name in ('..', b'..'):  # the parent of where the parent really is
+            real = os.path.dirname(self._resolve(parent, generation, links))
+        else:
+            real = os.path.join(self._resolve(parent, generation, links), name)
+            if os.path.islink(real):
+                if real in links:
+                    real = os.path.realpath(real)  # a symlink loop: leave it to realpath
+                else:
+                    try:
+                        target = os.path.join(os.path.dirname(real), os.readlink(real))
+                    except OSError:  # pragma: no cover
+                        pass  # not a symlink anymore
+                    else:
+                        real = self._resolve(target, generation, links | {real})
+        with self._lock:
+            if generation == self._generation:
+                self._cache[path] = real
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+                    self.evictions += 1
+        return real
+
+
+def circular_symlink_filter(root, *, resolver=None):
+    """Return a filter that rejects symlinks to directories that a scan has already been in
+
+    A symlink to a directory is rejected if its canonical target is the root, or is inside or
+    above the target of a symlink accepted before. Targets are identified by device and inode
+    first, so a target seen before is rejected without resolving the symlink again; that also
+    catches the same directory showing up under a different canonical path, e.g. through a bind
+    mount. The canonical targets go into a prefix trie, so checking a symlink costs time
+    proportional to the depth of its target, not to the number of symlinks accepted before.
+
+    The filter has state, so every scan needs a new one. For a scan of a ``bytes`` path, the root
+    must be ``bytes``, too.
+
+    Args:
+        root: The root directory of the scan
+        resolver: A :class:`PathResolver` to resolve symlink targets with, to share its cache
+            with other users; by default, every filter has its own
+    """
     root = os.fspath(root)
-    canonical_root = os.path.join(canonical_path(root), '')  # end in path sep
-    known_roots = {canonical_root}
+    resolve = (resolver or PathResolver()).resolve
+    known_roots = _PathTrie()
+    known_roots.add_unrelated(resolve(root))
+    known_ids = {_directory_id(root)} - {None}
 
     def is_noncircular_symlink(path):
         try:
@@ -76,18 +496,77 @@ def circular_symlink_filter(root):
             is_link = os.path.islink(os.path.join(root, path))
             is_dir = os.path.isdir(os.path.join(root, path))
         if is_link and is_dir:
-            testpath = os.path.join(canonical_path(path, root=root), '')  # end in path sep
-            if any(r.startswith(testpath) or testpath.startswith(r) for r in known_roots):
+            directory_id = _directory_id(os.path.join(root, path), getattr(path, 'stat', None))
+            if directory_id in known_ids:
+                log.info('Skipping circular symlink %r, target already seen', str(path))
+                return False
+            if directory_id is not None:
+                known_ids.add(directory_id)  # rejected targets stay rejected, as roots only grow
+            testpath = resolve(path, root=root)
+            if not known_roots.add_unrelated(testpath):
                 log.info('Skipping circular symlink %r -> %r', str(path), testpath)
                 return False
-            known_roots.add(testpath)
         return True
 
     return is_noncircular_symlink
 
 
+def _directory_id(path, stat=None):
+    """Return ``(st_dev, st_ino)`` of a directory, following symlinks, or ``None`` on error"""
+    if stat is None:
+        try:
+            stat = FileStat.from_stat_result(os.stat(path))
+        except OSError:
+            return None
+    return stat.dev, stat.ino
+
+
+class _PathTrie:
+    """A set of directories that tells if a path is equal to, inside or above any of them"""
+
+    __slots__ = ('_root',)
+
+    _MEMBER = None  # key that marks a node as a member; path components are never None
+
+    def __init__(self):
+        self._root = {}
+
+    def add_unrelated(self, path):
+        """Add a path unless it is equal to, inside or above a member; return if it was added"""
+        sep = os.path.sep if isinstance(path, str) else os.fsencode(os.path.sep)
+        parts = [part for part in path.split(sep) if part]
+        node = self._root
+        for index, part in enumerate(parts):
+            if self._MEMBER in node:
+                return False  # inside a member
+            child = node.get(part)
+            if child is None:
+                for part in parts[index:]:
+                    node[part] = node = {}
+                break
+            node = child
+        else:
+            if node:
+                return False  # equal to or above a member
+        node[self._MEMBER] = True
+        return True
+
+
 def hidden_file_filter():
-    return lambda path: (
-        path.name[0:1] != '.' and
-        all(part[0] != '.' for part in pathlib.PurePath(path.parent).parts)
-    )
+    """Return a filter that rejects paths with a hidden name or below a hidden directory
+
+    Scans never descend into rejected directories, so
+    :class:`FilterRules(hidden=True) <cherrymusic.media.filters.FilterRules>` is cheaper for
+    them, since it only checks the name.
+    """
+    markers = {str: ('.', os.path.sep + '.'), bytes: (b'.', os.fsencode(os.path.sep + '.'))}
+
+    def is_visible(path):
+        name = path.name
+        dot, hidden_part = markers[type(name)]
+        if name[0:1] == dot:
+            return False
+        parent = path.parent
+        return parent[0:1] != dot and hidden_part not in parent
+
+    return is_visible
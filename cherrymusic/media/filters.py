@@ -0,0 +1,134 @@
+# -*- coding: UTF-8 -*-
+import fnmatch
+import logging
+import os
+import re
+
+from .data import FileStat
+
+log = logging.getLogger(__name__)
+
+
+class FilterRules:
+    """Declarative rules for the paths of a scan, compiled into a single filter function
+
+    Rules combine with ``&``, which gives rules that accept only what both operands accept.
+    Since a scan never descends into rejected directories, the compiled filter only checks a
+    path's own name, instead of all the components of its parent path.
+
+    Args:
+        hidden: Reject hidden paths, i.e. names starting with a dot
+        extensions: If given, only accept files with one of these extensions, like ``'.mp3'``;
+            case insensitive. Directories are not affected.
+        exclude: Glob patterns for paths to reject; patterns containing a path separator are
+            matched against the whole relative path, others against the name only. Like with
+            :mod:`fnmatch`, ``*`` also matches path separators.
+        min_size, max_size: If given, only accept files with a size in this range (inclusive);
+            directories are not affected. Files get stat'ed if their
+            :attr:`~cherrymusic.media.data.Path.stat` is unknown.
+    """
+
+    def __init__(self, *, hidden=False, extensions=None, exclude=(), min_size=None,
+                 max_size=None):
+        self.hidden = hidden
+        self.extensions = (
+            frozenset(extension.lower() for extension in extensions)
+            if extensions is not None else None
+        )
+        self.exclude = tuple(exclude)
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        rules = ', '.join(f'{key}={value!r}' for key, value in vars(self).items()
+                          if value not in (False, None, ()))
+        return f'{clsname}({rules})'
+
+    def __and__(self, other):
+        if not isinstance(other, FilterRules):
+            return NotImplemented
+        if self.extensions is None or other.extensions is None:
+            extensions = self.extensions if other.extensions is None else other.extensions
+        else:
+            extensions = self.extensions & other.extensions
+        return type(self)(
+            hidden=self.hidden or other.hidden,
+            extensions=extensions,
+            exclude=self.exclude + tuple(p for p in other.exclude if p not in self.exclude),
+            min_size=_limit(max, self.min_size, other.min_size),
+            max_size=_limit(min, self.max_size, other.max_size),
+        )
+
+    @property
+    def needs_stat(self):
+        return self.min_size is not None or self.max_size is not None
+
+    def compile(self, root=None):
+        """Return a filter function for the scan of a root directory
+
+        Args:
+            root: The root directory the paths are relative to; only needed for size rules. If
+                it is ``bytes``, the filter is for :class:`~cherrymusic.media.data.BytesPath`
+                objects from a bytes-native scan.
+        """
+        assert root or not self.needs_stat, 'size rules need the root directory'
+        as_bytes = isinstance(root, bytes)
+        dot = b'.' if as_bytes else '.'
+        hidden = self.hidden
+        extensions = self.extensions
+        if as_bytes and extensions is not None:
+            extensions = frozenset(map(os.fsencode, extensions))
+        match_name, match_path = _glob_matchers(self.exclude, as_bytes=as_bytes)
+        min_size = self.min_size if self.min_size is not None else 0
+        max_size = self.max_size if self.max_size is not None else float('inf')
+        needs_stat = self.needs_stat
+        root = os.fspath(root) if root else None
+        splitext = os.path.splitext
+
+        def accept(path):
+            name = path.name
+            if hidden and name[:1] == dot:
+                return False
+            if match_name and match_name(name):
+                return False
+            if match_path and match_path(path.path):
+                return False
+            if path.is_dir:
+                return True
+            if extensions is not None and splitext(name)[1].lower() not in extensions:
+                return False
+            if needs_stat:
+                stat = path.stat
+                if stat is None:
+                    try:
+                        stat = FileStat.from_stat_result(os.stat(os.path.join(root, path.path)))
+                    except OSError as error:
+                        log.debug('Cannot stat %r: %s', path.path, error)
+                        return False
+                if not min_size <= stat.size <= max_size:
+                    return False
+            return True
+
+        accept.rules = self
+        return accept
+
+
+def _limit(choose, first, second):
+    if first is None or second is None:
+        return first if second is None else second
+    return choose(first, second)
+
+
+def _glob_matchers(patterns, *, as_bytes=False):
+    """Return ``match`` functions for name and path patterns, or ``None`` if there are none"""
+    name_patterns = [p for p in patterns if os.path.sep not in p]
+    path_patterns = [os.path.normpath(p) for p in patterns if os.path.sep in p]
+    matchers = []
+    for group in (name_patterns, path_patterns):
+        if not group:
+            matchers.append(None)
+            continue
+        regex = '|'.join(fnmatch.translate(os.path.normcase(p)) for p in group)
+        matchers.append(re.compile(os.fsencode(regex) if as_bytes else regex).match)
+    return tuple(matchers)
@@ -0,0 +1,226 @@
+# -*- coding: UTF-8 -*-
+import logging
+import os
+from enum import Enum
+
+from cherrymusic.database.sqlite import ISOLATION
+
+from .data import Path, decode_path, encode_path
+from .files import combine_filters, list_directory
+
+log = logging.getLogger(__name__)
+
+UPDATE_BATCH_SIZE = 1000
+
+
+class CHANGE(Enum):
+    ADDED = 'added'
+    REMOVED = 'removed'
+    MODIFIED = 'modified'
+
+
+class IncrementalScanner:
+    """Scan a directory tree for changes since the previous scan
+
+    The scanner keeps a snapshot of every directory's ``(st_mtime_ns, st_ino)`` and its accepted
+    entries in a :class:`~cherrymusic.database.sqlite.SqliteDatabase`. A directory whose mtime
+    and inode are unchanged has the same entries as before, so it is not listed again; only its
+    subdirectories are checked. An unchanged tree therefore costs one ``stat`` per directory
+    instead of a full walk.
+
+    Note:
+        Modifying a file's contents does not change the mtime of its directory, so changes are
+        detected on the level of directory entries: files and directories that have been added
+        or removed, and directories whose entries have changed (reported as modified).
+
+    Args:
+        database: The database to keep the snapshot in
+        root: The directory to scan; paths in the snapshot are relative to it
+        filters: Same as for :func:`~cherrymusic.media.files.recursive_scandir`; rejected entries
+            are not part of the snapshot. Use the same filters for every scan of a snapshot.
+    """
+
+    def __init__(self, database, root, *, filters=()):
+        self.database = database
+        self.root = os.path.abspath(root)
+        self.filters = tuple(filters)
+        self._accept = combine_filters(self.filters, self.root)
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.database!r}, {self.root!r})'
+
+    def create_tables(self, transaction):
+        transaction.execute(
+            'CREATE TABLE IF NOT EXISTS directories('
+            'path BLOB PRIMARY KEY, mtime_ns INTEGER, ino INTEGER'
+            ') WITHOUT ROWID'
+        )
+        transaction.execute(
+            'CREATE TABLE IF NOT EXISTS entries('
+            'parent BLOB, name BLOB, is_dir INTEGER, PRIMARY KEY(parent, name)'
+            ') WITHOUT ROWID'
+        )
+        _PendingUpdates.create_tables(transaction)
+
+    def reset(self):
+        """Forget the snapshot, so the next scan reports the entire tree as added"""
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            tx.execute('DELETE FROM entries')
+            tx.execute('DELETE FROM directories')
+
+    def scan(self):
+        """Compare the tree to the snapshot, and collect the updates of the snapshot on the way
+
+        The snapshot is read one directory at a time, and no transaction is open while changes
+        are yielded, so the caller may write to the database in between. Updates are staged in
+        tables of their own, ``UPDATE_BATCH_SIZE`` at a time, and get merged into the snapshot
+        in a single transaction after the last change has been yielded; if the generator is not
+        exhausted, the snapshot stays unchanged.
+
+        Yields:
+            ``(CHANGE, Path)`` tuples
+        """
+        updates = _PendingUpdates()
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            updates.clear(tx)  # left over from an interrupted scan
+        dirstack = [Path('.', is_dir=True)]
+        while dirstack:
+            directory = dirstack.pop()
+            with self.database.transaction() as tx:
+                changes, subdirs = self._scan_directory(tx, directory, updates)
+            if len(updates) >= UPDATE_BATCH_SIZE:
+                with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+                    updates.stage(tx)
+            yield from changes
+            dirstack.extend(subdirs)
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            updates.stage(tx)
+            updates.apply(tx)
+
+    def _scan_directory(self, tx, directory, updates):
+        """Return the changes of a directory's entries and the subdirectories to scan next
+
+        Updates of the snapshot are added to the :class:`_PendingUpdates`. None of them touches
+        rows that a later directory of the same scan reads.
+        """
+        key = encode_path(directory)
+        scanpath = os.path.join(self.root, directory.path)
+        try:
+            stat = os.stat(scanpath)
+        except OSError as error:  # pragma: no cover
+            # gone since its parent was listed: will be picked up as removed in the next scan
+            log.error('Error scanning directory %r: %s', scanpath, error)
+            return [], ()
+        known = tx.execute('SELECT mtime_ns, ino FROM directories WHERE path = ?', (key,))
+        old_entries = {
+            name: bool(is_dir)
+            for name, is_dir in tx.execute(
+                'SELECT name, is_dir FROM entries WHERE parent = ?', (key,))
+        }
+        if known and known[0] == (stat.st_mtime_ns, stat.st_ino):
+            # unchanged directory: same entries as before, so only subdirectories need a look
+            return [], [directory.make_child(decode_path(name), is_dir=True)
+                        for name, is_dir in old_entries.items() if is_dir]
+
+        changes = []
+        try:
+            children = list_directory(self.root, directory, accept=self._accept)
+        except OSError as error:  # pragma: no cover
+            log.error('Error scanning directory %r: %s', scanpath, error)
+            children = []
+        new_entries = {encode_path(child.name): child for child in children}
+        for name, was_dir in old_entries.items():
+            child = new_entries.get(name)
+            if child is None or child.is_dir != was_dir:
+                removed = directory.make_child(decode_path(name), is_dir=was_dir)
+                self._remove(tx, key, removed, changes, updates)
+        for name, child in new_entries.items():
+            if name not in old_entries or old_entries[name] != child.is_dir:
+                updates.entries.append((key, name, child.is_dir))
+                changes.append((CHANGE.ADDED, child))
+        if known and directory != '.':
+            changes.append((CHANGE.MODIFIED, directory))
+        updates.directories.append((key, stat.st_mtime_ns, stat.st_ino))
+        return changes, [child for child in children if child.is_dir]
+
+    def _remove(self, tx, parent_key, path, changes, updates):
+        """Collect the removal of a path and, for directories, its entire subtree"""
+        updates.entries.append((parent_key, encode_path(path.name), None))
+        changes.append((CHANGE.REMOVED, path))
+        if not path.is_dir:
+            return
+        dirstack = [path]
+        while dirstack:
+            directory = dirstack.pop()
+            key = encode_path(directory)
+            for name, is_dir in tx.execute('SELECT name, is_dir FROM entries WHERE parent = ?',
+                                           (key,)):
+                child = directory.make_child(decode_path(name), is_dir=bool(is_dir))
+                if child.is_dir:
+                    dirstack.append(child)
+                changes.append((CHANGE.REMOVED, child))
+            updates.removals.append((key,))
+
+
+class _PendingUpdates:
+    """Updates of a snapshot, buffered in memory and staged in tables until they get applied
+
+    The staged rows say what the snapshot's rows should be after the scan, so the last update of
+    a row wins: an entry with ``is_dir`` NULL is removed, and a removal deletes a directory's row
+    and its entries.
+    """
+
+    def __init__(self):
+        self.entries = []  # (parent, name, is_dir or None)
+        self.removals = []  # (directory,)
+        self.directories = []  # (path, mtime_ns, ino)
+
+    def __len__(self):
+        return len(self.entries) + len(self.removals) + len(self.directories)
+
+    @staticmethod
+    def create_tables(tx):
+        tx.execute(
+            'CREATE TABLE IF NOT EXISTS pending_entries('
+            'parent BLOB, name BLOB, is_dir INTEGER, PRIMARY KEY(parent, name)'
+            ') WITHOUT ROWID'
+        )
+        tx.execute(
+            'CREATE TABLE IF NOT EXISTS pending_removals(path BLOB PRIMARY KEY) WITHOUT ROWID'
+        )
+        tx.execute(
+            'CREATE TABLE IF NOT EXISTS pending_directories('
+            'path BLOB PRIMARY KEY, mtime_ns INTEGER, ino INTEGER'
+            ') WITHOUT ROWID'
+        )
+
+    def clear(self, tx):
+        for table in ('pending_entries', 'pending_removals', 'pending_directories'):
+            tx.execute(f'DELETE FROM {table}')
+
+    def stage(self, tx):
+        """Move the buffered updates into the staging tables"""
+        tx.executemany('INSERT OR REPLACE INTO pending_entries VALUES (?, ?, ?)', self.entries)
+        tx.executemany('INSERT OR REPLACE INTO pending_removals VALUES (?)', self.removals)
+        tx.executemany('INSERT OR REPLACE INTO pending_directories VALUES (?, ?, ?)',
+                       self.directories)
+        self.entries, self.removals, self.directories = [], [], []
+
+    def apply(self, tx):
+        """Merge the staged updates into the snapshot, and clear the staging tables"""
+        tx.execute('DELETE FROM entries WHERE parent IN (SELECT path FROM pending_removals)')
+        tx.execute('DELETE FROM directories WHERE path IN (SELECT path FROM pending_removals)')
+        tx.execute(
+            'DELETE FROM entries WHERE EXISTS ('
+            '  SELECT 1 FROM pending_entries AS pending'
+            '  WHERE pending.parent = entries.parent AND pending.name = entries.name'
+            '  AND pending.is_dir IS NULL'
+            ')'
+        )
+        tx.execute('INSERT OR REPLACE INTO entries '
+                   'SELECT parent, name, is_dir FROM pending_entries WHERE is_dir IS NOT NULL')
+        tx.execute('INSERT OR REPLACE INTO directories SELECT * FROM pending_directories')
+        self.clear(tx)
@@ -0,0 +1,178 @@
+# -*- coding: UTF-8 -*-
+import logging
+import os
+from itertools import islice
+from operator import attrgetter
+
+from cherrymusic.database.sqlite import ISOLATION
+
+from .data import encode_path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+class FileIndex:
+    """Persistent index of the paths in a media collection
+
+    Paths are stored relative to the collection root, as bytes, so undecodable file names
+    survive the round trip. Each row holds a path's parent and name, its depth, whether it is a
+    directory, and its size, mtime and inode.
+
+    Args:
+        database: The :class:`~cherrymusic.database.sqlite.SqliteDatabase` to keep the index in
+        root: The root directory of the collection
+    """
+
+    def __init__(self, database, root):
+        self.database = database
+        self.root = os.path.abspath(root)
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.database!r}, {self.root!r})'
+
+    def create_tables(self, transaction):
+        transaction.execute(
+            'CREATE TABLE IF NOT EXISTS files('
+            'parent BLOB NOT NULL, name BLOB NOT NULL, depth INTEGER NOT NULL, '
+            'is_dir INTEGER NOT NULL, size INTEGER, mtime_ns INTEGER, ino INTEGER, '
+            'PRIMARY KEY(parent, name))'
+        )
+
+    def update(self, paths, *, batch_size=DEFAULT_BATCH_SIZE, replace=False):
+        """Insert or update index entries for paths, e.g. straight from a scan
+
+        Paths that carry a :attr:`~cherrymusic.media.data.Path.stat` from the scan (see the
+        ``stat`` argument of :func:`~cherrymusic.media.files.recursive_scandir`) are not stat'ed
+        again.
+
+        All rows are written in a single IMMEDIATE transaction, in chunks of ``batch_size`` rows
+        at a time. Since ``paths`` is consumed lazily, a generator like
+        :func:`~cherrymusic.media.files.recursive_scandir` can be passed directly, and no more
+        than one chunk is held in memory at any time.
+
+        Args:
+            paths: An iterable of :class:`~cherrymusic.media.data.Path` objects, relative to root
+            batch_size: The number of rows to pass to a single ``executemany`` call
+            replace: If ``True``, remove all existing entries first
+
+        Returns:
+            The number of rows written
+        """
+        assert batch_size > 0
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            if replace:
+                tx.execute('DELETE FROM files')
+            return self._insert(tx, paths, batch_size)
+
+    def remove(self, paths):
+        """Remove index entries for paths and everything below them; return the row count"""
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            return sum(self._delete(tx, path) for path in paths)
+
+    def apply_changes(self, *, added=(), removed=(), moved=(), batch_size=DEFAULT_BATCH_SIZE):
+        """Apply a batch of changes to the index in a single transaction
+
+        Removals are applied first, then moves in the given order, then additions, so a path
+        may appear in several of the arguments, e.g. if it was removed and then created again.
+
+        Args:
+            added: Paths to insert or update, like for :meth:`update`
+            removed: Paths to remove along with everything below them, like for :meth:`remove`
+            moved: ``(old_path, new_path)`` pairs of renamed paths; entries below a renamed
+                directory are moved along with it, and existing entries at the new path are
+                replaced
+            batch_size: Same as for :meth:`update`
+        """
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            for path in removed:
+                self._delete(tx, path)
+            for old_path, new_path in moved:
+                self._move(tx, old_path, new_path)
+            self._insert(tx, added, batch_size)
+
+    def __len__(self):
+        with self.database.transaction() as tx:
+            self.create_tables(tx)
+            return tx.execute('SELECT COUNT(*) FROM files')[0][0]
+
+    def _insert(self, tx, paths, batch_size):
+        """Insert or replace rows for paths, ``batch_size`` rows at a time; return the count"""
+        rows = map(self._row, paths)
+        count = 0
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                return count
+            count += tx.executemany(
+                'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)',
+                batch,
+            )
+
+    @staticmethod
+    def _subtree(path):
+        """Return a WHERE clause and its params matching the rows of all descendants of path"""
+        # descendants have the path itself or a subpath of it as their parent;
+        # for the latter, compare to [path + sep, path + chr(ord(sep) + 1)) to use the index
+        prefix = encode_path(path.path)
+        separator = os.sep.encode()
+        return (
+            'parent = ? OR (parent >= ? AND parent < ?)',
+            (prefix, prefix + separator, prefix + bytes([separator[0] + 1])),
+        )
+
+    def _delete(self, tx, path):
+        """Delete the rows of a path and its descendants; return the count"""
+        rowcount = attrgetter('rowcount')
+        parent, name = encode_path(path.parent), encode_path(path.name)
+        count = tx.execute('DELETE FROM files WHERE parent = ? AND name = ?',
+                           (parent, name), cursor_callback=rowcount)
+        where, params = self._subtree(path)
+        return count + tx.execute(f'DELETE FROM files WHERE {where}', params,
+                                  cursor_callback=rowcount)
+
+    def _move(self, tx, old_path, new_path):
+        """Rename the rows of a path and its descendants, replacing rows at the new path"""
+        self._delete(tx, new_path)
+        depth_change = new_path.depth - old_path.depth
+        tx.execute(
+            'UPDATE files SET parent = ?, name = ?, depth = depth + ? '
+            'WHERE parent = ? AND name = ?',
+            (encode_path(new_path.parent), encode_path(new_path.name), depth_change,
+             encode_path(old_path.parent), encode_path(old_path.name)),
+        )
+        # replace the old prefix of descendants' parents; || works on text, so cast back to blob
+        where, params = self._subtree(old_path)
+        tx.execute(
+            'UPDATE files SET parent = CAST(? || substr(parent, ?) AS BLOB), depth = depth + ? '
+            f'WHERE {where}',
+            (encode_path(new_path.path), len(encode_path(old_path.path)) + 1, depth_change)
+            + params,
+        )
+
+    def _row(self, path):
+        stat = getattr(path, 'stat', None)  # captured while scanning, if the scan did that
+        if stat is not None:
+            size, mtime_ns, ino = stat.size, stat.mtime_ns, stat.ino
+        else:
+            try:
+                stat = os.stat(os.path.join(self.root, os.fsdecode(path.path)))
+            except OSError as error:
+                log.warning('Cannot stat %r: %s', path.path, error)
+                size = mtime_ns = ino = None
+            else:
+                size, mtime_ns, ino = stat.st_size, stat.st_mtime_ns, stat.st_ino
+        return (
+            encode_path(path.parent),
+            encode_path(path.name),
+            path.depth,
+            bool(path.is_dir),
+            size,
+            mtime_ns,
+            ino,
+        )
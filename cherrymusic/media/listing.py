@@ -0,0 +1,207 @@
+# -*- coding: UTF-8 -*-
+"""List directories for browsing, from a cache that is invalidated by file system changes"""
+import errno
+import logging
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from .data import Path
+from .files import combine_filters, hidden_file_filter, list_directory
+from .incremental import CHANGE
+from .opener import PathEscapeError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_MAX_BYTES = 64 * 1024 ** 2
+DEFAULT_TTL_SECS = 300
+
+
+class DirectoryLister:
+    """Return the sorted, filtered children of directories below a root, with an LRU cache
+
+    Listings are cached by directory, up to ``max_entries`` directories and ``max_bytes`` of
+    estimated memory, evicting the least recently used. Cached listings expire after
+    ``ttl_secs``, as a safeguard for changes that aren't reported.
+
+    Changes are reported by passing :meth:`on_changes` as the ``on_changes`` callback of a
+    :class:`~cherrymusic.media.watcher.Watcher`, or by passing the changes of an
+    :class:`~cherrymusic.media.incremental.IncrementalScanner` through :meth:`scan_changes`.
+    They invalidate the listings of the directories that contain changed paths, and of removed
+    or moved directories and everything below them; other listings stay cached.
+
+    Args:
+        root: The root directory that paths are relative to
+        filters: Filters for paths, like for :func:`~cherrymusic.media.files.recursive_scandir`;
+            defaults to :func:`~cherrymusic.media.files.hidden_file_filter`
+        stat: If ``True``, capture the :attr:`~cherrymusic.media.data.Path.stat` of children
+        max_entries: The maximum number of cached listings
+        max_bytes: The maximum estimated memory use of all cached listings
+        ttl_secs: Seconds after which a cached listing is read again
+    """
+
+    def __init__(self, root, *, filters=None, stat=False, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_bytes=DEFAULT_MAX_BYTES, ttl_secs=DEFAULT_TTL_SECS):
+        self.root = os.path.abspath(root)
+        self.filters = tuple(filters) if filters is not None else (hidden_file_filter(),)
+        self.stat = stat
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_secs = ttl_secs
+        self.size = 0
+        self.hits = self.misses = self.expirations = self.evictions = self.invalidations = 0
+        self._accept = combine_filters(self.filters, self.root)
+        self._cache = OrderedDict()  # directory path -> (children, size, expires), LRU first
+        self._lock = threading.Lock()
+        self._generation = 0  # changes with every invalidation
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.root!r}, max_entries={self.max_entries!r})'
+
+    def __len__(self):
+        return len(self._cache)
+
+    def list(self, directory):
+        """Return the accepted children of a directory as a tuple of paths, sorted by name
+
+        Args:
+            directory: A :class:`~cherrymusic.media.data.Path` or path string relative to root
+
+        Raises:
+            PathEscapeError: If the path is absolute or leads above the root with ``..``
+            OSError: If the directory can't be listed, e.g. ``FileNotFoundError`` or
+                ``NotADirectoryError``
+        """
+        if not isinstance(directory, Path):
+            directory = Path(directory)
+        key = directory.path
+        if (os.path.isabs(key) or directory.depth < 0 or
+                key.split(os.path.sep, 1)[0] == os.path.pardir or '\0' in key):
+            raise PathEscapeError(errno.EACCES, 'Path must stay below the root', key)
+        now = time.monotonic()
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                if cached[2] > now:
+                    self._cache.move_to_end(key)
+                    self.hits += 1
+                    return cached[0]
+                self._drop(key)
+                self.expirations += 1
+            self.misses += 1
+            generation = self._generation
+        children = self._read(directory)
+        with self._lock:
+            # a change reported while reading may or may not be in the listing: don't cache it
+            if generation == self._generation:
+                if key in self._cache:
+                    self._drop(key)
+                size = _estimate_size(children)
+                self._cache[key] = (children, size, now + self.ttl_secs)
+                self.size += size
+                self._evict()
+        return children
+
+    def invalidate(self, directory, *, below=False):
+        """Forget the cached listing of a directory, and if ``below``, of all directories below"""
+        key = directory.path if isinstance(directory, Path) else Path(directory).path
+        with self._lock:
+            self._generation += 1
+            if key in self._cache:
+                self._drop(key)
+                self.invalidations += 1
+            if below:
+                prefix = '' if key == '.' else key + os.path.sep
+                for other in [other for other in self._cache if other.startswith(prefix)]:
+                    self._drop(other)
+                    self.invalidations += 1
+
+    def clear(self):
+        """Forget all cached listings"""
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._cache)
+            self._cache.clear()
+            self.size = 0
+
+    def on_changes(self, changes):
+        """Invalidate the listings affected by a Watcher's :class:`~.watcher.Changes`"""
+        if changes.rescanned:
+            self.clear()
+            return
+        for path in changes.added:
+            self.invalidate(_parent(path))
+        for path in changes.removed:
+            self.invalidate(_parent(path))
+            if path.is_dir:
+                self.invalidate(path, below=True)
+        for old, new in changes.moved:
+            self.invalidate(_parent(old))
+            self.invalidate(_parent(new))
+            if old.is_dir:
+                self.invalidate(old, below=True)
+                self.invalidate(new, below=True)
+
+    def scan_changes(self, changes):
+        """Pass through a scan's ``(CHANGE, Path)`` pairs, invalidating the listings they affect
+
+        Args:
+            changes: The iterator returned by
+                :meth:`~cherrymusic.media.incremental.IncrementalScanner.scan`
+        """
+        for change, path in changes:
+            if change is CHANGE.MODIFIED:
+                self.invalidate(path)
+            else:
+                self.invalidate(_parent(path))
+                if change is CHANGE.REMOVED and path.is_dir:
+                    self.invalidate(path, below=True)
+            yield change, path
+
+    def stats(self):
+        """Return the cache metrics as a dict"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._cache),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'expirations': self.expirations,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _read(self, directory):
+        return tuple(list_directory(self.root, directory, accept=self._accept, stat=self.stat,
+                                    sort=True))
+
+    def _drop(self, key):
+        """Remove a cached listing; lock must be held"""
+        self.size -= self._cache.pop(key)[1]
+
+    def _evict(self):
+        """Remove least recently used listings beyond the limits; lock must be held"""
+        while self._cache and (len(self._cache) > self.max_entries or self.size > self.max_bytes):
+            _, (_, size, _) = self._cache.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+
+
+def _parent(path):
+    return Path(path.parent or '.', is_dir=True)
+
+
+def _estimate_size(children):
+    """Estimate the memory used by a listing, not counting interned strings shared with others"""
+    size = sys.getsizeof(children)
+    for child in children:
+        size += sys.getsizeof(child) + sys.getsizeof(child.name)
+        if child.stat is not None:
+            size += sys.getsizeof(child.stat)
+    return size
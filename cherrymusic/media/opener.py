@@ -0,0 +1,273 @@
+# -*- coding: UTF-8 -*-
+"""Open files below a root without following symlinks out of a set of allowed roots"""
+import errno
+import logging
+import os
+import threading
+from collections import OrderedDict
+
+from .files import PathResolver
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_DIRECTORIES = 256
+MAX_SYMLINKS = 40  # like the kernel's limit for a single lookup
+
+_DIRECTORY_FLAGS = (getattr(os, 'O_PATH', os.O_RDONLY) | os.O_DIRECTORY |
+                    getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_CLOEXEC', 0))
+_FILE_FLAGS = getattr(os, 'O_NOFOLLOW', 0) | getattr(os, 'O_CLOEXEC', 0)
+_HAS_DIR_FD = os.open in os.supports_dir_fd and hasattr(os, 'O_NOFOLLOW')
+
+
+class PathEscapeError(PermissionError):
+    """A path leads outside of the allowed roots, e.g. with ``..`` or through a symlink"""
+
+
+class SecureOpener:
+    """Open files by their path below a root, and make sure they are inside the allowed roots
+
+    Instead of resolving a path with :func:`os.path.realpath` and opening it afterwards, the
+    opener walks the path one component at a time with :func:`os.open` relative to the
+    descriptor of the directory before (like ``openat``), with ``O_NOFOLLOW``, and ``O_PATH``
+    for directories where available. Symlinks are followed by the opener itself, as long as
+    they stay inside the root or lead into one of the allowed roots; absolute symlinks must
+    point into an allowed root by its absolute or canonical path. Nothing outside the allowed
+    roots is opened, and resolving and opening take a single pass, so a symlink changed in
+    between can't redirect the result.
+
+    The descriptors of up to ``max_directories`` parent directories are cached, so opening a
+    file next to one opened before needs a ``stat`` of the directory, to check that its path
+    still leads to the same directory, and a single ``open`` relative to it.
+
+    Descriptors are opened on first use and closed by :meth:`close`. The opener can be used
+    from several threads; opens are serialized. Where :func:`os.open` doesn't support
+    ``dir_fd``, paths are resolved with a :class:`~cherrymusic.media.files.PathResolver` and
+    checked before they are opened instead.
+
+    Args:
+        root: The directory that paths are relative to; it is always allowed
+        allowed_roots: More directories that symlinks below the root may lead into
+        max_directories: The maximum number of cached directory descriptors
+    """
+
+    def __init__(self, root, *, allowed_roots=(), max_directories=DEFAULT_MAX_DIRECTORIES):
+        self.root = os.path.abspath(root)
+        self.allowed_roots = tuple(os.path.abspath(allowed) for allowed in allowed_roots)
+        self.max_directories = max_directories
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.Lock()
+        self._roots = None  # absolute path components -> descriptor, once opened
+        self._root_fds = {}  # descriptor -> canonical path components of its root
+        self._root_fd = None
+        self._cache = OrderedDict()  # relative directory -> (descriptor, (dev, ino)), LRU first
+        self._resolver = None if _HAS_DIR_FD else PathResolver(self.root)
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.root!r}, allowed_roots={self.allowed_roots!r})'
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open(self, path, flags=os.O_RDONLY):
+        """Open a path below the root and return the file descriptor
+
+        Args:
+            path: The path relative to the root, as a string or
+                :class:`~cherrymusic.media.data.Path`
+            flags: Flags for :func:`os.open`; ``O_NOFOLLOW`` and ``O_CLOEXEC`` are added
+
+        Raises:
+            PathEscapeError: If the path leads outside of the allowed roots
+            OSError: If the path can't be opened, e.g. ``FileNotFoundError``
+        """
+        path = os.fsdecode(path)
+        if os.path.isabs(path):
+            raise PathEscapeError(errno.EACCES, 'Path must be relative to the root', path)
+        if not _HAS_DIR_FD:  # pragma: no cover
+            return self._open_resolved(path, flags)
+        parent, name = os.path.split(os.path.normpath(path))
+        with self._lock:
+            if self._roots is None:
+                self._open_roots()
+            if name in ('', '.', '..') or os.path.pardir in parent.split(os.path.sep):
+                return self._walk(path.split(os.path.sep), flags)[0]
+            dir_fd = self._cached_directory(parent)
+            if dir_fd is not None:
+                try:
+                    return os.open(name, flags | _FILE_FLAGS, dir_fd=dir_fd)
+                except OSError as error:
+                    if not _is_symlink_error(error):
+                        raise
+            fd, walked_dir_fd = self._walk(path.split(os.path.sep), flags)
+            if walked_dir_fd is not None:
+                if dir_fd is None and parent:
+                    try:
+                        self._cache_directory(parent, walked_dir_fd)
+                    except BaseException:
+                        os.close(walked_dir_fd)
+                        os.close(fd)
+                        raise
+                else:  # the cached directory is fine, the file is a symlink
+                    os.close(walked_dir_fd)
+            return fd
+
+    def close(self):
+        """Close all descriptors; they get opened again if the opener is used afterwards"""
+        with self._lock:
+            for fd, _ in self._cache.values():
+                os.close(fd)
+            self._cache.clear()
+            for fd in self._root_fds:
+                os.close(fd)
+            self._root_fds.clear()
+            self._roots = self._root_fd = None
+
+    def stats(self):
+        """Return the metrics of the directory cache as a dict"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+            }
+
+    def _open_roots(self):
+        """Open the descriptors of the allowed roots, under both their paths; lock must be held"""
+        roots = {}
+        try:
+            for path in dict.fromkeys((self.root,) + self.allowed_roots):
+                fd = os.open(path, _DIRECTORY_FLAGS & ~os.O_NOFOLLOW)  # roots may be symlinks
+                self._root_fds[fd] = _parts(os.path.realpath(path))
+                roots[_parts(path)] = roots[self._root_fds[fd]] = fd
+        except OSError:
+            for fd in self._root_fds:
+                os.close(fd)
+            self._root_fds.clear()
+            raise
+        self._roots = roots
+        self._root_fd = roots[_parts(self.root)]
+
+    def _cached_directory(self, parent):
+        """Return the cached descriptor of a directory, if its path still leads to it"""
+        if not parent:
+            return self._root_fd
+        cached = self._cache.get(parent)
+        if cached is not None:
+            fd, identity = cached
+            try:
+                parent_stat = os.stat(parent, dir_fd=self._root_fd)
+            except OSError:
+                parent_stat = None
+            if parent_stat is not None and (parent_stat.st_dev, parent_stat.st_ino) == identity:
+                self._cache.move_to_end(parent)
+                self.hits += 1
+                return fd
+            del self._cache[parent]
+            os.close(fd)
+        self.misses += 1
+        return None
+
+    def _cache_directory(self, parent, fd):
+        """Cache the descriptor of a directory, unless the file was a symlink to another one
+
+        The caller still owns the descriptor if this raises.
+        """
+        directory_stat, parent_stat = os.fstat(fd), os.stat(parent, dir_fd=self._root_fd)
+        identity = (directory_stat.st_dev, directory_stat.st_ino)
+        if identity != (parent_stat.st_dev, parent_stat.st_ino):
+            os.close(fd)
+            return
+        self._cache[parent] = (fd, identity)
+        while len(self._cache) > self.max_directories:
+            _, (evicted, _) = self._cache.popitem(last=False)
+            os.close(evicted)
+            self.evictions += 1
+
+    def _walk(self, parts, flags):
+        """Open a path component by component and return its descriptor and its directory's
+
+        The directory's descriptor is ``None`` if it is the descriptor of a root; otherwise the
+        caller owns it. Symlinks are read and their targets walked in place of them.
+        """
+        roots = self._roots
+        stack = [self._root_fd]  # descriptors of the directories walked into, from a root
+        outside = None  # absolute components walked outside of any root, not opened
+        todo = list(reversed(parts))
+        links = 0
+        try:
+            while todo:
+                name = todo.pop()
+                if name in ('', '.'):
+                    continue
+                if outside is not None:  # walk lexically until a root comes up
+                    if name == '..':
+                        outside = outside[:-1]
+                    else:
+                        outside += (name,)
+                    if outside in roots:
+                        stack, outside = [roots[outside]], None
+                    continue
+                if name == '..':
+                    if len(stack) > 1:
+                        os.close(stack.pop())
+                    else:  # leaving the root: continue from its parent
+                        outside = self._root_fds[stack[0]][:-1]
+                        stack = []
+                    continue
+                last = not todo
+                try:
+                    fd = os.open(name, (flags | _FILE_FLAGS) if last else _DIRECTORY_FLAGS,
+                                 dir_fd=stack[-1])
+                except OSError as error:
+                    if not _is_symlink_error(error):
+                        raise
+                    try:
+                        target = os.readlink(name, dir_fd=stack[-1])
+                    except OSError:
+                        raise error from None
+                    links += 1
+                    if links > MAX_SYMLINKS:
+                        raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), name) from None
+                    if os.path.isabs(target):
+                        for fd in stack[1:]:
+                            os.close(fd)
+                        stack, outside = [], ()
+                    todo.extend(reversed(target.split(os.path.sep)))
+                    continue
+                if last:
+                    dir_fd = stack.pop() if len(stack) > 1 else None
+                    return fd, dir_fd
+                stack.append(fd)
+            if outside is None:  # the path ends in a directory, with '.' or '..'
+                return os.open('.', flags | _FILE_FLAGS, dir_fd=stack[-1]), None
+            path = os.path.sep.join(parts)
+            log.warning('Path %r leads outside of the allowed roots', path)
+            raise PathEscapeError(errno.EACCES, 'Path leads outside of the allowed roots', path)
+        finally:
+            for fd in stack[1:]:
+                os.close(fd)
+
+    def _open_resolved(self, path, flags):  # pragma: no cover
+        """Resolve a path, check it against the allowed roots, and open it"""
+        real = self._resolver.resolve(path)
+        for root in (self.root,) + self.allowed_roots:
+            real_root = self._resolver.resolve(root)
+            if real == real_root or real.startswith(os.path.join(real_root, '')):
+                return os.open(real, flags | _FILE_FLAGS)
+        raise PathEscapeError(errno.EACCES, 'Path leads outside of the allowed roots', path)
+
+
+def _parts(path):
+    return tuple(part for part in path.split(os.path.sep) if part)
+
+
+def _is_symlink_error(error):
+    """Return if an error from opening with O_NOFOLLOW might come from a symlink"""
+    return error.errno in (errno.ELOOP, errno.ENOTDIR, errno.EMLINK)
@@ -0,0 +1,522 @@
+# -*- coding: UTF-8 -*-
+"""Read audio metadata with pure-Python parsers, and cache it in SQLite
+
+The parsers only read what they need: frame and atom headers are used to seek past everything
+else, like embedded cover art. Supported are ID3v2.2-2.4 and ID3v1 tags (MP3), FLAC, Ogg Vorbis
+and Opus comments, and MP4/M4A metadata atoms.
+"""
+import io
+import logging
+import os
+import struct
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+from cherrymusic.database.sqlite import ISOLATION
+
+from .data import encode_path
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500  # stays below SQLite's old limit of 999 query parameters
+
+AUDIO_EXTENSIONS = frozenset(('.mp3', '.flac', '.ogg', '.oga', '.opus', '.m4a', '.mp4', '.m4b'))
+
+FIELDS = ('format', 'title', 'artist', 'album', 'albumartist', 'track', 'disc', 'date', 'genre',
+          'duration')
+
+MAX_TAG_SIZE = 16 * 1024 * 1024  # don't read more than this for a single tag or comment block
+
+
+class TagError(ValueError):
+    """Raised by parsers for malformed files"""
+
+
+def read_tags(filename):
+    """Read the metadata of an audio file, based on its contents instead of its extension
+
+    Returns:
+        A dict with keys from :data:`FIELDS`; ``format`` is ``None`` for unknown or malformed
+        files. ``None`` instead of a dict if the file can't be read.
+    """
+    try:
+        with open(filename, 'rb') as file:
+            head = file.read(12)
+            file.seek(0)
+            if head.startswith(b'ID3'):
+                tags = _read_id3v2(file)
+                if file.read(4) == b'fLaC':  # FLAC with a non-standard ID3 tag in front
+                    tags = _read_flac(file)
+            elif head.startswith(b'fLaC'):
+                file.seek(4)
+                tags = _read_flac(file)
+            elif head.startswith(b'OggS'):
+                tags = _read_ogg(file)
+            elif head[4:8] == b'ftyp':
+                tags = _read_mp4(file)
+            else:
+                tags = _read_id3v1(file)
+    except OSError as error:
+        log.warning('Cannot read tags of %r: %s', filename, error)
+        return None
+    except (TagError, struct.error, UnicodeDecodeError, IndexError) as error:
+        log.info('Malformed tags in %r: %s', filename, error)
+        tags = {'format': None}
+    return {field: tags.get(field) for field in FIELDS}
+
+
+def _number(text):
+    """Parse track and disc numbers like ``'3'`` or ``'3/12'``"""
+    try:
+        return int(text.split('/')[0])
+    except (AttributeError, ValueError):
+        return None
+
+
+def _read_exactly(file, size):
+    if size > MAX_TAG_SIZE:
+        raise TagError(f'Unreasonable size: {size}')
+    data = file.read(size)
+    if len(data) < size:
+        raise TagError('Unexpected end of file')
+    return data
+
+
+# -- ID3
+
+_ID3_FRAMES = {
+    'TIT2': 'title', 'TPE1': 'artist', 'TALB': 'album', 'TPE2': 'albumartist', 'TRCK': 'track',
+    'TPOS': 'disc', 'TDRC': 'date', 'TYER': 'date', 'TCON': 'genre', 'TLEN': 'duration',
+    # ID3v2.2
+    'TT2': 'title', 'TP1': 'artist', 'TAL': 'album', 'TP2': 'albumartist', 'TRK': 'track',
+    'TPA': 'disc', 'TYE': 'date', 'TCO': 'genre', 'TLE': 'duration',
+}
+
+_ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _id3_text(data):
+    text = data[1:].decode(_ID3_ENCODINGS[data[0]])
+    return text.split('\0')[0].strip()  # ID3v2.4 separates multiple values with NUL
+
+
+def _read_id3v2(file):
+    """Parse an ID3v2 tag at the current position; leave the file at the end of the tag"""
+    header = _read_exactly(file, 10)
+    version, flags, size = header[3], header[5], _syncsafe(header[6:10])
+    if version not in (2, 3, 4):
+        raise TagError(f'Unsupported ID3 version 2.{version}')
+    end = file.tell() + size
+    if flags & 0x80 and version < 4:  # whole tag unsynchronized: undo in memory
+        data = _read_exactly(file, size).replace(b'\xff\x00', b'\xff')
+        frames = _id3_frames(io.BytesIO(data), len(data), version)
+    else:
+        if flags & 0x40:  # extended header
+            ext_size = _read_exactly(file, 4)
+            if version == 4:
+                file.seek(_syncsafe(ext_size) - 4, os.SEEK_CUR)
+            else:
+                file.seek(int.from_bytes(ext_size, 'big'), os.SEEK_CUR)
+        frames = _id3_frames(file, end, version)
+    tags = {'format': 'id3'}
+    for frame_id, text in frames:
+        field = _ID3_FRAMES[frame_id]
+        if field in tags or not text:
+            continue
+        if field in ('track', 'disc'):
+            text = _number(text)
+        elif field == 'duration':
+            text = _number(text)
+            text = text / 1000 if text else None
+        tags[field] = text
+    file.seek(end)
+    return tags
+
+
+def _id3_frames(file, end, version):
+    """Yield ``(frame_id, text)`` for the frames in :data:`_ID3_FRAMES`, seeking past others"""
+    id_size, header_size = (3, 6) if version == 2 else (4, 10)
+    while file.tell() + header_size <= end:
+        header = file.read(header_size)
+        if header[0] == 0:  # padding
+            return
+        frame_id = header[:id_size].decode('latin-1')
+        if version == 2:
+            size = int.from_bytes(header[3:6], 'big')
+        elif version == 3:
+            size = int.from_bytes(header[4:8], 'big')
+        else:
+            size = _syncsafe(header[4:8])
+        skip = frame_id not in _ID3_FRAMES
+        if version > 2:
+            format_flags = header[9]
+            if version == 3:
+                skip = skip or format_flags & 0xc0  # compressed or encrypted
+            else:
+                skip = skip or format_flags & 0x0c
+        if skip:
+            file.seek(size, os.SEEK_CUR)
+            continue
+        data = _read_exactly(file, size)
+        if version == 4:
+            if format_flags & 0x01:  # data length indicator
+                data = data[4:]
+            if format_flags & 0x02:  # frame unsynchronized
+                data = data.replace(b'\xff\x00', b'\xff')
+        elif version == 3 and header[9] & 0x20:  # group id
+            data = data[1:]
+        if data:
+            yield frame_id, _id3_text(data)
+
+
+def _read_id3v1(file):
+    try:
+        file.seek(-128, os.SEEK_END)
+    except OSError:  # file is too short
+        return {'format': None}
+    data = file.read(128)
+    if not data.startswith(b'TAG'):
+        return {'format': None}
+
+    def text(start, length):
+        return data[start:start + length].split(b'\0')[0].decode('latin-1').strip() or None
+
+    tags = {
+        'format': 'id3v1',
+        'title': text(3, 30),
+        'artist': text(33, 30),
+        'album': text(63, 30),
+        'date': text(93, 4),
+    }
+    if data[125] == 0 and data[126]:
+        tags['track'] = data[126]
+    return tags
+
+
+# -- Vorbis comments: FLAC, Ogg Vorbis, Opus
+
+_VORBIS_FIELDS = {
+    'TITLE': 'title', 'ARTIST': 'artist', 'ALBUM': 'album', 'ALBUMARTIST': 'albumartist',
+    'ALBUM ARTIST': 'albumartist', 'TRACKNUMBER': 'track', 'DISCNUMBER': 'disc', 'DATE': 'date',
+    'GENRE': 'genre',
+}
+
+
+def _parse_vorbis_comment(data, tags):
+    """Parse a vorbis comment block; counts and lengths are checked against the block size"""
+    vendor_length = int.from_bytes(data[0:4], 'little')
+    offset = 4 + vendor_length
+    if offset + 4 > len(data):
+        raise TagError('Truncated vorbis comment block')
+    count = int.from_bytes(data[offset:offset + 4], 'little')
+    offset += 4
+    for _ in range(count):
+        length = int.from_bytes(data[offset:offset + 4], 'little')
+        if offset + 4 + length > len(data):
+            raise TagError('Truncated vorbis comment block')
+        comment = data[offset + 4:offset + 4 + length].decode('utf-8', 'replace')
+        offset += 4 + length
+        key, _, value = comment.partition('=')
+        field = _VORBIS_FIELDS.get(key.upper())
+        if field and value and field not in tags:
+            tags[field] = _number(value) if field in ('track', 'disc') else value.strip()
+    return tags
+
+
+def _read_flac(file):
+    """Parse FLAC metadata blocks, starting after the ``fLaC`` marker"""
+    tags = {'format': 'flac'}
+    while True:
+        header = _read_exactly(file, 4)
+        is_last, block_type = header[0] & 0x80, header[0] & 0x7f
+        size = int.from_bytes(header[1:4], 'big')
+        if block_type == 0:  # STREAMINFO
+            info = int.from_bytes(_read_exactly(file, size)[10:18], 'big')
+            sample_rate, total_samples = info >> 44, info & (2 ** 36 - 1)
+            if sample_rate and total_samples:
+                tags['duration'] = total_samples / sample_rate
+        elif block_type == 4:  # VORBIS_COMMENT
+            _parse_vorbis_comment(_read_exactly(file, size), tags)
+        else:
+            file.seek(size, os.SEEK_CUR)
+        if is_last:
+            return tags
+
+
+def _ogg_packets(file):
+    """Yield the packets at the start of an Ogg stream"""
+    packet = b''
+    while True:
+        header = file.read(27)
+        if len(header) < 27:
+            return
+        if not header.startswith(b'OggS'):
+            raise TagError('Lost Ogg page sync')
+        segments = _read_exactly(file, header[26])
+        data = _read_exactly(file, sum(segments))
+        offset = 0
+        for length in segments:
+            packet += data[offset:offset + length]
+            offset += length
+            if len(packet) > MAX_TAG_SIZE:
+                raise TagError('Oversized Ogg packet')
+            if length < 255:
+                yield packet
+                packet = b''
+
+
+def _last_granule(file):
+    """Return the granule position of the last Ogg page, or None"""
+    file.seek(0, os.SEEK_END)
+    file.seek(max(0, file.tell() - 65536))
+    data = file.read()
+    index = data.rfind(b'OggS')
+    if index < 0 or len(data) < index + 14:
+        return None
+    return struct.unpack_from('<q', data, index + 6)[0]
+
+
+def _read_ogg(file):
+    packets = _ogg_packets(file)
+    identification, comment = next(packets, b''), next(packets, b'')
+    if identification.startswith(b'\x01vorbis') and comment.startswith(b'\x03vorbis'):
+        tags = _parse_vorbis_comment(comment[7:], {'format': 'vorbis'})
+        sample_rate, pre_skip = int.from_bytes(identification[12:16], 'little'), 0
+    elif identification.startswith(b'OpusHead') and comment.startswith(b'OpusTags'):
+        tags = _parse_vorbis_comment(comment[8:], {'format': 'opus'})
+        sample_rate, pre_skip = 48000, int.from_bytes(identification[10:12], 'little')
+    else:
+        return {'format': None}
+    granule = _last_granule(file)
+    if granule and granule > pre_skip and sample_rate:
+        tags['duration'] = (granule - pre_skip) / sample_rate
+    return tags
+
+
+# -- MP4
+
+_MP4_FIELDS = {
+    b'\xa9nam': 'title', b'\xa9ART': 'artist', b'\xa9alb': 'album', b'aART': 'albumartist',
+    b'trkn': 'track', b'disk': 'disc', b'\xa9day': 'date', b'\xa9gen': 'genre',
+}
+
+
+def _mp4_atoms(file, start, end):
+    """Yield ``(type, data_start, data_end)`` of the atoms in a byte range, seeking past them"""
+    position = start
+    while position + 8 <= end:
+        file.seek(position)
+        header = _read_exactly(file, 8)
+        size, atom_type = int.from_bytes(header[:4], 'big'), header[4:]
+        data_start = position + 8
+        if size == 1:  # 64-bit size
+            size = int.from_bytes(_read_exactly(file, 8), 'big')
+            data_start += 8
+        elif size == 0:  # extends to the end
+            size = end - position
+        if size < data_start - position:
+            raise TagError(f'Invalid atom size: {size}')
+        yield atom_type, data_start, position + size
+        position += size
+
+
+def _mp4_find(file, start, end, *path):
+    """Return the data range of the atom at a path of nested atom types, or None"""
+    for atom_type in path:
+        for found, data_start, data_end in _mp4_atoms(file, start, end):
+            if found == atom_type:
+                start, end = data_start, data_end
+                if atom_type == b'meta':  # a full box: skip version and flags
+                    start += 4
+                break
+        else:
+            return None
+    return start, end
+
+
+def _read_mp4(file):
+    file.seek(0, os.SEEK_END)
+    moov = _mp4_find(file, 0, file.tell(), b'moov')
+    if moov is None:
+        return {'format': None}
+    tags = {'format': 'mp4'}
+    mvhd = _mp4_find(file, *moov, b'mvhd')
+    if mvhd:
+        file.seek(mvhd[0])
+        data = _read_exactly(file, 32)
+        if data[0] == 1:  # version 1: 64-bit times
+            timescale, duration = struct.unpack_from('>IQ', data, 20)
+        else:
+            timescale, duration = struct.unpack_from('>II', data, 12)
+        if timescale:
+            tags['duration'] = duration / timescale
+    ilst = _mp4_find(file, *moov, b'udta', b'meta', b'ilst')
+    for item_type, item_start, item_end in (_mp4_atoms(file, *ilst) if ilst else ()):
+        field = _MP4_FIELDS.get(item_type)
+        if field is None:
+            continue
+        data_range = _mp4_find(file, item_start, item_end, b'data')
+        if data_range is None:
+            continue
+        file.seek(data_range[0])
+        data = _read_exactly(file, data_range[1] - data_range[0])[8:]  # skip type and locale
+        if field in ('track', 'disc'):
+            tags[field] = int.from_bytes(data[2:4], 'big') or None
+        else:
+            tags[field] = data.decode('utf-8', 'replace').strip() or None
+    return tags
+
+
+class TagCache:
+    """Tags of the audio files in a collection, read in parallel and cached in SQLite
+
+    Cache entries are keyed by path, and are only valid for the file size and mtime they were
+    read with; a file whose size and mtime are unchanged is never read again.
+
+    Args:
+        database: The :class:`~cherrymusic.database.sqlite.SqliteDatabase` to keep the cache in
+        root: The root directory of the collection
+    """
+
+    def __init__(self, database, root):
+        self.database = database
+        self.root = os.path.abspath(root)
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.database!r}, {self.root!r})'
+
+    def create_tables(self, transaction):
+        transaction.execute(
+            'CREATE TABLE IF NOT EXISTS tags('
+            'path BLOB PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL, '
+            'format TEXT, title TEXT, artist TEXT, album TEXT, albumartist TEXT, '
+            'track INTEGER, disc INTEGER, date TEXT, genre TEXT, duration REAL)'
+        )
+
+    @staticmethod
+    def is_audio(path):
+        return not path.is_dir and os.path.splitext(path.name)[1].lower() in AUDIO_EXTENSIONS
+
+    def update(self, paths, *, max_workers=None, batch_size=DEFAULT_BATCH_SIZE):
+        """Read and cache the tags of new or changed audio files among paths
+
+        ``paths`` is consumed lazily in batches, so the output of
+        :func:`~cherrymusic.media.files.recursive_scandir` can be passed directly; a scan with
+        ``stat=True`` saves another stat per path. Files are parsed on a pool of worker
+        processes, which only gets started if there is anything to read. While the workers parse
+        a batch, the next batch is checked against the cache, and results of the previous one
+        are written, each in its own transaction.
+
+        Args:
+            paths: An iterable of :class:`~cherrymusic.media.data.Path` objects, relative to root;
+                directories and files without an extension in :data:`AUDIO_EXTENSIONS` are
+                skipped
+            max_workers: The number of worker processes; defaults to the number of CPUs
+            batch_size: The number of paths to check against the cache with a single query
+
+        Returns:
+            The number of files read
+        """
+        candidates = filter(self.is_audio, paths)
+        workers = max_workers or os.cpu_count() or 1
+        executor = None
+        in_flight = deque()  # (stale entries, iterator of their parse results)
+        count = 0
+        try:
+            while True:
+                batch = list(islice(candidates, batch_size))
+                if batch:
+                    stale = self._stale(batch)
+                    if stale:
+                        if executor is None:
+                            executor = ProcessPoolExecutor(workers)
+                        filenames = [filename for *_, filename in stale]
+                        chunksize = max(1, len(stale) // (4 * workers))
+                        in_flight.append((stale, executor.map(read_tags, filenames,
+                                                              chunksize=chunksize)))
+                if in_flight and (len(in_flight) > 1 or not batch):
+                    count += self._store(*in_flight.popleft())
+                if not batch and not in_flight:
+                    return count
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+    def get(self, path):
+        """Return the cached tags of a path as a dict, or ``None``"""
+        with self.database.transaction() as tx:
+            self.create_tables(tx)
+            rows = tx.execute(f'SELECT {", ".join(FIELDS)} FROM tags WHERE path = ?',
+                              (encode_path(path),))
+        return dict(zip(FIELDS, rows[0])) if rows else None
+
+    def remove(self, paths):
+        """Remove cache entries for paths and everything below them; return the number removed"""
+        separator = os.sep.encode()
+        count = 0
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            for path in paths:
+                key = encode_path(path)
+                count += tx.execute(
+                    'DELETE FROM tags WHERE path = ? OR (path >= ? AND path < ?)',
+                    (key, key + separator, key + bytes([separator[0] + 1])),
+                    cursor_callback=lambda cursor: cursor.rowcount,
+                )
+        return count
+
+    def __len__(self):
+        with self.database.transaction() as tx:
+            self.create_tables(tx)
+            return tx.execute('SELECT COUNT(*) FROM tags')[0][0]
+
+    def _stale(self, batch):
+        """Return ``(key, size, mtime_ns, filename)`` for paths without a valid cache entry"""
+        current = {}
+        for path in batch:
+            filename = os.path.join(self.root, path.path)
+            stat = getattr(path, 'stat', None)
+            if stat is None:
+                try:
+                    stat = os.stat(filename)
+                except OSError as error:
+                    log.warning('Cannot stat %r: %s', path.path, error)
+                    continue
+                size, mtime_ns = stat.st_size, stat.st_mtime_ns
+            else:
+                size, mtime_ns = stat.size, stat.mtime_ns
+            current[encode_path(path)] = (size, mtime_ns, filename)
+        if not current:
+            return []
+        with self.database.transaction() as tx:
+            self.create_tables(tx)
+            cached = tx.execute(
+                'SELECT path, size, mtime_ns FROM tags '
+                f'WHERE path IN ({", ".join("?" * len(current))})',
+                tuple(current),
+            )
+        for key, size, mtime_ns in cached:
+            if current[key][:2] == (size, mtime_ns):
+                del current[key]
+        return [(key,) + values for key, values in current.items()]
+
+    def _store(self, stale, results):
+        """Write parse results for stale entries; return the number of files read"""
+        rows = [
+            (key, size, mtime_ns) + tuple(tags[field] for field in FIELDS)
+            for (key, size, mtime_ns, _), tags in zip(stale, results)
+            if tags is not None
+        ]
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            tx.executemany(
+                f'INSERT OR REPLACE INTO tags VALUES ({", ".join("?" * (3 + len(FIELDS)))})',
+                rows,
+            )
+        return len(rows)
@@ -0,0 +1,116 @@
+# -*- coding: UTF-8 -*-
+"""Build minimal audio files with metadata, for testing and benchmarking tag parsers
+
+The files contain valid metadata structures, but no playable audio.
+"""
+import struct
+
+FILLER = b'\0' * 1024  # stands in for audio data
+
+
+def _syncsafe(number):
+    return bytes((number >> shift) & 0x7f for shift in (21, 14, 7, 0))
+
+
+def id3v2(tags, *, version=4, picture_size=0, padding=64):
+    """Return an ID3v2 tag with text frames for tags, e.g. ``{'TIT2': 'Title'}``"""
+    frames = b''
+    for frame_id, text in tags.items():
+        if version == 3:
+            data = b'\x01' + text.encode('utf-16')  # with BOM
+        else:
+            data = b'\x03' + text.encode('utf-8')
+        if version == 2:
+            frames += frame_id.encode() + len(data).to_bytes(3, 'big') + data
+        else:
+            size = _syncsafe(len(data)) if version == 4 else len(data).to_bytes(4, 'big')
+            frames += frame_id.encode() + size + b'\0\0' + data
+    if picture_size:
+        data = b'\0image/jpeg\0\x03\0' + b'\xff' * picture_size
+        size = _syncsafe(len(data)) if version == 4 else len(data).to_bytes(4, 'big')
+        frames += b'APIC' + size + b'\0\0' + data
+    frames += b'\0' * padding
+    return b'ID3' + bytes((version, 0, 0)) + _syncsafe(len(frames)) + frames
+
+
+def mp3(tags, **kwargs):
+    return id3v2(tags, **kwargs) + b'\xff\xfb\x90\x00' + FILLER
+
+
+def id3v1(title, artist, album, year, track):
+    def field(text, length):
+        return text.encode('latin-1').ljust(length, b'\0')
+    return b'\xff\xfb\x90\x00' + FILLER + b'TAG' + field(title, 30) + field(artist, 30) + \
+        field(album, 30) + field(year, 4) + b'\0' * 28 + bytes((0, track, 255))
+
+
+def vorbis_comment(tags, vendor='test'):
+    comments = [f'{key}={value}'.encode() for key, value in tags.items()]
+    return (
+        struct.pack('<I', len(vendor)) + vendor.encode() + struct.pack('<I', len(comments)) +
+        b''.join(struct.pack('<I', len(comment)) + comment for comment in comments)
+    )
+
+
+def flac(tags, *, sample_rate=44100, total_samples=44100 * 180, picture_size=0):
+    info = (sample_rate << 44) | (1 << 41) | (15 << 36) | total_samples
+    streaminfo = b'\0' * 10 + info.to_bytes(8, 'big') + b'\0' * 16
+    blocks = [(0, streaminfo), (4, vorbis_comment(tags))]
+    if picture_size:
+        blocks.append((6, b'\0' * picture_size))
+    data = b'fLaC'
+    for number, (block_type, block) in enumerate(blocks):
+        is_last = 0x80 if number == len(blocks) - 1 else 0
+        data += bytes((is_last | block_type,)) + len(block).to_bytes(3, 'big') + block
+    return data + FILLER
+
+
+def _ogg_page(packet_data, *, granule, sequence, header_type=0):
+    segments = []
+    remaining = len(packet_data)
+    while remaining >= 255:
+        segments.append(255)
+        remaining -= 255
+    segments.append(remaining)
+    assert len(segments) < 256
+    return (
+        b'OggS' + bytes((0, header_type)) + struct.pack('<qIII', granule, 1, sequence, 0) +
+        bytes((len(segments),)) + bytes(segments) + packet_data
+    )
+
+
+def ogg(tags, *, codec='vorbis', seconds=180):
+    if codec == 'vorbis':
+        sample_rate, pre_skip = 44100, 0
+        identification = b'\x01vorbis' + struct.pack('<IBIiii', 0, 2, sample_rate, 0, 0, 0)
+        comment = b'\x03vorbis' + vorbis_comment(tags) + b'\x01'
+    else:
+        sample_rate, pre_skip = 48000, 312
+        identification = b'OpusHead' + struct.pack('<BBHIhB', 1, 2, pre_skip, 48000, 0, 0)
+        comment = b'OpusTags' + vorbis_comment(tags)
+    granule = pre_skip + seconds * sample_rate
+    return (
+        _ogg_page(identification, granule=0, sequence=0, header_type=2) +
+        _ogg_page(comment, granule=0, sequence=1) +
+        _ogg_page(FILLER, granule=granule, sequence=2, header_type=4)
+    )
+
+
+def _atom(atom_type, data):
+    return struct.pack('>I', 8 + len(data)) + atom_type + data
+
+
+def mp4(tags, *, timescale=1000, duration=180_000, track=None):
+    """Return an MP4 file with metadata; tags map item types like ``b'\\xa9nam'`` to text"""
+    items = b''.join(
+        _atom(item_type, _atom(b'data', struct.pack('>II', 1, 0) + text.encode()))
+        for item_type, text in tags.items()
+    )
+    if track:
+        items += _atom(b'trkn', _atom(b'data', struct.pack('>IIHHHH', 0, 0, 0, track, 12, 0)))
+    meta = _atom(b'meta', b'\0\0\0\0' + _atom(b'hdlr', b'\0' * 25) + _atom(b'ilst', items))
+    mvhd = _atom(b'mvhd', struct.pack('>IIIII', 0, 0, 0, timescale, duration) + b'\0' * 80)
+    return (
+        _atom(b'ftyp', b'M4A \0\0\0\0') + _atom(b'mdat', FILLER) +
+        _atom(b'moov', mvhd + _atom(b'udta', meta))  # moov at the end, like many encoders do
+    )
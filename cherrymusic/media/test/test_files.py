@@ -1,10 +1,17 @@
 # -*- coding: UTF-8 -*-
 import os
+import pickle
+from unittest import mock
 
 import pytest
 
 from cherrymusic.common.test.helpers import tempdir
 from cherrymusic.media import files
+from cherrymusic.media.data import Path
+from cherrymusic.media.filters import FilterRules
+from cherrymusic.media.incremental import CHANGE
+from cherrymusic.media.tree import PathTree
+from cherrymusic.media.watcher import Changes
 
 
 def test_path_attributes():
@@ -70,6 +77,26 @@ def test_path_equality():
     assert d['foo'] is sentinel_c
 
 
+def test_path_is_compact_and_frozen():
+    path = files.Path('FOO').make_child('BAR', is_dir=False)
+    assert not hasattr(path, '__dict__')
+    assert repr(path) == "Path('FOO/BAR')"
+    with pytest.raises(AttributeError):
+        path.name = 'BAZ'
+    with pytest.raises(AttributeError):
+        del path.parent
+    with pytest.raises(TypeError):
+        files.Path('FOO', unknown=True)
+
+
+def test_path_pickles_cached_attributes():
+    path = files.Path('FOO/BAR', is_dir=False)
+    assert path.depth == 2
+    copy = pickle.loads(pickle.dumps(path))
+    assert copy == path
+    assert (copy.depth, copy.is_dir, copy.path) == (2, False, 'FOO/BAR')
+
+
 def test_path_is_pathlike():
     assert os.fsencode(files.Path('.')) == b'.'
     assert os.fsencode(files.Path(b'.')) == b'.'
@@ -118,6 +145,78 @@ def test_path_string_attributes_are_interned():
     assert files.Path('PARENT/NAME').parent is files.Path('PARENT/NAME').parent
 
 
+def test_path_children_from_scandir():
+    with tempdir('dir/file', 'dir/sub/', links={'dir/link': 'dir/sub/'}) as tmp_path:
+        with os.scandir(tmp_path / 'dir') as dir_entries:
+            entries = sorted(dir_entries, key=lambda entry: entry.name)
+        for parent in (files.Path('.', is_dir=True), files.Path('top/dir', is_dir=True)):
+            children = files.Path.children_from_scandir(parent, entries)
+            expected = [
+                parent.make_child(entry.name, is_dir=entry.is_dir(),
+                                  is_symlink=entry.is_symlink())
+                for entry in entries
+            ]
+
+            assert children == expected
+            for child, other in zip(children, expected):
+                assert (child.path, child.parent, child.depth) == (
+                    other.path, other.parent, other.depth)
+                assert (child.is_dir, child.is_symlink) == (other.is_dir, other.is_symlink)
+                assert child.stat is None
+                assert child.name is other.name and child.parent is other.parent  # interned
+        assert [child.is_dir for child in children] == [False, True, True]
+        assert [child.is_symlink for child in children] == [False, True, False]
+
+        stat_entry = mock.Mock(side_effect=files.dir_entry_stat)
+        children = files.Path.children_from_scandir(
+            parent, entries, accept=lambda child: child.is_dir, stat_entry=stat_entry)
+        assert [child.name for child in children] == ['link', 'sub']
+        assert [call[0][0].name for call in stat_entry.call_args_list] == ['link', 'sub']
+        assert children[1].stat == files.FileStat.from_stat_result(os.stat(tmp_path / 'dir/sub'))
+
+
+def test_bytes_path():
+    path = files.BytesPath(b'dir/n\xe4me.mp3')
+
+    assert (path.parent, path.name, path.path, path.depth) == (
+        b'dir', b'n\xe4me.mp3', b'dir/n\xe4me.mp3', 2)
+    assert bytes(path) is path.path
+    assert os.fspath(path) == b'dir/n\xe4me.mp3'
+    assert path.as_url == 'dir/n%E4me.mp3'
+    assert files.BytesPath.from_url(path.as_url) == path
+    assert path.display == str(path) == 'dir/n\ufffdme.mp3'
+    assert path == b'dir/n\xe4me.mp3' and hash(path) == hash(b'dir/n\xe4me.mp3')
+    assert path != files.Path(b'dir/n\xe4me.mp3')
+
+    child = files.BytesPath('.', is_dir=True).make_child(b'sub')
+    assert (child.parent, child.path, child.depth) == (b'', b'sub', 1)
+    assert child.make_child('other').path == b'sub/other'
+    assert files.BytesPath(b'./sub//x/../y').path == b'sub/y'
+    assert pickle.loads(pickle.dumps(path)) == path
+
+
+def test_recursive_scandir_bytes():
+    raw_name = os.fsdecode(b'caf\xe9.mp3')  # not valid in UTF-8
+    with tempdir('dir/sub/' + raw_name, 'dir/.hidden/file', 'dir/top.txt',
+                 links={'dir/loop/': 'dir/'}) as tmp_path:
+        for scandir in (files.recursive_scandir, files.parallel_recursive_scandir):
+            root = os.fsencode(tmp_path / 'dir')
+            filters = [files.hidden_file_filter(), files.circular_symlink_filter(root),
+                       FilterRules(exclude=['*.txt'])]
+            found = list(scandir(root, filters=filters, stat=True))
+
+            assert all(isinstance(path, files.BytesPath) for path in found)
+            assert sorted(map(bytes, found)) == [b'sub', b'sub/caf\xe9.mp3']
+            assert all(path.stat is not None for path in found)
+
+            found = list(scandir(b'sub', root=os.fsdecode(root)))
+            assert found == [b'sub', b'sub/caf\xe9.mp3']
+            assert found[1].depth == 2
+
+        with pytest.raises(TypeError):
+            list(files.recursive_scandir(os.fsencode(tmp_path), tree=PathTree()))
+
+
 def test_recursive_scandir():
     with tempdir('file', 'dir/', 'dir/subfile') as tmp_path:
         found_paths = {str(p): p for p in files.recursive_scandir(tmp_path)}
@@ -177,6 +276,42 @@ def test_recursive_scandir_symlinks():
         assert os.path.samefile(root_path / objs['dirlink/file'], root_path / objs['link'])
 
 
+@pytest.mark.parametrize('scan', [files.recursive_scandir, files.parallel_recursive_scandir])
+def test_scandir_captures_stat_of_accepted_entries(scan):
+    links = {'broken': 'missing'}
+    with tempdir('dir/file', 'skipped', links=links) as tmp_path:
+        os.remove(tmp_path / 'missing')
+
+        def accept(path):
+            return path.name != 'skipped'
+
+        with mock.patch.object(files, 'dir_entry_stat', wraps=files.dir_entry_stat) as stat:
+            found = {str(path): path for path in scan(tmp_path, filters=[accept], stat=True)}
+
+        assert sorted(call[0][0].name for call in stat.call_args_list) == [
+            'broken', 'dir', 'file']
+        assert found['broken'].stat is None
+        expected = os.stat(tmp_path / 'dir/file')
+        assert found['dir/file'].stat == files.FileStat.from_stat_result(expected)
+        assert found['dir/file'].stat.size == expected.st_size
+        assert all(path.stat is None for path in scan(tmp_path))
+
+
+def test_list_directory():
+    with tempdir('dir/b', 'dir/c/', 'dir/a', 'dir/.hidden') as tmp_path:
+        directory = files.Path('dir', is_dir=True)
+        accept = files.hidden_file_filter()
+
+        children = files.list_directory(tmp_path, directory, accept=accept, stat=True, sort=True)
+
+        assert children == ['dir/a', 'dir/b', 'dir/c']
+        assert [child.is_dir for child in children] == [False, False, True]
+        assert children[0].stat == files.FileStat.from_stat_result(os.stat(tmp_path / 'dir/a'))
+        assert files.list_directory(tmp_path, directory)[0].stat is None
+        with pytest.raises(FileNotFoundError):
+            files.list_directory(tmp_path, files.Path('missing', is_dir=True))
+
+
 def test_recursive_scandir_raises_error_when_invalid_startpath():
     with pytest.raises(FileNotFoundError):
         list(files.recursive_scandir('STARTPATH_DOES_NOT_EXIST'))
@@ -192,6 +327,66 @@ def test_canonical_path():
         assert files.canonical_path(b'.') == os.getcwdb()
 
 
+@pytest.mark.parametrize('path', [
+    '.', 'file', 'dir/sub/file', 'link_to_dir/sub/file', 'link_to_link/sub', 'link_to_dir/..',
+    'dir/up/sub/../file', 'absolute/sub', 'missing/sub', 'dir/./sub//', 'loop/x', b'dir/sub',
+])
+def test_path_resolver_resolves_like_canonical_path(path):
+    links = {'link_to_dir/': 'dir/', 'link_to_link/': 'link_to_dir/', 'dir/up/': 'dir/'}
+    with tempdir('file', 'dir/sub/file', links=links) as testdir:
+        os.symlink(testdir / 'dir', testdir / 'absolute')
+        os.symlink('loop2', testdir / 'loop')
+        os.symlink('loop', testdir / 'loop2')
+        resolver = files.PathResolver(testdir)
+
+        root = os.fsencode(testdir) if isinstance(path, bytes) else testdir
+        assert resolver.resolve(path) == files.canonical_path(path, root=root)
+        assert resolver.resolve(path) == files.canonical_path(path, root=root)  # cached
+
+
+def test_path_resolver_caches_ancestors():
+    with tempdir('dir/a', 'dir/b', links={'link/': 'dir/'}) as testdir:
+        resolver = files.PathResolver(testdir, max_entries=100)
+        assert resolver.resolve('link/a') == str(testdir / 'dir' / 'a')
+        hits = resolver.hits
+
+        with mock.patch('os.path.islink', wraps=os.path.islink) as islink:
+            assert resolver.resolve('link/b') == str(testdir / 'dir' / 'b')
+            assert resolver.resolve('link/b', root=str(testdir)) == str(testdir / 'dir' / 'b')
+        assert islink.call_count == 1  # only for the new name
+        stats = resolver.stats()
+        assert stats['hits'] == hits + 2 and stats['entries'] == len(resolver)
+        assert 0 < stats['hit_rate'] < 1
+
+        resolver = files.PathResolver(testdir, max_entries=2)
+        resolver.resolve('dir/a')
+        assert len(resolver) == 2 and resolver.stats()['evictions'] > 0
+
+
+def test_path_resolver_invalidation():
+    with tempdir('dir/a/', 'other/a/', links={'link/': 'dir/'}) as testdir:
+        resolver = files.PathResolver(testdir)
+
+        def retarget(link, target):
+            os.remove(testdir / link)
+            os.symlink(testdir / target, testdir / link)
+
+        assert resolver.resolve('link/a') == str(testdir / 'dir' / 'a')
+        retarget('link', 'other')
+        assert resolver.resolve('link/a') == str(testdir / 'dir' / 'a')  # stale
+        resolver.on_changes(Changes([], [Path('link')], [], False))
+        assert resolver.resolve('link/a') == str(testdir / 'other' / 'a')
+
+        os.rename(testdir / 'other' / 'a', testdir / 'other' / 'b')
+        os.symlink(testdir / 'dir' / 'a', testdir / 'other' / 'a')
+        changes = [(CHANGE.ADDED, Path('other/a'))]
+        assert list(resolver.scan_changes(iter(changes))) == changes  # invalidated behind link
+        assert resolver.resolve('link/a') == str(testdir / 'dir' / 'a')
+
+        resolver.on_changes(Changes([], [], [], True))
+        assert len(resolver) == 0 and resolver.stats()['invalidations'] > 0
+
+
 def test_circular_symlink_filter():
     links = {
         'root/safe_always': 'root/links_to_files_are_safe',
@@ -213,6 +408,35 @@ def test_circular_symlink_filter():
         assert filter_allows('safe_despite_common_suffix')
 
 
+def test_circular_symlink_filter_identifies_targets_by_inode():
+    links = {'root/first': 'other/dir/', 'root/second': 'other/dir/', 'root/self': 'root/'}
+    with tempdir('other/dir/', links=links) as testpath:
+        resolver = files.PathResolver()
+        filter_allows = files.circular_symlink_filter(root=testpath / 'root', resolver=resolver)
+
+        assert filter_allows(files.Path('first', is_dir=True, is_symlink=True))
+        with mock.patch.object(resolver, '_resolve') as resolve:
+            assert not filter_allows(files.Path('second', is_dir=True, is_symlink=True))
+            assert not filter_allows(files.Path('self', is_dir=True, is_symlink=True))
+        resolve.assert_not_called()
+
+
+def test_path_trie():
+    trie = files._PathTrie()
+    assert trie.add_unrelated(os.path.join('', 'a', 'b', ''))
+    assert trie.add_unrelated(os.path.join('', 'a', 'bc'))
+    assert trie.add_unrelated(os.path.join('', 'a', 'd', 'e'))
+    assert not trie.add_unrelated(os.path.join('', 'a', 'b'))  # equal
+    assert not trie.add_unrelated(os.path.join('', 'a', 'b', 'c'))  # inside
+    assert not trie.add_unrelated(os.path.join('', 'a', 'd'))  # above
+    assert not trie.add_unrelated(os.path.sep)
+    assert trie.add_unrelated(os.path.join('', 'a', 'd', 'f'))
+
+    trie = files._PathTrie()
+    assert trie.add_unrelated(os.path.sep)
+    assert not trie.add_unrelated(os.path.join('', 'a'))
+
+
 def test_hidden_file_filter():
     path = files.Path
     filter_allows = files.hidden_file_filter()
@@ -224,3 +448,59 @@ def test_hidden_file_filter():
     assert not filter_allows(path('dir/.name'))
     assert not filter_allows(path('../name'))
     assert not filter_allows(path('.dir/name'))
+
+
+def test_parallel_recursive_scandir():
+    with tempdir('file', 'dir/', 'dir/subfile', 'dir/sub/', 'dir/sub/subsubfile') as tmp_path:
+        found_paths = {str(p): p for p in files.parallel_recursive_scandir(tmp_path)}
+
+    assert found_paths.keys() == {'file', 'dir', 'dir/subfile', 'dir/sub', 'dir/sub/subsubfile'}
+    assert found_paths['dir'].is_dir is True
+    assert found_paths['file'].is_dir is False
+
+
+def test_parallel_recursive_scandir_ordered():
+    paths = ('c', 'a/', 'a/z', 'a/y/', 'a/y/x', 'b/', 'b/1', 'b/0')
+    with tempdir(*paths) as tmp_path:
+        found = list(files.parallel_recursive_scandir(tmp_path, ordered=True, max_workers=2))
+        again = list(files.parallel_recursive_scandir(tmp_path, ordered=True, max_workers=3))
+
+    # like recursive_scandir: a directory's children are listed before descending into them,
+    # and the last subdirectory listed is descended into first
+    assert found == ['a', 'b', 'c', 'b/0', 'b/1', 'a/y', 'a/z', 'a/y/x']
+    assert again == found
+
+
+def test_parallel_recursive_scandir_same_semantics():
+    paths = ('dir/', 'dir/subdir/subfile', '.hidden/file', 'other/.hidden', 'other/file')
+    with tempdir(*paths) as tmp_path:
+        for kwargs in ({'max_depth': 1}, {'filters': (files.hidden_file_filter(),)}):
+            for ordered in (True, False):
+                expected = set(files.recursive_scandir(tmp_path, **kwargs))
+                found = list(files.parallel_recursive_scandir(tmp_path, ordered=ordered, **kwargs))
+                assert len(found) == len(expected)
+                assert set(found) == expected
+
+        assert list(files.parallel_recursive_scandir('dir', root=tmp_path, ordered=True)) == [
+            'dir', 'dir/subdir', 'dir/subdir/subfile',
+        ]
+        assert list(files.parallel_recursive_scandir('subfile', root=tmp_path / 'dir/subdir')) == [
+            'subfile',
+        ]
+
+
+def test_parallel_recursive_scandir_stops_early():
+    with tempdir(*[f'{i}/{j}/' for i in range(20) for j in range(5)]) as tmp_path:
+        for ordered in (True, False):
+            scan = files.parallel_recursive_scandir(tmp_path, ordered=ordered, max_workers=1)
+            first = next(scan)
+            scan.close()  # must not hang or raise
+
+            assert first.depth == 1
+            with pytest.raises(StopIteration):
+                next(scan)
+
+
+def test_parallel_recursive_scandir_raises_error_when_invalid_startpath():
+    with pytest.raises(FileNotFoundError):
+        list(files.parallel_recursive_scandir('STARTPATH_DOES_NOT_EXIST'))
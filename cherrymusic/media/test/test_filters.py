@@ -0,0 +1,89 @@
+# -*- coding: UTF-8 -*-
+import os
+from unittest import mock
+
+import pytest
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.media import files
+from cherrymusic.media.data import BytesPath, FileStat, Path
+from cherrymusic.media.filters import FilterRules
+
+
+@pytest.mark.parametrize('rules, accepted', [
+    (FilterRules(), {'a.mp3', 'b.OGG', 'c.txt', '.d.mp3', 'e', 'e/f.mp3', 'e/g.log', '.h'}),
+    (FilterRules(hidden=True), {'a.mp3', 'b.OGG', 'c.txt', 'e', 'e/f.mp3', 'e/g.log'}),
+    (FilterRules(extensions=['.mp3', '.ogg']), {'a.mp3', 'b.OGG', '.d.mp3', 'e', 'e/f.mp3', '.h'}),
+    (FilterRules(exclude=['*.txt', 'e/*.log']), {'a.mp3', 'b.OGG', '.d.mp3', 'e', 'e/f.mp3', '.h'}),
+    # paths below rejected directories are left to scans, which don't descend into them
+    (FilterRules(exclude=['e']), {'a.mp3', 'b.OGG', 'c.txt', '.d.mp3', 'e/f.mp3', 'e/g.log', '.h'}),
+])
+@pytest.mark.parametrize('path_type, root', [(Path, None), (BytesPath, b'/')])
+def test_filter_rules(rules, accepted, path_type, root):
+    names = ('a.mp3', 'b.OGG', 'c.txt', '.d.mp3', 'e/f.mp3', 'e/g.log')
+    paths = [path_type(name) for name in names]
+    paths += [path_type('e', is_dir=True), path_type('.h', is_dir=True)]
+    accept = rules.compile(root)
+    assert {os.fsdecode(path.path) for path in paths if accept(path)} == accepted
+
+
+def test_filter_rules_size_range():
+    with tempdir('dir/', 'missing') as tmp_path:
+        for name, size in [('small', 10), ('medium', 100), ('large', 1000)]:
+            (tmp_path / name).write_bytes(b'\0' * size)
+        accept = FilterRules(min_size=50, max_size=500).compile(tmp_path)
+        (tmp_path / 'missing').unlink()
+
+        assert not accept(Path('small'))
+        assert not accept(Path('large'))
+        assert not accept(Path('missing'))
+        assert accept(Path('dir', is_dir=True))
+
+        assert accept(Path('medium'))
+
+        with mock.patch('os.stat', side_effect=AssertionError('stat again')):
+            assert accept(Path('captured', is_dir=False, stat=FileStat(100, 0, 0, 0)))
+            assert not accept(Path('captured', is_dir=False, stat=FileStat(10, 0, 0, 0)))
+
+
+def test_filter_rules_combine():
+    rules = (
+        FilterRules(extensions=['.mp3', '.ogg'], min_size=10) &
+        FilterRules(hidden=True, extensions=['.MP3'], exclude=['*.txt'], min_size=5, max_size=9)
+    )
+    assert rules.hidden is True
+    assert rules.extensions == {'.mp3'}
+    assert rules.exclude == ('*.txt',)
+    assert (rules.min_size, rules.max_size) == (10, 9)
+    assert (FilterRules() & FilterRules(extensions=['.ogg'])).extensions == {'.ogg'}
+    assert repr(FilterRules(hidden=True)) == 'FilterRules(hidden=True)'
+
+
+def test_filter_rules_prune_directories_in_scans():
+    with tempdir('a.mp3', 'notes.txt', '.git/objects/x.mp3', 'album/b.mp3', 'album/.c.mp3',
+                 'skip/d.mp3') as tmp_path:
+        rules = FilterRules(hidden=True, extensions=['.mp3'], exclude=['skip'])
+        listed = []
+        scandir = os.scandir
+
+        def spy_scandir(path):
+            listed.append(os.path.relpath(path, tmp_path))
+            return scandir(path)
+
+        with mock.patch('os.scandir', spy_scandir):
+            paths = {str(path) for path in files.recursive_scandir(tmp_path, filters=[rules])}
+        parallel_paths = {str(path) for path in files.parallel_recursive_scandir(
+            tmp_path, filters=[rules, files.circular_symlink_filter(tmp_path)])}
+
+    assert paths == parallel_paths == {'a.mp3', 'album', 'album/b.mp3'}
+    assert sorted(listed) == ['.', 'album']
+
+
+def test_combine_filters():
+    assert files.combine_filters([]) is None
+    only = mock.Mock()
+    assert files.combine_filters([only]) is only
+
+    first, second = mock.Mock(return_value=False), mock.Mock(return_value=True)
+    assert files.combine_filters([first, second])(Path('x')) is False
+    second.assert_not_called()
@@ -0,0 +1,139 @@
+# -*- coding: UTF-8 -*-
+import os
+import shutil
+from unittest import mock
+
+from cherrymusic.common.test.helpers import create_path, tempdir
+from cherrymusic.database.sqlite import ISOLATION, SqliteDatabase
+from cherrymusic.media import files, incremental
+from cherrymusic.media.incremental import CHANGE, IncrementalScanner
+
+
+def _changes(scanner):
+    return {(change, str(path)) for change, path in scanner.scan()}
+
+
+def _bump_mtime(path):
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+
+def test_incremental_scan_first_run_adds_everything():
+    with tempdir('file', 'dir/sub/subfile', 'dbdir/') as tmp_path:
+        database = SqliteDatabase('snapshot', basepath=tmp_path / 'dbdir')
+        scanner = IncrementalScanner(database, tmp_path / 'dir')
+
+        assert _changes(scanner) == {
+            (CHANGE.ADDED, 'sub'),
+            (CHANGE.ADDED, 'sub/subfile'),
+        }
+
+
+def test_incremental_scan_unchanged_tree_does_not_list_directories():
+    with tempdir('dir/a/b/c/file', 'dir/a/other', 'dbdir/') as tmp_path:
+        database = SqliteDatabase('snapshot', basepath=tmp_path / 'dbdir')
+        scanner = IncrementalScanner(database, tmp_path / 'dir')
+        list(scanner.scan())
+
+        with mock.patch('os.scandir', side_effect=AssertionError('should not list')):
+            assert _changes(scanner) == set()
+
+
+def test_incremental_scan_reset():
+    with tempdir('dir/sub/subfile', 'dbdir/') as tmp_path:
+        database = SqliteDatabase('snapshot', basepath=tmp_path / 'dbdir')
+        scanner = IncrementalScanner(database, tmp_path / 'dir')
+        first = _changes(scanner)
+
+        scanner.reset()
+
+        assert _changes(scanner) == first
+
+
+def test_incremental_scan_reports_changes():
+    with tempdir('dir/a/b/file', 'dir/a/gone/deep/file', 'dir/c', 'dbdir/') as tmp_path:
+        root = tmp_path / 'dir'
+        database = SqliteDatabase('snapshot', basepath=tmp_path / 'dbdir')
+        scanner = IncrementalScanner(database, root)
+        list(scanner.scan())
+
+        create_path('a/b/new', parent_dir=root, is_dir=False)
+        shutil.rmtree(root / 'a' / 'gone')
+        os.remove(root / 'c')
+        create_path('c', parent_dir=root, is_dir=True)
+        _bump_mtime(root / 'a' / 'b')  # make sure the change is visible with coarse timestamps
+        _bump_mtime(root / 'a')
+        _bump_mtime(root)
+
+        assert _changes(scanner) == {
+            (CHANGE.ADDED, 'a/b/new'),
+            (CHANGE.MODIFIED, 'a/b'),
+            (CHANGE.REMOVED, 'a/gone'),
+            (CHANGE.REMOVED, 'a/gone/deep'),
+            (CHANGE.REMOVED, 'a/gone/deep/file'),
+            (CHANGE.MODIFIED, 'a'),
+            (CHANGE.REMOVED, 'c'),
+            (CHANGE.ADDED, 'c'),
+        }
+        assert _changes(scanner) == set()
+
+
+def test_incremental_scan_keeps_snapshot_when_interrupted():
+    with tempdir('dir/a', 'dir/b', 'dbdir/') as tmp_path:
+        database = SqliteDatabase('snapshot', basepath=tmp_path / 'dbdir')
+        scanner = IncrementalScanner(database, tmp_path / 'dir')
+
+        scan = scanner.scan()
+        next(scan)
+        scan.close()
+
+        assert len(_changes(scanner)) == 2
+
+
+def test_incremental_scan_filters():
+    with tempdir('dir/.hidden/file', 'dir/visible', 'dbdir/') as tmp_path:
+        database = SqliteDatabase('snapshot', basepath=tmp_path / 'dbdir')
+        hidden_file_filter = files.hidden_file_filter()
+        scanner = IncrementalScanner(database, tmp_path / 'dir', filters=[hidden_file_filter])
+
+        assert _changes(scanner) == {(CHANGE.ADDED, 'visible')}
+
+
+def test_incremental_scan_lets_the_caller_write_while_iterating():
+    with tempdir('dir/a/file', 'dir/b', 'dbdir/') as tmp_path:
+        database = SqliteDatabase('snapshot', basepath=tmp_path / 'dbdir')
+        scanner = IncrementalScanner(database, tmp_path / 'dir')
+        with database.transaction() as tx:
+            tx.execute('CREATE TABLE seen(path TEXT)')
+
+        for change, path in scanner.scan():
+            with database.transaction(isolation=ISOLATION.IMMEDIATE, timeout_secs=0.1) as tx:
+                tx.execute('INSERT INTO seen VALUES (?)', (str(path),))
+
+        with database.transaction() as tx:
+            assert len(tx.execute('SELECT path FROM seen')) == 3
+        assert _changes(scanner) == set()
+
+
+def test_incremental_scan_stages_updates_in_batches():
+    with tempdir('dir/' + 'sub/' * 10 + 'file', 'dbdir/') as tmp_path:
+        database = SqliteDatabase('snapshot', basepath=tmp_path / 'dbdir')
+        scanner = IncrementalScanner(database, tmp_path / 'dir')
+        stage = incremental._PendingUpdates.stage
+        buffered = []
+
+        def recording_stage(updates, tx):
+            buffered.append(len(updates))
+            stage(updates, tx)
+
+        with mock.patch.object(incremental, 'UPDATE_BATCH_SIZE', 3), \
+                mock.patch.object(incremental._PendingUpdates, 'stage', recording_stage):
+            interrupted = scanner.scan()
+            for _ in range(8):
+                next(interrupted)
+            interrupted.close()
+            assert len(buffered) > 1
+
+            assert len(_changes(scanner)) == 11
+        assert max(buffered) <= 3 + 2  # a full batch plus the updates of one directory
+        assert _changes(scanner) == set()
@@ -0,0 +1,129 @@
+# -*- coding: UTF-8 -*-
+import os
+from unittest import mock
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.media import files
+from cherrymusic.media.data import Path
+from cherrymusic.media.index import FileIndex
+
+
+def _rows(index):
+    with index.database.transaction() as tx:
+        return {
+            os.path.join(os.fsdecode(parent), os.fsdecode(name)): rest
+            for parent, name, *rest in tx.execute('SELECT * FROM files')
+        }
+
+
+def test_file_index_update_from_scan():
+    with tempdir('music/dir/sub/file', 'music/other', 'db/') as tmp_path:
+        root = tmp_path / 'music'
+        index = FileIndex(SqliteDatabase('index', basepath=tmp_path / 'db'), root)
+
+        assert index.update(files.recursive_scandir(root)) == 4
+
+        rows = _rows(index)
+        stat = os.stat(root / 'dir/sub/file')
+        assert rows.keys() == {'dir', 'dir/sub', 'dir/sub/file', 'other'}
+        assert rows['dir/sub/file'] == [3, 0, stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        assert rows['dir/sub'][:2] == [2, 1]
+        assert len(index) == 4
+
+
+def test_file_index_update_in_batches_within_one_transaction():
+    with tempdir(*[f'music/{i}' for i in range(10)], 'db/') as tmp_path:
+        root = tmp_path / 'music'
+        database = SqliteDatabase('index', basepath=tmp_path / 'db')
+        index = FileIndex(database, root)
+
+        with mock.patch.object(database, 'transaction', wraps=database.transaction) as transaction:
+            with mock.patch('cherrymusic.database.sqlite.SqliteTransaction.executemany',
+                            autospec=True, side_effect=lambda tx, sql, rows: len(rows)) as insert:
+                assert index.update(files.recursive_scandir(root), batch_size=3) == 10
+
+        assert transaction.call_count == 1
+        assert [len(call[0][2]) for call in insert.call_args_list] == [3, 3, 3, 1]
+
+
+def test_file_index_update_uses_stat_from_scan():
+    with tempdir('music/dir/file', 'db/') as tmp_path:
+        root = tmp_path / 'music'
+        index = FileIndex(SqliteDatabase('index', basepath=tmp_path / 'db'), root)
+
+        paths = list(files.recursive_scandir(root, stat=True))
+        assert len(index) == 0  # connects to the database, which needs a stat
+        with mock.patch('os.stat', side_effect=AssertionError('should not stat')):
+            assert index.update(paths) == 2
+
+        stat = os.stat(root / 'dir/file')
+        assert _rows(index)['dir/file'][2:] == [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def test_file_index_update_replace():
+    with tempdir('music/a', 'music/b', 'db/') as tmp_path:
+        root = tmp_path / 'music'
+        index = FileIndex(SqliteDatabase('index', basepath=tmp_path / 'db'), root)
+        index.update(files.recursive_scandir(root))
+
+        index.update([Path('a')])
+        assert _rows(index).keys() == {'a', 'b'}
+
+        index.update([Path('a')], replace=True)
+        assert _rows(index).keys() == {'a'}
+
+
+def test_file_index_remove():
+    paths = ('music/a/b/c', 'music/a/d', 'music/ab/e', 'music/a0', 'db/')
+    with tempdir(*paths) as tmp_path:
+        root = tmp_path / 'music'
+        index = FileIndex(SqliteDatabase('index', basepath=tmp_path / 'db'), root)
+        index.update(files.recursive_scandir(root))
+
+        assert index.remove([Path('a')]) == 4
+        assert _rows(index).keys() == {'ab', 'ab/e', 'a0'}
+
+
+def test_file_index_undecodable_names():
+    with tempdir('db/') as tmp_path:
+        os.makedirs(os.fsencode(tmp_path / 'music') + b'/\xfe')
+        root = tmp_path / 'music'
+        index = FileIndex(SqliteDatabase('index', basepath=tmp_path / 'db'), root)
+
+        index.update(files.recursive_scandir(root))
+
+        with index.database.transaction() as tx:
+            assert tx.execute('SELECT name FROM files') == [(b'\xfe',)]
+
+
+def test_file_index_apply_changes():
+    paths = ('music/a/b/c', 'music/a/d', 'music/ab/e', 'music/x', 'music/gone/f', 'db/')
+    with tempdir(*paths) as tmp_path:
+        root = tmp_path / 'music'
+        database = SqliteDatabase('index', basepath=tmp_path / 'db')
+        index = FileIndex(database, root)
+        index.update(files.recursive_scandir(root))
+        os.rename(root / 'a', root / 'ab/moved')
+        os.mkdir(os.fsencode(root) + b'/\xfe')
+
+        with mock.patch.object(database, 'transaction', wraps=database.transaction) as transaction:
+            index.apply_changes(
+                added=[Path('gone'), Path('x')],
+                removed=[Path('gone')],
+                moved=[(Path('a'), Path('ab/moved')), (Path('x'), Path(b'\xfe/x'))],
+            )
+
+        assert transaction.call_count == 1
+        rows = _rows(index)
+        assert rows.keys() == {
+            'ab', 'ab/e', 'ab/moved', 'ab/moved/b', 'ab/moved/b/c', 'ab/moved/d', 'gone', 'x',
+            os.fsdecode(b'\xfe/x'),
+        }
+        assert rows['ab/moved/b/c'][0] == 4
+        assert rows['ab/moved'][0] == 2
+        assert rows[os.fsdecode(b'\xfe/x')][0] == 2
+
+        index.apply_changes(moved=[(Path(b'\xfe/x'), Path(b'\xfe/y'))])
+        index.apply_changes(moved=[(Path(b'\xfe'), Path('z'))])
+        assert 'z/y' in _rows(index)
@@ -0,0 +1,137 @@
+# -*- coding: UTF-8 -*-
+import shutil
+from unittest import mock
+
+import pytest
+
+from cherrymusic.common.test.helpers import create_path, tempdir
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.media.data import Path
+from cherrymusic.media.incremental import IncrementalScanner
+from cherrymusic.media.listing import DirectoryLister
+from cherrymusic.media.opener import PathEscapeError
+from cherrymusic.media.watcher import Changes
+
+
+def _names(paths):
+    return [path.name for path in paths]
+
+
+@pytest.fixture
+def library():
+    with tempdir('music/b/', 'music/a/x/y/file', 'music/c.mp3', 'music/.hidden', 'db/') as tmp:
+        yield tmp / 'music'
+
+
+def test_list_sorted_filtered_children(library):
+    lister = DirectoryLister(library, stat=True)
+
+    children = lister.list('.')
+    assert _names(children) == ['a', 'b', 'c.mp3']
+    assert [child.is_dir for child in children] == [True, True, False]
+    assert children[2].stat.size == 0
+    assert lister.list(Path('a/x')) == ('a/x/y',)
+
+    with pytest.raises(FileNotFoundError):
+        lister.list('missing')
+    with pytest.raises(NotADirectoryError):
+        lister.list('c.mp3')
+
+
+def test_listings_are_cached(library):
+    lister = DirectoryLister(library)
+    first = lister.list('.')
+
+    with mock.patch('os.scandir', side_effect=AssertionError('should not list')):
+        assert lister.list('.') is first
+
+    stats = lister.stats()
+    assert (stats['hits'], stats['misses'], stats['entries']) == (1, 1, 1)
+    assert stats['hit_rate'] == 0.5
+    assert stats['bytes'] == lister.size > 0
+
+
+def test_cache_limits_and_ttl(library):
+    lister = DirectoryLister(library, max_entries=2)
+    for directory in ('.', 'a', 'a/x'):
+        lister.list(directory)
+    assert len(lister) == 2 and lister.stats()['evictions'] == 1
+
+    lister = DirectoryLister(library, max_bytes=1)
+    lister.list('.')
+    assert len(lister) == 0 and lister.size == 0
+
+    lister = DirectoryLister(library, ttl_secs=10)
+    with mock.patch('time.monotonic', return_value=100):
+        lister.list('.')
+    with mock.patch('time.monotonic', return_value=111):
+        lister.list('.')
+    assert lister.stats()['expirations'] == 1
+
+
+def test_watcher_changes_invalidate_affected_listings(library):
+    lister = DirectoryLister(library)
+
+    def relist(*directories):
+        for directory in directories:
+            lister.list(directory)
+
+    relist('.', 'a', 'a/x', 'a/x/y', 'b')
+    lister.on_changes(Changes([Path('b/new')], [], [], False))
+    assert sorted(lister._cache) == ['.', 'a', 'a/x', 'a/x/y']
+
+    relist('b')
+    lister.on_changes(Changes([], [Path('a/x', is_dir=True)], [], False))
+    assert sorted(lister._cache) == ['.', 'b']
+
+    relist('a', 'a/x', 'a/x/y')
+    lister.on_changes(Changes([], [], [(Path('a/x', is_dir=True), Path('b/x', is_dir=True))],
+                              False))
+    assert sorted(lister._cache) == ['.']
+
+    lister.on_changes(Changes([], [], [], True))
+    assert len(lister) == 0
+
+
+def test_scan_changes_invalidate_affected_listings(library):
+    scanner = IncrementalScanner(SqliteDatabase('snapshot', basepath=library / '..' / 'db'),
+                                 library)
+    lister = DirectoryLister(library)
+    list(lister.scan_changes(scanner.scan()))
+    assert _names(lister.list('a/x')) == ['y']
+    assert _names(lister.list('b')) == []
+    assert _names(lister.list('.')) == ['a', 'b', 'c.mp3']
+
+    create_path('b/new.mp3', parent_dir=library, is_dir=False)
+    shutil.rmtree(library / 'a' / 'x')
+    changes = list(lister.scan_changes(scanner.scan()))
+
+    assert changes
+    assert sorted(lister._cache) == ['.']
+    assert _names(lister.list('b')) == ['new.mp3']
+    assert _names(lister.list('a')) == []
+
+
+def test_changes_while_reading_are_not_cached(library):
+    lister = DirectoryLister(library)
+    read = lister._read
+
+    def read_with_concurrent_change(directory):
+        children = read(directory)
+        lister.invalidate(directory)
+        return children
+
+    with mock.patch.object(lister, '_read', read_with_concurrent_change):
+        lister.list('.')
+    assert len(lister) == 0
+
+
+@pytest.mark.parametrize('directory', ['..', 'a/../..', '../music', '/', 'a/\0'])
+def test_list_rejects_paths_outside_the_root(library, directory):
+    lister = DirectoryLister(library / 'a')
+
+    with pytest.raises(PathEscapeError):
+        lister.list(directory)
+    with pytest.raises(PathEscapeError):
+        lister.list(Path(directory))
+    assert len(lister) == 0
@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+import errno
+import os
+import shutil
+from unittest import mock
+
+import pytest
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.media.data import Path
+from cherrymusic.media.opener import PathEscapeError, SecureOpener
+
+
+@pytest.fixture
+def tree():
+    with tempdir('root/dir/file', 'root/top', 'outside/secret', 'extra/album/track') as tmp_path:
+        root = tmp_path / 'root'
+        os.symlink(tmp_path / 'outside' / 'secret', root / 'dir' / 'absolute_secret')
+        os.symlink(os.path.join('..', '..', 'outside', 'secret'), root / 'dir' / 'secret')
+        os.symlink(tmp_path / 'outside', root / 'outside')
+        os.symlink(tmp_path / 'extra' / 'album', root / 'album')
+        os.symlink(os.path.join('..', 'extra', 'album'), root / 'relative_album')
+        os.symlink('file', root / 'dir' / 'same_dir')
+        os.symlink(os.path.join('..', 'top'), root / 'dir' / 'up')
+        os.symlink('loop', root / 'loop')
+        yield tmp_path
+
+
+def _opens_same_file(opener, path):
+    fd = opener.open(path)
+    try:
+        return os.path.samestat(os.fstat(fd), os.stat(os.path.join(opener.root, path)))
+    finally:
+        os.close(fd)
+
+
+@pytest.mark.parametrize('path', [
+    'dir/file', Path('top'), 'dir/same_dir', 'dir/up', 'album/track', 'relative_album/track',
+    'dir/../top', 'dir', '.', 'dir/..',
+])
+def test_open_inside_allowed_roots(tree, path):
+    with SecureOpener(tree / 'root', allowed_roots=[tree / 'extra']) as opener:
+        assert _opens_same_file(opener, path)
+        assert _opens_same_file(opener, path)  # again, from the cached directory
+
+
+@pytest.mark.parametrize('path', [
+    'dir/absolute_secret', 'dir/secret', 'outside/secret', '../outside/secret', '..',
+    str(os.path.abspath(os.sep)), 'album/track',
+])
+def test_open_outside_allowed_roots(tree, path):
+    with SecureOpener(tree / 'root') as opener:
+        with pytest.raises(PathEscapeError):
+            opener.open(path)
+
+
+@pytest.mark.parametrize('path, error', [
+    ('missing', FileNotFoundError), ('dir/file/more', NotADirectoryError),
+])
+def test_open_errors(tree, path, error):
+    with SecureOpener(tree / 'root') as opener:
+        with pytest.raises(error):
+            opener.open(path)
+        with pytest.raises(OSError) as info:
+            opener.open('loop')
+        assert info.value.errno == errno.ELOOP
+
+
+def test_cached_directories_are_checked(tree):
+    root = tree / 'root'
+    with SecureOpener(root, max_directories=1) as opener:
+        os.close(opener.open('dir/file'))
+        os.close(opener.open('dir/file'))
+        assert (opener.hits, opener.misses) == (1, 1)
+
+        shutil.rmtree(root / 'dir')
+        os.symlink(tree / 'outside', root / 'dir')  # swapped for a symlink out of the root
+        with pytest.raises(PathEscapeError):
+            opener.open('dir/secret')
+
+        stats = opener.stats()
+        assert stats['entries'] == 0 and stats['hits'] == 1
+
+
+def test_close_releases_descriptors(tree):
+    opener = SecureOpener(tree / 'root', allowed_roots=[tree / 'extra', tree / 'root'])
+    before = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+    for path in ('dir/file', 'album/track', 'relative_album/track', 'dir/up'):
+        os.close(opener.open(path))
+    opener.close()
+    if before is not None:
+        assert len(os.listdir('/proc/self/fd')) == before
+    os.close(opener.open('dir/file'))  # reopened on demand
+    opener.close()
+
+
+def test_failed_directory_check_releases_descriptors(tree):
+    with SecureOpener(tree / 'root') as opener:
+        os.close(opener.open('top'))
+        before = len(os.listdir('/proc/self/fd')) if os.path.isdir('/proc/self/fd') else None
+        with mock.patch('os.stat', side_effect=PermissionError(errno.EACCES, 'denied')):
+            with pytest.raises(PermissionError):
+                opener.open('dir/file')
+        if before is not None:
+            assert len(os.listdir('/proc/self/fd')) == before
+        assert opener.stats()['entries'] == 0
@@ -0,0 +1,106 @@
+# -*- coding: UTF-8 -*-
+import os
+from unittest import mock
+
+import pytest
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.media import files, tags
+from cherrymusic.media.data import Path
+from cherrymusic.media.test import audiofiles
+
+VORBIS_TAGS = {
+    'TITLE': 'Título', 'ARTIST': 'Artist', 'ALBUM': 'Album', 'TRACKNUMBER': '3/12',
+    'DATE': '1999', 'GENRE': 'Rock',
+}
+MP4_TAGS = {b'\xa9nam': 'Título', b'\xa9ART': 'Artist', b'\xa9alb': 'Album', b'\xa9day': '1999'}
+ID3_TAGS = {'TIT2': 'Título', 'TPE1': 'Artist', 'TALB': 'Album', 'TRCK': '3/12', 'TLEN': '180000'}
+ID3V22_TAGS = {'TT2': 'Título', 'TP1': 'Artist', 'TAL': 'Album', 'TRK': '3'}
+
+
+@pytest.mark.parametrize('data, expected', [
+    (audiofiles.mp3(ID3_TAGS, version=4, picture_size=5000), {'format': 'id3', 'duration': 180}),
+    (audiofiles.mp3(ID3_TAGS, version=3), {'format': 'id3', 'duration': 180}),
+    (audiofiles.mp3(ID3V22_TAGS, version=2), {'format': 'id3'}),
+    (audiofiles.id3v1('Título', 'Artist', 'Album', '1999', 3),
+     {'format': 'id3v1', 'date': '1999'}),
+    (audiofiles.flac(VORBIS_TAGS, picture_size=5000),
+     {'format': 'flac', 'date': '1999', 'genre': 'Rock', 'duration': 180}),
+    (audiofiles.ogg(VORBIS_TAGS), {'format': 'vorbis', 'date': '1999', 'duration': 180}),
+    (audiofiles.ogg(VORBIS_TAGS, codec='opus'), {'format': 'opus', 'duration': 180}),
+    (audiofiles.mp4(MP4_TAGS, track=3), {'format': 'mp4', 'date': '1999', 'duration': 180}),
+])
+def test_read_tags(tmp_path, data, expected):
+    filename = tmp_path / 'file'
+    filename.write_bytes(data)
+
+    result = tags.read_tags(filename)
+
+    assert result.keys() == set(tags.FIELDS)
+    assert (result['title'], result['artist'], result['album']) == ('Título', 'Artist', 'Album')
+    assert result['track'] == 3
+    assert {key: result[key] for key in expected} == expected
+
+
+@pytest.mark.parametrize('data', [
+    b'', b'not audio', b'ID3\x04\0\0\0\0\x7f\x7f', b'OggS' * 10,
+    b'fLaC\x84\0\0\x08' + b'\0\0\0\0' + b'\xff\xff\xff\xff',  # comment count beyond the block
+    b'fLaC\x84\0\0\x0c' + b'\0\0\0\0' + b'\x01\0\0\0' + b'\xff\0\0\0',  # truncated comment
+    b'fLaC\x84\0\0\x04' + b'\x10\0\0\0',  # vendor string beyond the block
+])
+def test_read_tags_unknown_or_malformed(tmp_path, data):
+    filename = tmp_path / 'file'
+    filename.write_bytes(data)
+    assert tags.read_tags(filename) == dict.fromkeys(tags.FIELDS)
+
+
+def test_read_tags_unreadable(tmp_path):
+    assert tags.read_tags(tmp_path / 'missing') is None
+
+
+def _run_inline(max_workers=None):
+    """Stand-in for ProcessPoolExecutor that runs in the test process, to count calls"""
+    executor = mock.Mock()
+    executor.map.side_effect = lambda function, items, chunksize: map(function, items)
+    return executor
+
+
+def test_tag_cache_reads_unchanged_files_once():
+    with tempdir('music/dir/', 'music/cover.jpg', 'db/') as tmp_path:
+        root = tmp_path / 'music'
+        (root / 'a.flac').write_bytes(audiofiles.flac(VORBIS_TAGS))
+        (root / 'dir/b.mp3').write_bytes(audiofiles.mp3(ID3_TAGS))
+        (root / 'dir/c.ogg').write_bytes(b'broken')
+        cache = tags.TagCache(SqliteDatabase('tags', basepath=tmp_path / 'db'), root)
+
+        with mock.patch.object(tags, 'ProcessPoolExecutor', side_effect=_run_inline), \
+                mock.patch.object(tags, 'read_tags', wraps=tags.read_tags) as read_tags:
+            assert cache.update(files.recursive_scandir(root, stat=True), batch_size=2) == 3
+            assert cache.update(files.recursive_scandir(root)) == 0
+
+            stat = os.stat(root / 'a.flac')
+            os.utime(root / 'a.flac', ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+            assert cache.update(files.recursive_scandir(root)) == 1
+
+        assert read_tags.call_count == 4
+        assert len(cache) == 3
+        assert cache.get(Path('a.flac'))['title'] == 'Título'
+        assert cache.get(Path('dir/b.mp3'))['track'] == 3
+        assert cache.get(Path('dir/c.ogg'))['format'] is None
+        assert cache.get(Path('cover.jpg')) is None
+
+        assert cache.remove([Path('dir')]) == 2
+        assert len(cache) == 1
+
+
+def test_tag_cache_uses_process_pool():
+    with tempdir('music/', 'db/') as tmp_path:
+        root = tmp_path / 'music'
+        for number in range(10):
+            (root / f'{number}.mp3').write_bytes(audiofiles.mp3({'TIT2': str(number)}))
+        cache = tags.TagCache(SqliteDatabase('tags', basepath=tmp_path / 'db'), root)
+
+        assert cache.update(files.recursive_scandir(root), max_workers=2, batch_size=3) == 10
+
+        assert cache.get(Path('7.mp3'))['title'] == '7'
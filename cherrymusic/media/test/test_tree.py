@@ -0,0 +1,88 @@
+# -*- coding: UTF-8 -*-
+import os
+
+import pytest
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.media import files
+from cherrymusic.media.data import Path
+from cherrymusic.media.tree import PathNode, PathTree
+
+
+def test_node_attributes():
+    tree = PathTree()
+    node = tree.node('SOME/PARENT/./SOME_NAME/', is_dir=False)
+
+    assert node.name == 'SOME_NAME'
+    assert node.parent == 'SOME/PARENT'
+    assert node.path == os.fspath(node) == 'SOME/PARENT/SOME_NAME'
+    assert node.depth == 3
+    assert node.is_dir is False
+    assert node.parent_node.parent_node.name == 'SOME'
+    assert repr(node) == "PathNode('SOME/PARENT/SOME_NAME')"
+
+    assert tree.root.path == '.'
+    assert tree.root.parent == ''
+    assert tree.node('.') is tree.root
+    assert tree.node(b'.', is_dir=True).is_dir is True
+
+    with pytest.raises(AttributeError):
+        node.name = 'OTHER'
+    with pytest.raises(ValueError):
+        tree.node('../OUTSIDE')
+
+
+def test_make_child_shares_parent_and_names():
+    tree = PathTree()
+    parent = tree.node('PARENT')
+    first = parent.make_child('NAME', is_dir=False)
+    second = tree.node('OTHER').make_child(''.join(['NA', 'ME']))
+
+    assert first.parent_node is parent
+    assert first.depth == 2
+    assert first.name is second.name  # interned in the tree
+    assert parent.make_child('SUB/./NAME') == 'PARENT/SUB/NAME'
+    assert parent.make_child('SUB/NAME').depth == 3
+    assert tree.root.make_child('NAME').path == 'NAME'
+
+
+def test_children_from_scandir():
+    tree = PathTree()
+    parent = tree.node('PARENT', is_dir=True)
+    with tempdir('file', 'sub/') as tmp_path:
+        with os.scandir(tmp_path) as dir_entries:
+            entries = sorted(dir_entries, key=lambda entry: entry.name)
+        children = PathNode.children_from_scandir(parent, entries)
+
+    assert children == ['PARENT/file', 'PARENT/sub']
+    assert all(child.parent_node is parent and child.depth == 2 for child in children)
+    assert [child.is_dir for child in children] == [False, True]
+    assert [child.is_symlink for child in children] == [False, False]
+    assert children[0].name is tree.intern('file')
+
+
+def test_node_equals_path():
+    tree = PathTree()
+    node = tree.node('FOO/BAR')
+
+    assert node == tree.node('FOO').make_child('BAR')
+    assert node == PathTree().node('FOO/BAR')
+    assert node != tree.node('FOO/BAZ')
+    assert node != tree.node('BAR')
+    assert node == Path('FOO/BAR') and Path('FOO/BAR') == node
+    assert node == 'FOO/BAR'
+    assert node != object()
+    assert hash(node) == hash(Path('FOO/BAR'))
+    assert bytes(node) == b'FOO/BAR'
+    assert node.as_url == Path('FOO/BAR').as_url
+    assert str(tree.node(b'BAD\xfe')) == str(Path(b'BAD\xfe'))
+
+
+@pytest.mark.parametrize('scan', [files.recursive_scandir, files.parallel_recursive_scandir])
+def test_scan_into_tree(scan):
+    with tempdir('test_scan_into_tree', 'dir/subdir/subfile', 'file') as tmp_path:
+        expected = set(files.recursive_scandir(tmp_path))
+        found = list(scan(tmp_path, tree=PathTree()))
+        assert all(isinstance(path, PathNode) for path in found)
+        assert set(found) == expected
+        assert {path.depth for path in found} == {path.depth for path in expected}
@@ -0,0 +1,171 @@
+# -*- coding: UTF-8 -*-
+import errno
+import os
+import queue
+import shutil
+from unittest import mock
+
+import pytest
+
+from cherrymusic.common.test.helpers import create_path, tempdir
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.media import watcher
+from cherrymusic.media.data import Path
+from cherrymusic.media.index import FileIndex
+
+
+def _rows(index):
+    with index.database.transaction() as tx:
+        return {
+            os.path.join(os.fsdecode(parent), os.fsdecode(name))
+            for parent, name in tx.execute('SELECT parent, name FROM files')
+        }
+
+
+@pytest.fixture
+def watched():
+    """Yield a function that starts a watcher on a temporary root, and a queue of its changes"""
+    with tempdir('music/', 'db/') as tmp_path:
+        changes = queue.Queue()
+        watchers = []
+
+        def start(**kwargs):
+            index = FileIndex(SqliteDatabase('index', basepath=tmp_path / 'db'), tmp_path / 'music')
+            kwargs.setdefault('debounce_secs', 0.05)
+            watcher_ = watcher.Watcher(index, on_changes=changes.put, **kwargs)
+            watcher_.start()
+            watchers.append(watcher_)
+            assert watcher_.ready.wait(5)
+            assert changes.get(timeout=5).rescanned
+            return tmp_path / 'music', watcher_
+
+        start.changes = lambda: changes.get(timeout=5)
+        yield start
+        for watcher_ in watchers:
+            watcher_.stop()
+
+
+def test_batch_coalesces_changes():
+    batch = watcher._Batch()
+    batch.add(Path('new'))
+    batch.remove(Path('new'))
+    batch.add(Path('dir/a'))
+    batch.remove(Path('dir/a'))
+    batch.remove(Path('dir'))
+    batch.add(Path('dir'))
+    changes = batch.changes()
+    assert changes.added == ['dir']
+    assert changes.removed == ['new', 'dir']  # removals are applied first, and are idempotent
+    assert changes.moved == []
+
+
+def test_batch_moves():
+    batch = watcher._Batch()
+    batch.add(Path('created/file'))
+    batch.move(Path('created'), Path('renamed'))
+    batch.move(Path('a'), Path('b'))
+    batch.move(Path('b'), Path('c'))
+    batch.add(Path('a'))
+    changes = batch.changes()
+    assert set(changes.added) == {'renamed/file', 'a'}
+    assert changes.moved == [('created', 'renamed'), ('a', 'b'), ('b', 'c')]
+
+    batch.remove(Path('c'))
+    changes = batch.changes()
+    assert changes.moved == [('created', 'renamed')]
+    # a has been recreated after it was moved, and b and c might have been renamed over
+    assert set(changes.removed) == {'a', 'b', 'c'}
+    assert changes.added == ['renamed/file']
+
+
+def test_batch_remove_after_move_away():
+    batch = watcher._Batch()
+    batch.move(Path('a'), Path('b'))
+    batch.add(Path('a'))
+    batch.remove(Path('a'))  # not the original a, which is b now
+    assert batch.changes() == ([], [], [('a', 'b')], False)
+
+
+def test_watcher_applies_changes(watched):
+    root, watcher_ = watched()
+
+    # moved in from outside the watched tree, all at once
+    os.rename(create_path('staging/dir/sub/file', parent_dir=root.parent, is_dir=False)
+              .parent.parent, root / 'dir')
+    assert set(watched.changes().added) == {'dir', 'dir/sub', 'dir/sub/file'}
+    assert _rows(watcher_.index) == {'dir', 'dir/sub', 'dir/sub/file'}
+
+    os.rename(root / 'dir', root / 'renamed')
+    changes = watched.changes()
+    assert changes.moved == [('dir', 'renamed')]
+    assert _rows(watcher_.index) == {'renamed', 'renamed/sub', 'renamed/sub/file'}
+
+    create_path('renamed/sub/new', parent_dir=root, is_dir=False)  # watches follow renames
+    os.remove(root / 'renamed/sub/file')
+    changes = watched.changes()
+    assert changes.added == ['renamed/sub/new']
+    assert changes.removed == ['renamed/sub/file']
+
+    shutil.move(str(root / 'renamed'), str(root.parent / 'db'))  # out of the watched tree
+    assert watched.changes().removed == ['renamed']
+    assert _rows(watcher_.index) == set()
+
+
+def test_watcher_filters(watched):
+    root, watcher_ = watched()
+    create_path('.hidden/file', parent_dir=root, is_dir=False)
+    create_path('visible', parent_dir=root, is_dir=False)
+    os.symlink(root, root / 'loop')
+    os.rename(root / 'visible', root / '.now_hidden')
+    create_path('last', parent_dir=root, is_dir=False)
+
+    for _ in range(10):
+        if 'last' in _rows(watcher_.index):
+            break
+        watched.changes()
+    assert _rows(watcher_.index) == {'last'}
+    assert set(watcher_._wds) == {'.'}
+
+
+def test_watcher_builds_filters_once_per_batch(watched):
+    root, watcher_ = watched(debounce_secs=0.2)
+    names = {f'file{number}' for number in range(50)}
+    with mock.patch.object(watcher, 'circular_symlink_filter',
+                           wraps=watcher.circular_symlink_filter) as symlink_filter:
+        for name in names:
+            create_path(name, parent_dir=root, is_dir=False)
+        while _rows(watcher_.index) != names:
+            watched.changes()
+
+    assert 1 <= symlink_filter.call_count < 10  # instead of at least once per event
+
+
+def test_watcher_falls_back_to_polling(watched):
+    no_space = OSError(errno.ENOSPC, 'No space left on device')
+    with mock.patch.object(watcher._Inotify, 'add_watch', side_effect=no_space):
+        root, watcher_ = watched(poll_interval_secs=0.05)
+
+    assert watcher_.polling
+    os.rename(create_path('staging/dir/file', parent_dir=root.parent, is_dir=False).parent,
+              root / 'dir')
+    assert set(watched.changes().added) == {'dir', 'dir/file'}
+    shutil.rmtree(root / 'dir')
+    assert set(watched.changes().removed) >= {'dir'}
+    assert _rows(watcher_.index) == set()
+
+
+def test_watcher_rescans_on_overflow(watched):
+    root, watcher_ = watched()
+    create_path('file', parent_dir=root, is_dir=False)
+    watched.changes()
+
+    read_events = watcher._Inotify.read_events
+
+    def overflow(inotify):
+        read_events(inotify)  # drop the actual events
+        return [(-1, watcher.IN_Q_OVERFLOW, 0, b'')]
+
+    with mock.patch.object(watcher._Inotify, 'read_events', autospec=True, side_effect=overflow):
+        create_path('other', parent_dir=root, is_dir=False)
+        assert watched.changes().rescanned
+    assert _rows(watcher_.index) == {'file', 'other'}
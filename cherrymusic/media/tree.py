@@ -0,0 +1,191 @@
+# -*- coding: UTF-8 -*-
+import os
+
+from cherrymusic.common.types import CachedSlotProperty
+
+from .data import Path
+
+
+class PathTree:
+    """Arena for :class:`PathNode` objects with shared parents and a private table of names
+
+    Every node only stores its own name and a reference to its parent node, so a node takes
+    the same amount of memory no matter how deep it is in the tree. Names are interned in a
+    table that belongs to the tree, which means they get released along with it instead of
+    staying in the interpreter-wide table of :func:`sys.intern` for good.
+
+    Nodes are created top down, by :meth:`node` or :meth:`PathNode.make_child`; there are no
+    references from parents to their children.
+    """
+
+    def __init__(self):
+        self._names = {}
+        self.root = PathNode('.', None, self, 0)
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}(names={len(self._names)})'
+
+    def intern(self, name):
+        """Return the tree's copy of a string equal to ``name``"""
+        return self._names.setdefault(name, name)
+
+    def node(self, path, **kwargs):
+        """Return a node for a relative path, creating nodes for all its parent directories
+
+        Args:
+            path: A path-like object (``str``, ``bytes``, :class:`~cherrymusic.media.data.Path`
+                or :class:`PathNode`); it gets normalized like a :class:`Path`
+            kwargs: ``is_dir``, ``is_symlink`` and ``stat`` of the final node, if known
+
+        Raises:
+            ValueError: if the path is absolute or leads outside of the root
+        """
+        path = Path(path).path
+        if os.path.isabs(path) or path == '..' or path.startswith('..' + os.path.sep):
+            raise ValueError(f'Path must be relative and inside the root: {path!r}')
+        node = self.root
+        if path == '.':
+            return node._with(**kwargs) if kwargs else node
+        names = path.split(os.path.sep)
+        for name in names[:-1]:
+            node = PathNode(self.intern(name), node, self, node.depth + 1)
+        return PathNode(self.intern(names[-1]), node, self, node.depth + 1, **kwargs)
+
+
+class PathNode:
+    """A relative path as a node in a :class:`PathTree`, with the same interface as a :class:`Path`
+
+    Attributes like :attr:`path` and :attr:`parent` are rebuilt from the chain of parent nodes
+    on every access instead of being cached, which takes time proportional to the depth of the
+    node. Nodes compare and hash equal to :class:`Path` objects and strings of the same path.
+    """
+
+    __slots__ = ('name', 'parent_node', 'tree', 'depth', '_is_dir', '_is_symlink', '_stat')
+
+    _presettable = ('is_dir', 'is_symlink', 'stat')
+
+    def __init__(self, name, parent_node, tree, depth, **kwargs):
+        setattr_ = object.__setattr__
+        setattr_(self, 'name', name)
+        setattr_(self, 'parent_node', parent_node)
+        setattr_(self, 'tree', tree)
+        setattr_(self, 'depth', depth)
+        self._preset(**kwargs)
+
+    _preset = Path._preset
+
+    def __setattr__(self, key, *args, **kwargs):
+        raise AttributeError(f"Can't modify {type(self).__name__}.{key}, attributes are read-only.")
+
+    __delattr__ = __setattr__
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.path!r})'
+
+    def _with(self, **kwargs):
+        """Return a copy of this node with other ``is_dir``, ``is_symlink`` or ``stat`` values"""
+        return type(self)(self.name, self.parent_node, self.tree, self.depth, **kwargs)
+
+    @CachedSlotProperty
+    def is_dir(self):
+        return os.path.isdir(self)
+
+    @CachedSlotProperty
+    def is_symlink(self):
+        return os.path.islink(self)
+
+    stat = CachedSlotProperty(Path.stat.getter)
+
+    def make_child(self, other, **kwargs):
+        is_simple_name = (
+            isinstance(other, str) and
+            other not in ('', '.', '..') and
+            os.path.sep not in other and
+            not (os.path.altsep and os.path.altsep in other)
+        )
+        if not is_simple_name:
+            return self.tree.node(Path(other, parent=self.path), **kwargs)
+        name = self.tree.intern(os.path.normcase(other))
+        return type(self)(name, self, self.tree, self.depth + 1, **kwargs)
+
+    @classmethod
+    def children_from_scandir(cls, parent, entries, *, accept=None, stat_entry=None):
+        """Return a list of child nodes for the :func:`os.scandir` entries of a directory node
+
+        See :meth:`Path.children_from_scandir <cherrymusic.media.data.Path.children_from_scandir>`.
+        """
+        slots = PathNode.__dict__
+        new = cls.__new__
+        set_name, set_parent, set_tree, set_depth, set_is_dir, set_is_symlink, set_stat = (
+            slots[slot].__set__
+            for slot in ('name', 'parent_node', 'tree', 'depth', '_is_dir', '_is_symlink', '_stat')
+        )
+        tree = parent.tree
+        intern = tree.intern
+        depth = parent.depth + 1
+        children = []
+        for entry in entries:
+            child = new(cls)
+            set_name(child, intern(os.path.normcase(entry.name)))
+            set_parent(child, parent)
+            set_tree(child, tree)
+            set_depth(child, depth)
+            set_is_dir(child, entry.is_dir())
+            set_is_symlink(child, entry.is_symlink())
+            if accept is not None and not accept(child):
+                continue
+            if stat_entry is not None:
+                set_stat(child, stat_entry(entry))
+            children.append(child)
+        return children
+
+    def _names(self):
+        """Return the names of all nodes from the top directory down to this one"""
+        names = []
+        node = self
+        while node.parent_node is not None:
+            names.append(node.name)
+            node = node.parent_node
+        names.reverse()
+        return names
+
+    @property
+    def parent(self):
+        return os.path.sep.join(self._names()[:-1])
+
+    @property
+    def path(self):  # may contain surrogates from errors='surrogateescape'
+        return os.path.sep.join(self._names()) or '.'
+
+    display = property(Path.display.getter)
+    as_url = property(Path.as_url.getter)
+
+    __bytes__ = Path.__bytes__
+    __str__ = Path.__str__
+
+    def __fspath__(self):
+        return self.path
+
+    def __hash__(self):
+        return hash(self.path)
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, PathNode):  # shortcut: compare names without building paths
+            while self.name == other.name and self.depth == other.depth:
+                self, other = self.parent_node, other.parent_node
+                if self is other:
+                    return True
+            return False
+        if isinstance(other, (str, bytes, os.PathLike)):
+            return os.fspath(self) == os.fspath(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return NotImplemented
+        return not equal
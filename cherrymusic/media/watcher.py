@@ -0,0 +1,488 @@
+# -*- coding: UTF-8 -*-
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from .data import Path, decode_path
+from .files import circular_symlink_filter, combine_filters, hidden_file_filter, list_directory
+from .incremental import CHANGE, IncrementalScanner
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DEBOUNCE_SECS = 0.5
+DEFAULT_MAX_DELAY_SECS = 5.0
+DEFAULT_POLL_INTERVAL_SECS = 60.0
+
+# inotify constants from <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+WATCH_MASK = (
+    IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB | IN_ONLYDIR |
+    IN_EXCL_UNLINK
+)
+
+_event_header = struct.Struct('iIII')  # struct inotify_event: wd, mask, cookie, len, name[len]
+
+Changes = namedtuple('Changes', 'added removed moved rescanned')
+Changes.__doc__ = '''A batch of changes to the paths below a watched root
+
+Attributes:
+    added: A list of paths that were added or modified
+    removed: A list of paths that were removed, along with everything below them
+    moved: A list of ``(old_path, new_path)`` pairs, in the order the moves happened
+    rescanned: ``True`` if the index was rebuilt from a full scan, which means any state
+        derived from earlier changes is stale; all other fields are empty in that case
+'''
+
+
+class _Inotify:
+    """Minimal binding of the Linux inotify API via ctypes
+
+    Raises:
+        OSError: if inotify is not available, or the limit of inotify instances is reached
+    """
+
+    def __init__(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            init = libc.inotify_init1
+            self._add_watch = libc.inotify_add_watch
+            self._rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError) as error:
+            raise OSError(errno.ENOSYS, f'inotify is not available: {error}') from error
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._rm_watch.argtypes = (ctypes.c_int, ctypes.c_int)
+        self.fd = init(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise self._error()
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}(fd={self.fd})'
+
+    @staticmethod
+    def _error(path=None):
+        code = ctypes.get_errno()
+        return OSError(code, os.strerror(code), path)
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """Watch a path; return its watch descriptor, which is the same for every path to a file"""
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise self._error(path)
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)  # fails if the watch is already gone, which is fine
+
+    def read_events(self):
+        """Return a list of available ``(wd, mask, cookie, name)`` events, without blocking"""
+        try:
+            buffer = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buffer):
+            wd, mask, cookie, length = _event_header.unpack_from(buffer, offset)
+            offset += _event_header.size
+            name = buffer[offset:offset + length].rstrip(b'\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+def _is_below(path, ancestor):
+    """Return whether path is ancestor or below it, both given as strings"""
+    return path == ancestor or path.startswith(ancestor + os.path.sep)
+
+
+def _rebase(path, old, new):
+    """Return a copy of a :class:`Path` below ``old`` that is below ``new`` instead"""
+    return Path(new.path + path.path[len(old.path):], is_dir=path.is_dir,
+                is_symlink=path.is_symlink)
+
+
+class _Batch:
+    """Coalesces a burst of changes into their net effect on the index
+
+    The changes get applied to the index as removals first, then moves in order, then additions.
+    Every method keeps the batch in a state where that order produces the same result as
+    applying the changes as they happened.
+    """
+
+    def __init__(self):
+        self.added = {}
+        self.removed = {}
+        self.moved = []
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.moved)
+
+    def add(self, path):
+        self.added[path.path] = path
+
+    def remove(self, path):
+        key = path.path
+        self._drop_added(key)
+        moved_here = [move for move in self.moved if _is_below(move[1].path, key)]
+        for move in moved_here:
+            # moved here and gone now: same as if it was removed at its old location
+            if move in self.moved:
+                self.moved.remove(move)
+                self.remove(move[0])
+        if any(_is_below(key, old.path) for old, _ in self.moved):
+            return  # only created after its old occupant was moved away: not in the index
+        for removed in list(self.removed):
+            if _is_below(removed, key):
+                del self.removed[removed]
+        self.removed[key] = path
+
+    def move(self, old, new):
+        self._drop_added(new.path)  # replaced by the moved path
+        renamed = [_rebase(path, old, new)
+                   for key, path in self.added.items() if _is_below(key, old.path)]
+        self._drop_added(old.path)
+        self.added.update((path.path, path) for path in renamed)
+        # in case old is not in the index because it was created in this batch, moving it
+        # there does nothing, and its new rows are added afterwards
+        self.moved.append((old, new))
+
+    def _drop_added(self, key):
+        for added in list(self.added):
+            if _is_below(added, key):
+                del self.added[added]
+
+    def changes(self):
+        return Changes(list(self.added.values()), list(self.removed.values()), list(self.moved),
+                       False)
+
+
+class Watcher:
+    """Keep a :class:`~cherrymusic.media.index.FileIndex` in sync with its root directory
+
+    A background thread watches the root directory and all of its subdirectories with inotify.
+    Events are coalesced into batches: a batch is applied to the index in a single transaction
+    once no new events arrived for ``debounce_secs``, or at the latest ``max_delay_secs`` after
+    its first event. Renamed files and directories are moved in the index, instead of being
+    removed and added again.
+
+    Paths rejected by ``filters`` are not indexed or watched. Symlinks to directories are
+    skipped like :func:`~cherrymusic.media.files.circular_symlink_filter` would, and so is any
+    other directory that is already watched by a different path.
+
+    If inotify is not available, or if the limit of inotify watches or instances is reached,
+    the watcher switches to polling with an
+    :class:`~cherrymusic.media.incremental.IncrementalScanner` every ``poll_interval_secs``.
+    If the kernel drops events because they arrived too fast, the index is rebuilt from a
+    full scan.
+
+    Args:
+        index: The :class:`~cherrymusic.media.index.FileIndex` to update; the snapshot for
+            polling is kept in the same database
+        filters: Filters for paths, like for :func:`~cherrymusic.media.files.recursive_scandir`;
+            defaults to :func:`~cherrymusic.media.files.hidden_file_filter`. Filters must not keep
+            state between calls, since they can see the same path again.
+        debounce_secs: Time without new events after which a batch gets applied
+        max_delay_secs: Maximum time between the first event of a batch and applying it
+        poll_interval_secs: Time between two scans when polling
+        on_changes: Called with the :class:`Changes` of a batch after it has been applied, on the
+            watcher thread
+    """
+
+    def __init__(self, index, *, filters=None, debounce_secs=DEFAULT_DEBOUNCE_SECS,
+                 max_delay_secs=DEFAULT_MAX_DELAY_SECS,
+                 poll_interval_secs=DEFAULT_POLL_INTERVAL_SECS, on_changes=None):
+        self.index = index
+        self.root = index.root
+        self.filters = tuple(filters) if filters is not None else (hidden_file_filter(),)
+        self._accept_known = combine_filters(self.filters, self.root)  # without symlink checks
+        self.debounce_secs = debounce_secs
+        self.max_delay_secs = max_delay_secs
+        self.poll_interval_secs = poll_interval_secs
+        self.on_changes = on_changes
+        self.polling = False
+        self.ready = threading.Event()  # set after the initial scan
+        self._stop = threading.Event()
+        self._thread = None
+        self._inotify = None
+        self._watches = {}  # wd -> watched directory Path
+        self._wds = {}  # watched directory path string -> wd
+        self._move_sources = {}  # inotify cookie -> Path moved away, waiting for its move target
+        self._overflowed = False
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.index!r})'
+
+    def start(self):
+        """Start watching on a background thread, beginning with a full scan to fill the index"""
+        assert self._thread is None, 'already started'
+        self._thread = threading.Thread(target=self.run, name=repr(self), daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Apply pending changes and stop watching"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def run(self):
+        """Watch until stopped; this is what the thread started by :meth:`start` runs"""
+        try:
+            try:
+                self._inotify = _Inotify()
+                self._rescan()
+                self.ready.set()
+                self._watch_events()
+            except OSError as error:
+                if error.errno not in (errno.ENOSPC, errno.EMFILE, errno.ENOSYS):
+                    raise
+                log.warning('Cannot watch %r for changes (%s), polling every %ss instead',
+                            self.root, error, self.poll_interval_secs)
+                self._close_inotify()
+                self.polling = True
+                self._poll(reset=True)
+                self.ready.set()
+                while not self._stop.wait(self.poll_interval_secs):
+                    self._poll()
+        finally:
+            self._close_inotify()
+            self.ready.set()
+
+    def _close_inotify(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+        self._watches.clear()
+        self._wds.clear()
+        self._move_sources.clear()
+
+    def _accepts(self):
+        """Return a predicate for new paths, with a fresh circular_symlink_filter
+
+        Building it resolves the root, so it is built once per scan or batch of events.
+        """
+        return combine_filters(self.filters + (circular_symlink_filter(self.root),), self.root)
+
+    def _apply(self, changes):
+        if changes.added or changes.removed or changes.moved:
+            self.index.apply_changes(added=changes.added, removed=changes.removed,
+                                     moved=changes.moved)
+            if self.on_changes:
+                self.on_changes(changes)
+
+    def _rescan(self):
+        """Watch the whole tree from scratch, and rebuild the index from it"""
+        for wd in list(self._watches):
+            self._inotify.rm_watch(wd)
+        self._watches.clear()
+        self._wds.clear()
+        self._move_sources.clear()
+        self._overflowed = False
+        self.index.update(self._watch_tree(Path('.', is_dir=True), self._accepts()),
+                          replace=True)
+        if self.on_changes:
+            self.on_changes(Changes([], [], [], True))
+
+    # -- polling
+
+    def _poll(self, *, reset=False):
+        # the circular symlink filter has state, so every scan needs a new one
+        scanner = IncrementalScanner(self.index.database, self.root,
+                                     filters=self.filters + (circular_symlink_filter(self.root),))
+        if reset:
+            scanner.reset()
+            added = [path for change, path in scanner.scan() if change is CHANGE.ADDED]
+            self.index.update(added, replace=True)
+            if self.on_changes:
+                self.on_changes(Changes([], [], [], True))
+            return
+        batch = _Batch()
+        for change, path in scanner.scan():
+            if change is CHANGE.ADDED:
+                batch.add(path)
+            elif change is CHANGE.REMOVED:
+                batch.remove(path)
+        self._apply(batch.changes())
+
+    # -- inotify
+
+    def _watch_events(self):
+        batch = _Batch()
+        accept = None  # built for the first event of a batch
+        first_event = last_event = None
+        while True:
+            stopping = self._stop.is_set()
+            now = time.monotonic()
+            if batch or self._move_sources or self._overflowed:
+                due = min(last_event + self.debounce_secs, first_event + self.max_delay_secs)
+                if stopping or now >= due:
+                    self._flush(batch)
+                    batch = _Batch()
+                    accept = None
+                    first_event = last_event = None
+                    continue
+                timeout = due - now
+            elif stopping:
+                return
+            else:
+                first_event = last_event = None
+                timeout = self.debounce_secs
+            readable, _, _ = select.select([self._inotify], [], [], min(timeout, 0.5))
+            if readable:
+                events = self._inotify.read_events()
+                if events and accept is None:
+                    accept = self._accepts()
+                for event in events:
+                    self._handle(batch, accept, *event)
+                last_event = time.monotonic()
+                first_event = first_event or last_event
+
+    def _flush(self, batch):
+        if self._overflowed:
+            log.warning('Lost inotify events for %r, rescanning', self.root)
+            self._rescan()
+            return
+        for old in self._move_sources.values():  # moved out of the watched tree
+            self._unwatch(old)
+            batch.remove(old)
+        self._move_sources.clear()
+        self._apply(batch.changes())
+
+    def _handle(self, batch, accept, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            self._overflowed = True
+            return
+        directory = self._watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:  # watched directory is gone
+            del self._watches[wd]
+            if self._wds.get(directory.path) == wd:
+                del self._wds[directory.path]
+            return
+        if not name:  # event of the watched directory itself; reported by its parent
+            return
+        name = decode_path(name)
+        if mask & (IN_DELETE | IN_MOVED_FROM):
+            path = directory.make_child(name, is_dir=bool(mask & IN_ISDIR))
+            if mask & IN_DELETE:
+                batch.remove(path)
+            else:
+                self._move_sources[cookie] = path
+            return
+        scanpath = os.path.join(self.root, directory.path, name)
+        path = directory.make_child(name, is_dir=os.path.isdir(scanpath),
+                                    is_symlink=os.path.islink(scanpath))
+        if mask & IN_MOVED_TO and cookie in self._move_sources:
+            self._moved(batch, accept, self._move_sources.pop(cookie), path)
+        else:
+            self._added(batch, accept, path)
+
+    def _added(self, batch, accept, path):
+        if not accept(path):
+            return
+        if path.is_dir and path.path not in self._wds:
+            for new_path in self._watch_tree(path, accept):
+                batch.add(new_path)
+        else:
+            batch.add(path)
+
+    def _moved(self, batch, accept, old, new):
+        was_accepted = self._accept_known is None or self._accept_known(old)
+        if not (was_accepted and accept(new)):
+            self._unwatch(old)
+            if was_accepted:
+                batch.remove(old)
+            self._added(batch, accept, new)
+            return
+        for key, wd in list(self._wds.items()):
+            if _is_below(key, old.path):
+                watched = _rebase(self._watches[wd], old, new)
+                del self._wds[key]
+                self._wds[watched.path] = wd
+                self._watches[wd] = watched
+        batch.move(old, new)
+
+    def _watch(self, directory):
+        """Add a watch for a directory; return ``False`` if it can't or shouldn't be watched"""
+        try:
+            wd = self._inotify.add_watch(os.path.join(self.root, directory.path), WATCH_MASK)
+        except OSError as error:
+            if error.errno == errno.ENOSPC:
+                raise
+            log.error('Cannot watch directory %r: %s', directory.path, error)
+            return False
+        watched = self._watches.get(wd)
+        if watched is not None and watched != directory:
+            log.info('Skipping %r, already watched as %r', directory.path, watched.path)
+            return False
+        self._watches[wd] = directory
+        self._wds[directory.path] = wd
+        return True
+
+    def _unwatch(self, path):
+        for key in [key for key in self._wds if _is_below(key, path.path)]:
+            wd = self._wds.pop(key)
+            del self._watches[wd]
+            self._inotify.rm_watch(wd)
+
+    def _watch_tree(self, top, accept):
+        """Watch a directory and its subdirectories; yield them and all files below them
+
+        Each directory is watched before it gets listed, so no entry can be created unnoticed.
+        """
+        dirstack = [top]
+        while dirstack:
+            directory = dirstack.pop()
+            if not self._watch(directory):
+                continue
+            if directory != '.':
+                yield directory
+            try:
+                # the stats spare the index a stat per file
+                children = list_directory(self.root, directory, accept=accept, stat=True)
+            except OSError as error:  # pragma: no cover
+                scanpath = os.path.join(self.root, directory.path)
+                log.error('Error scanning directory %r: %s', scanpath, error)
+                continue
+            for child in children:
+                if child.is_dir:
+                    dirstack.append(child)
+                else:
+                    yield child
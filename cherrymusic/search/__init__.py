@@ -0,0 +1 @@
+# -*- coding: UTF-8 -*-
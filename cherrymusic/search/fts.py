@@ -0,0 +1,186 @@
+# -*- coding: UTF-8 -*-
+import os
+import re
+from itertools import islice
+
+from cherrymusic.database.sqlite import ISOLATION
+from cherrymusic.media.data import Path, decode_path, encode_path
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_PAGE_SIZE = 20
+
+# relative importance of a match in the file name vs. a match in the parent directories
+NAME_WEIGHT, PARENT_WEIGHT = 2.0, 1.0
+
+_words = re.compile(r'\w+').findall
+
+
+def match_expression(query):
+    """Turn a user query into an FTS5 expression matching paths containing all words as prefixes
+
+    Returns:
+        The expression, or an empty string if the query contains no searchable words
+    """
+    return ' '.join(f'"{word}"*' for word in _words(query.lower()))
+
+
+class SearchIndex:
+    """Full-text search index for the display versions of path components
+
+    Every indexed path is searchable by the words in its name and in the names of its parent
+    directories (e.g. artist and album directories), with prefix matching. Results are ranked
+    by bm25, with matches in file names weighing more than matches in directory names.
+
+    The index consists of an FTS5 table for the search terms and a regular table mapping the
+    full-text rows to the original paths, stored as bytes.
+
+    Args:
+        database: The :class:`~cherrymusic.database.sqlite.SqliteDatabase` to keep the index in
+    """
+
+    def __init__(self, database):
+        self.database = database
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.database!r})'
+
+    def create_tables(self, transaction):
+        transaction.execute(
+            'CREATE TABLE IF NOT EXISTS search_paths('
+            'id INTEGER PRIMARY KEY, path BLOB NOT NULL UNIQUE)'
+        )
+        transaction.execute(
+            'CREATE VIRTUAL TABLE IF NOT EXISTS search_terms USING fts5('
+            "name, parent, tokenize='unicode61 remove_diacritics 2', prefix='2 3 4')"
+        )
+
+    def update(self, paths, *, batch_size=DEFAULT_BATCH_SIZE, replace=False):
+        """Add paths to the index, or update their entries; return the number of paths written
+
+        Args:
+            paths: An iterable of :class:`~cherrymusic.media.data.Path` objects or other path-like
+                objects; consumed lazily
+            batch_size: Number of paths to write with a single ``executemany`` call
+            replace: If ``True``, remove all existing entries first; this is a lot faster than
+                updating existing entries, but the paths must not contain duplicates
+        """
+        assert batch_size > 0
+        paths = iter(paths)
+        count = 0
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            if replace:
+                tx.execute('DELETE FROM search_paths')
+                tx.execute('DELETE FROM search_terms')
+            while True:
+                batch = [encode_path(path) for path in islice(paths, batch_size)]
+                if not batch:
+                    break
+                count += self._update_batch(tx, batch, replace_existing=not replace)
+        return count
+
+    def update_from_index(self, file_index, *, batch_size=DEFAULT_BATCH_SIZE):
+        """Replace all entries with the paths in a :class:`~cherrymusic.media.index.FileIndex`"""
+        with file_index.database.transaction() as tx:
+            file_index.create_tables(tx)
+        with file_index.database.transaction() as tx:  # read only, while the update writes
+            rows = tx.iterate('SELECT parent, name FROM files')
+            paths = (os.path.join(parent, name) for parent, name in rows)
+            return self.update(paths, batch_size=batch_size, replace=True)
+
+    def remove(self, paths):
+        """Remove paths and everything below them from the index; return the number removed"""
+        count = 0
+        with self.database.transaction(isolation=ISOLATION.IMMEDIATE) as tx:
+            self.create_tables(tx)
+            for path in paths:
+                path = encode_path(path)
+                # the path itself and everything in [path + sep, path + chr(ord(sep) + 1))
+                separator = os.sep.encode()
+                ids = tx.execute(
+                    'SELECT id FROM search_paths WHERE path = ? OR (path >= ? AND path < ?)',
+                    (path, path + separator, path + bytes([separator[0] + 1])),
+                )
+                tx.executemany('DELETE FROM search_terms WHERE rowid = ?', ids)
+                count += tx.executemany('DELETE FROM search_paths WHERE id = ?', ids)
+        return count
+
+    def search(self, query, *, page=0, page_size=DEFAULT_PAGE_SIZE):
+        """Return a page of paths matching all words in the query, best matches first
+
+        Every word in the query matches as a prefix of words in a path's components. All
+        matches are ranked, so pages agree with :meth:`count`.
+
+        Note:
+            Ranking takes time in proportion to the number of matches, for every page. Queries
+            matching a few thousand paths take milliseconds, but broad ones don't: in
+            ``benchmarks/bench_search.py``, a word matching about 260,000 paths takes over 400
+            ms, a few hundred times as long as a rare word. Callers that need a bounded latency
+            should check :meth:`count` first, or insist on longer queries.
+
+        Args:
+            query: The user query; non-word characters are ignored
+            page: The number of the page to return, starting at 0
+            page_size: The maximum number of results per page
+
+        Returns:
+            A list of :class:`~cherrymusic.media.data.Path` objects
+        """
+        expression = match_expression(query)
+        if not expression:
+            return []
+        with self.database.transaction() as tx:
+            self.create_tables(tx)
+            # rank and page inside the subquery, so only a page of matches gets joined
+            rows = tx.execute(
+                'SELECT search_paths.path FROM search_paths JOIN ('
+                f'  SELECT rowid, bm25(search_terms, {NAME_WEIGHT}, {PARENT_WEIGHT}) AS score'
+                '   FROM search_terms WHERE search_terms MATCH ?'
+                '   ORDER BY score LIMIT ? OFFSET ?'
+                ') AS matches ON search_paths.id = matches.rowid '
+                'ORDER BY matches.score',
+                (expression, page_size, page * page_size),
+            )
+        return [Path(path) for path, in rows]
+
+    def count(self, query):
+        """Return the total number of paths matching the query"""
+        expression = match_expression(query)
+        if not expression:
+            return 0
+        with self.database.transaction() as tx:
+            self.create_tables(tx)
+            return tx.execute('SELECT COUNT(*) FROM search_terms WHERE search_terms MATCH ?',
+                              (expression,))[0][0]
+
+    @staticmethod
+    def _terms(path):
+        """Return the searchable (name, parent) text of an encoded path"""
+        parent, name = os.path.split(path)
+        parent = decode_path(parent, errors='replace').replace(os.path.sep, ' ')
+        return decode_path(name, errors='replace'), parent
+
+    def _update_batch(self, tx, paths, *, replace_existing=True):
+        """Write full-text rows for a batch of encoded paths; return the count"""
+        if replace_existing:
+            tx.executemany(
+                'DELETE FROM search_terms WHERE rowid = '
+                '(SELECT id FROM search_paths WHERE path = ?)',
+                ((path,) for path in paths),
+            )
+            tx.executemany('INSERT OR IGNORE INTO search_paths(path) VALUES (?)',
+                           ((path,) for path in paths))
+            return tx.executemany(
+                'INSERT INTO search_terms(rowid, name, parent) '
+                'SELECT id, ?, ? FROM search_paths WHERE path = ?',
+                (self._terms(path) + (path,) for path in paths),
+            )
+        # no rows to replace: assign ids directly instead of looking them up
+        first_id = tx.execute('SELECT COALESCE(MAX(id), 0) + 1 FROM search_paths')[0][0]
+        ids = range(first_id, first_id + len(paths))
+        tx.executemany('INSERT INTO search_paths(id, path) VALUES (?, ?)', zip(ids, paths))
+        return tx.executemany(
+            'INSERT INTO search_terms(rowid, name, parent) VALUES (?, ?, ?)',
+            ((rowid,) + self._terms(path) for rowid, path in zip(ids, paths)),
+        )
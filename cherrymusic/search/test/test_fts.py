@@ -0,0 +1,100 @@
+# -*- coding: UTF-8 -*-
+import pytest
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.database.sqlite import SqliteDatabase
+from cherrymusic.media import files
+from cherrymusic.media.data import Path
+from cherrymusic.media.index import FileIndex
+from cherrymusic.search import fts
+
+PATHS = (
+    'Artist/Album/01 First Song.mp3',
+    'Artist/Album/02 Second Song.mp3',
+    'Artist/Other Album/01 Song.ogg',
+    'Different Artist/Songs/01 Artistic Impression.flac',
+    'Motörhead/Overkill/01 Overkill.mp3',
+)
+
+
+@pytest.fixture
+def search_index():
+    with tempdir() as tmp_path:
+        index = fts.SearchIndex(SqliteDatabase('search', basepath=tmp_path))
+        index.update(Path(path) for path in PATHS)
+        yield index
+
+
+def test_match_expression():
+    assert fts.match_expression('') == ''
+    assert fts.match_expression(' - ') == ''
+    assert fts.match_expression('Foo "bar*"') == '"foo"* "bar"*'
+
+
+def test_search_by_prefixes_of_all_words(search_index):
+    assert search_index.search('seco') == ['Artist/Album/02 Second Song.mp3']
+    assert set(search_index.search('art alb')) == {
+        'Artist/Album/01 First Song.mp3',
+        'Artist/Album/02 Second Song.mp3',
+        'Artist/Other Album/01 Song.ogg',
+    }
+    assert search_index.search('motorhead') == ['Motörhead/Overkill/01 Overkill.mp3']
+    assert search_index.search('nothing') == []
+    assert search_index.search('"') == []
+
+
+def test_search_ranks_file_names_higher(search_index):
+    results = search_index.search('artistic')
+    assert results[0] == 'Different Artist/Songs/01 Artistic Impression.flac'
+
+    results = search_index.search('overkill')
+    assert results == ['Motörhead/Overkill/01 Overkill.mp3']
+
+
+def test_search_pages(search_index):
+    all_results = search_index.search('song', page_size=100)
+    assert len(all_results) == search_index.count('song') == 4
+
+    pages = [search_index.search('song', page=page, page_size=3) for page in range(3)]
+    assert [len(page) for page in pages] == [3, 1, 0]
+    assert pages[0] + pages[1] == all_results
+
+
+def test_search_ranks_and_pages_all_matches(search_index):
+    search_index.update(Path(f'Songs {number:04}/Track.mp3') for number in range(1100))
+    search_index.update([Path('Other/Song.mp3')])  # the best match comes last
+    total = search_index.count('song')
+    assert total == 1105
+
+    assert search_index.search('song')[0] == 'Other/Song.mp3'
+    last_page = search_index.search('song', page=total // 100, page_size=100)
+    assert len(last_page) == total % 100
+
+
+def test_search_update_and_remove(search_index):
+    search_index.update([Path('Artist/Album/01 First Song.mp3')])  # no duplicates
+    assert search_index.count('first') == 1
+
+    assert search_index.remove([Path('Artist')]) == 3
+    assert search_index.count('song') == 1
+    assert search_index.count('artist') == 1
+
+
+def test_search_undecodable_names(search_index):
+    search_index.update([Path(b'Bad \xfe/Name')])
+    assert search_index.search('bad name') == [Path(b'Bad \xfe/Name')]
+
+
+def test_search_update_from_index():
+    with tempdir(*(f'music/{path}' for path in PATHS), 'db/') as tmp_path:
+        database = SqliteDatabase('media', basepath=tmp_path / 'db')
+        file_index = FileIndex(database, tmp_path / 'music')
+        file_index.update(files.recursive_scandir(tmp_path / 'music'))
+        search_index = fts.SearchIndex(database)
+
+        assert search_index.update_from_index(file_index) == len(file_index)
+        assert search_index.search('second') == ['Artist/Album/02 Second Song.mp3']
+        assert search_index.search('other alb') == [
+            'Artist/Other Album',
+            'Artist/Other Album/01 Song.ogg',
+        ]
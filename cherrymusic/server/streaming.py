@@ -0,0 +1,459 @@
+# -*- coding: UTF-8 -*-
+"""Stream files from the media root over HTTP/1.1, with support for range requests"""
+import asyncio
+import email.utils
+import functools
+import logging
+import mimetypes
+import os
+import re
+import stat
+from collections import namedtuple
+from http import HTTPStatus
+from urllib.parse import parse_qs
+
+from cherrymusic.media.data import Path
+from cherrymusic.media.opener import PathEscapeError, SecureOpener
+
+from .transcoding import DEFAULT_BITRATE, TranscodeError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_URL_PREFIX = '/stream/'
+DEFAULT_KEEPALIVE_SECS = 15.0
+MAX_HEADER_COUNT = 100
+MAX_BODY_SIZE = 64 * 1024  # requests for files don't need a body; it is read and discarded
+COPY_CHUNK_SIZE = 256 * 1024  # for event loops without sendfile
+
+Request = namedtuple('Request', 'method target version headers')
+
+_get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)  # Python 3.7+
+_DIGITS = re.compile('[0-9]+')  # str.isdigit also accepts other digits, like '\xb2' in latin-1
+
+
+class HTTPError(Exception):
+    """An error to answer a request with
+
+    Args:
+        status: The :class:`http.HTTPStatus` of the response
+        headers: Additional response headers
+        close: Close the connection after the response, since the request can't be read to
+            its end
+    """
+
+    def __init__(self, status, headers=None, *, close=False):
+        super().__init__(status)
+        self.status = status
+        self.headers = headers or {}
+        self.close = close
+
+
+class StreamingServer:
+    """Serve the files below a media root over HTTP/1.1
+
+    Files are addressed by their :meth:`~cherrymusic.media.data.Path.as_url` below
+    ``url_prefix``; ``GET`` and ``HEAD`` are supported. The server answers single-range
+    ``Range`` requests with the requested part, and sends ``ETag`` and ``Last-Modified``
+    headers for conditional requests (``If-None-Match``, ``If-Modified-Since`` and
+    ``If-Range``). A request for several ranges at once gets the whole file. File contents are
+    sent with :meth:`asyncio.AbstractEventLoop.sendfile`, which copies them from the file to the
+    socket in the kernel, without going through Python.
+
+    With a :class:`~cherrymusic.server.transcoding.Transcoder`, a ``format`` and optional
+    ``bitrate`` query parameter ask for a transcoded file. Finished transcodes are served from
+    the transcode cache like any other file; otherwise the output is streamed while the encoder
+    runs, without support for ranges.
+
+    Files are opened with a :class:`~cherrymusic.media.opener.SecureOpener`, which follows
+    symlinks only as long as they stay inside the media root or the ``allowed_roots``, and
+    hands out the open file in the same pass.
+
+    Args:
+        root: The media root; paths outside of it can't be requested
+        url_prefix: The URL path below which files are served
+        keepalive_secs: Time to wait for the next request on a persistent connection
+        transcoder: The :class:`~cherrymusic.server.transcoding.Transcoder` for files below
+            the same root, if transcoding is supported
+        allowed_roots: Directories outside of the media root that symlinks in it may lead into
+    """
+
+    def __init__(self, root, *, url_prefix=DEFAULT_URL_PREFIX,
+                 keepalive_secs=DEFAULT_KEEPALIVE_SECS, transcoder=None, allowed_roots=()):
+        self.root = os.path.abspath(root)
+        self.url_prefix = url_prefix
+        self.keepalive_secs = keepalive_secs
+        self.transcoder = transcoder
+        self.opener = SecureOpener(self.root, allowed_roots=allowed_roots)
+        self._server = None
+        self._connections = {}  # StreamWriter -> Future that is done when its handler returns
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.root!r})'
+
+    @property
+    def address(self):
+        """The ``(host, port)`` the server listens on"""
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start listening for connections; port 0 picks a free port"""
+        assert self._server is None, 'already started'
+        self._server = await asyncio.start_server(self.handle_connection, host, port)
+        log.info('%r listening on %s:%s', self, *self.address)
+
+    async def close(self):
+        """Stop listening, close all connections and wait until their handlers are done"""
+        self._server.close()
+        for writer in list(self._connections):
+            writer.transport.abort()
+        await asyncio.gather(*self._connections.values())
+        await self._server.wait_closed()
+        self._server = None
+        self.opener.close()
+
+    async def handle_connection(self, reader, writer):
+        """Answer the requests of a connection until the client or the timeout closes it"""
+        self._connections[writer] = _get_running_loop().create_future()
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(read_request(reader), self.keepalive_secs)
+                except asyncio.TimeoutError:
+                    break
+                except HTTPError as error:
+                    self._write_error(writer, error, close=True)
+                    await writer.drain()
+                    break
+                if request is None or not await self.respond(request, writer):
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError) as error:
+            log.debug('Connection lost: %s', error)
+        finally:
+            writer.close()
+            self._connections.pop(writer).set_result(None)
+
+    async def respond(self, request, writer):
+        """Write the response to a request; return if the connection can be kept open"""
+        keep_alive = _keep_alive(request)
+        try:
+            if request.method not in ('GET', 'HEAD'):
+                raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, {'Allow': 'GET, HEAD'})
+            path, query = self._resolve(request.target)
+            content_type = mimetypes.guess_type(path.path)[0] or 'application/octet-stream'
+            if self.transcoder and 'format' in query:
+                source, _ = _open_file(path.path, self.opener)  # checked once, then used as is
+                with source:
+                    format, bitrate, filename = await self._cached_transcode(path, query, source)
+                    content_type = self.transcoder.formats[format]
+                    if filename is None:
+                        return await self._respond_transcoding(
+                            request, writer, keep_alive, path, source, format, bitrate,
+                            content_type)
+                file, file_stat = _open_file(filename)
+            else:
+                file, file_stat = _open_file(path.path, self.opener)
+        except HTTPError as error:
+            self._write_error(writer, error, close=not keep_alive)
+            await writer.drain()
+            return keep_alive
+        with file:
+            size = file_stat.st_size
+            headers = {
+                'Content-Type': content_type,
+                'Accept-Ranges': 'bytes',
+                'ETag': etag(file_stat),
+                'Last-Modified': email.utils.formatdate(file_stat.st_mtime, usegmt=True),
+            }
+            status, start, length = HTTPStatus.OK, 0, size
+            try:
+                if _not_modified(request.headers, headers):
+                    status, length = HTTPStatus.NOT_MODIFIED, 0
+                elif 'range' in request.headers and _if_range(request.headers, headers):
+                    byte_range = parse_range(request.headers['range'], size)
+                    if byte_range:
+                        start, stop = byte_range
+                        status, length = HTTPStatus.PARTIAL_CONTENT, stop - start
+                        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+            except HTTPError as error:
+                error.headers.update(headers)
+                self._write_error(writer, error, close=not keep_alive)
+                await writer.drain()
+                return keep_alive
+            if status is not HTTPStatus.NOT_MODIFIED:
+                headers['Content-Length'] = str(length)
+            _write_head(writer, status, headers, close=not keep_alive)
+            if request.method == 'HEAD' or not length:
+                await writer.drain()
+                return keep_alive
+            sent = await _send_file(writer, file, start, length)
+        if sent < length:
+            log.warning('%r: sent %d of %d bytes', request.target, sent, length)
+            return False  # the file shrank; only closing the connection tells the client
+        return keep_alive
+
+    def _resolve(self, target):
+        """Return the :class:`Path` and the parsed query string of a request target"""
+        url_path, _, query = target.partition('?')
+        if not url_path.startswith(self.url_prefix):
+            raise HTTPError(HTTPStatus.NOT_FOUND)
+        path = Path.from_url(url_path[len(self.url_prefix):])
+        if (os.path.isabs(path.path) or path.depth < 1 or
+                path.path.split(os.path.sep, 1)[0] == os.path.pardir or '\0' in path.path):
+            raise HTTPError(HTTPStatus.NOT_FOUND)
+        return path, parse_qs(query)
+
+    async def _cached_transcode(self, path, query, source):
+        """Return the format and bitrate from a query, and the filename of a finished transcode
+
+        The filename is ``None`` if the transcode of the open ``source`` file is not cached.
+        """
+        format = query['format'][-1]
+        cached = functools.partial(self.transcoder.cached, source=source)
+        try:
+            bitrate = int(query.get('bitrate', [DEFAULT_BITRATE])[-1])
+            filename = await _get_running_loop().run_in_executor(
+                None, cached, path, format, bitrate)
+            return format, bitrate, filename
+        except ValueError:
+            raise HTTPError(HTTPStatus.BAD_REQUEST) from None
+        except OSError:
+            raise HTTPError(HTTPStatus.NOT_FOUND) from None
+
+    async def _respond_transcoding(self, request, writer, keep_alive, path, source, format,
+                                   bitrate, content_type):
+        """Stream a transcode while it is encoded, in chunks or until the connection closes"""
+        chunked = request.version == 'HTTP/1.1'
+        headers = {'Content-Type': content_type, 'Accept-Ranges': 'none'}
+        if chunked:
+            headers['Transfer-Encoding'] = 'chunked'
+        else:
+            keep_alive = False  # the end of the connection marks the end of the content
+        if request.method == 'HEAD':
+            _write_head(writer, HTTPStatus.OK, headers, close=not keep_alive)
+            await writer.drain()
+            return keep_alive
+        chunks = self.transcoder.stream(path, format, bitrate, source=source)
+        try:
+            try:
+                first_chunk = await chunks.__anext__()  # so an early error gets a status
+            except StopAsyncIteration:
+                first_chunk = b''
+            except (TranscodeError, OSError):
+                raise HTTPError(HTTPStatus.INTERNAL_SERVER_ERROR) from None
+            _write_head(writer, HTTPStatus.OK, headers, close=not keep_alive)
+            _write_chunk(writer, first_chunk, chunked)
+            async for chunk in chunks:
+                _write_chunk(writer, chunk, chunked)
+                await writer.drain()
+            if chunked:
+                writer.write(b'0\r\n\r\n')
+            await writer.drain()
+        except TranscodeError as error:
+            log.warning('%r: transcoding failed while streaming: %s', request.target, error)
+            return False  # only closing the connection tells the client
+        finally:
+            await chunks.aclose()
+        return keep_alive
+
+    @staticmethod
+    def _write_error(writer, error, *, close):
+        body = f'{error.status.value} {error.status.phrase}\n'.encode()
+        headers = dict(error.headers)
+        headers['Content-Type'] = 'text/plain; charset=utf-8'
+        headers['Content-Length'] = str(len(body))
+        _write_head(writer, error.status, headers, close=close or error.close)
+        writer.write(body)
+
+
+def _open_file(filename, opener=None):
+    """Return an open regular file and its stat result
+
+    Args:
+        filename: The file's name, relative to the opener's root if there is an opener
+        opener: The :class:`~cherrymusic.media.opener.SecureOpener` to open the file with
+    """
+    try:
+        if opener is None:
+            file = open(filename, 'rb', buffering=0)
+        else:
+            file = open(opener.open(filename), 'rb', buffering=0)
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError, PathEscapeError):
+        raise HTTPError(HTTPStatus.NOT_FOUND) from None
+    except OSError as error:
+        log.error('Cannot open %r: %s', filename, error)
+        raise HTTPError(HTTPStatus.FORBIDDEN) from None
+    file_stat = os.fstat(file.fileno())
+    if not stat.S_ISREG(file_stat.st_mode):
+        file.close()
+        raise HTTPError(HTTPStatus.NOT_FOUND)
+    return file, file_stat
+
+
+async def read_request(reader):
+    """Read a request and its headers from a stream; return ``None`` at the end of the stream
+
+    Header names are lowercased, and repeated headers are joined with commas. Any request body
+    is read and discarded.
+
+    Raises:
+        HTTPError: If the request is malformed or too large
+    """
+    line = await _read_line(reader)
+    if line == '':  # RFC 7230 asks servers to ignore an empty line before a request
+        line = await _read_line(reader)
+    if line is None:
+        return None
+    try:
+        method, target, version = line.split(' ')
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, close=True) from None
+    if version not in ('HTTP/1.0', 'HTTP/1.1'):
+        raise HTTPError(HTTPStatus.HTTP_VERSION_NOT_SUPPORTED, close=True)
+    headers = {}
+    while True:
+        line = await _read_line(reader)
+        if not line:
+            break
+        if len(headers) >= MAX_HEADER_COUNT:
+            raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, close=True)
+        name, colon, value = line.partition(':')
+        if not colon or name != name.strip():
+            raise HTTPError(HTTPStatus.BAD_REQUEST, close=True)
+        name, value = name.lower(), value.strip()
+        headers[name] = f'{headers[name]}, {value}' if name in headers else value
+    if 'transfer-encoding' in headers:
+        raise HTTPError(HTTPStatus.NOT_IMPLEMENTED, close=True)
+    try:
+        body_size = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(HTTPStatus.BAD_REQUEST, close=True) from None
+    if not 0 <= body_size <= MAX_BODY_SIZE:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, close=True)
+    await reader.readexactly(body_size)
+    return Request(method, target, version, headers)
+
+
+async def _read_line(reader):
+    """Return a line without its line break, or ``None`` at the end of the stream"""
+    try:
+        line = await reader.readuntil(b'\n')
+    except asyncio.IncompleteReadError as error:
+        if error.partial:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, close=True) from None
+        return None
+    except asyncio.LimitOverrunError:
+        raise HTTPError(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, close=True) from None
+    return line.rstrip(b'\r\n').decode('latin-1')
+
+
+def parse_range(header, size):
+    """Return the ``(start, stop)`` of the bytes a ``Range`` header asks for
+
+    Returns:
+        The range, or ``None`` if the header should be ignored and the whole file sent; that
+        is the case for malformed headers, units other than bytes and multiple ranges
+
+    Raises:
+        HTTPError: If the range can't be satisfied for a file of the given size
+    """
+    unit, _, ranges = header.partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in ranges:
+        return None
+    first, dash, last = ranges.strip().partition('-')
+    if not dash or not _DIGITS.fullmatch(first + last):  # also rejects signs and blanks
+        return None
+    unsatisfiable = HTTPError(HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE,
+                              {'Content-Range': f'bytes */{size}'})
+    if not first:  # suffix range: the last bytes of the file
+        suffix_length = int(last)
+        if not suffix_length or not size:
+            raise unsatisfiable
+        return max(size - suffix_length, 0), size
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise unsatisfiable
+    return start, min(int(last) + 1, size) if last else size
+
+
+def etag(file_stat):
+    """Return a strong entity tag for a file, from its inode, size and modification time"""
+    return f'"{file_stat.st_ino:x}-{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"'
+
+
+def _not_modified(request_headers, headers):
+    if 'if-none-match' in request_headers:
+        tags = [tag.strip() for tag in request_headers['if-none-match'].split(',')]
+        return '*' in tags or any(_strip_weak(tag) == headers['ETag'] for tag in tags)
+    if 'if-modified-since' in request_headers:
+        return _parse_date(request_headers['if-modified-since']) >= \
+            _parse_date(headers['Last-Modified'])
+    return False
+
+
+def _if_range(request_headers, headers):
+    """Return if the ``If-Range`` condition of a request allows sending a range"""
+    condition = request_headers.get('if-range')
+    if condition is None:
+        return True
+    if condition.startswith(('"', 'W/')):
+        return condition == headers['ETag']  # If-Range needs a strong comparison
+    return condition == headers['Last-Modified']
+
+
+def _strip_weak(tag):
+    return tag[2:] if tag.startswith('W/') else tag
+
+
+def _parse_date(value):
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError):
+        return float('-inf')
+
+
+def _keep_alive(request):
+    tokens = {token.strip().lower() for token in request.headers.get('connection', '').split(',')}
+    if request.version == 'HTTP/1.0':
+        return 'keep-alive' in tokens
+    return 'close' not in tokens
+
+
+def _write_head(writer, status, headers, *, close):
+    lines = [f'HTTP/1.1 {status.value} {status.phrase}',
+             f'Date: {email.utils.formatdate(usegmt=True)}']
+    lines.extend(f'{name}: {value}' for name, value in headers.items())
+    lines.append('Connection: close' if close else 'Connection: keep-alive')
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+
+
+def _write_chunk(writer, chunk, chunked):
+    if not chunked:
+        writer.write(chunk)
+    elif chunk:  # an empty chunk would end the content
+        writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+
+
+async def _send_file(writer, file, start, length):
+    """Send part of a file to a stream; return the number of bytes sent"""
+    await writer.drain()  # sendfile needs the response head to be written first
+    sendfile = getattr(_get_running_loop(), 'sendfile', None)  # Python 3.7+
+    if sendfile is None:
+        return await _copy_file(writer, file, start, length)
+    return await sendfile(writer.transport, file, start, length)
+
+
+async def _copy_file(writer, file, start, length):
+    """Like :func:`_send_file`, but read the file into memory chunk by chunk"""
+    file.seek(start)
+    sent = 0
+    while sent < length:
+        chunk = file.read(min(COPY_CHUNK_SIZE, length - sent))
+        if not chunk:
+            break
+        writer.write(chunk)
+        await writer.drain()
+        sent += len(chunk)
+    return sent
@@ -0,0 +1,33 @@
+# -*- coding: UTF-8 -*-
+"""Stand-in for an encoder in tests: writes a header, then the uppercased input in chunks
+
+Fails if the input contains ``FAIL``.
+
+Usage: python encoder.py INPUT FORMAT BITRATE
+"""
+import sys
+import time
+
+CHUNK_SIZE = 1000
+
+
+def encoded(data, format, bitrate):
+    """Return the output for input data"""
+    return f'{format}@{bitrate}:'.encode() + data.upper()
+
+
+def main(filename, format, bitrate):
+    with open(filename, 'rb') as file:
+        data = file.read()
+    if b'FAIL' in data:
+        sys.stderr.write('cannot encode this\n')
+        sys.exit(1)
+    output = encoded(data, format, bitrate)
+    for start in range(0, len(output), CHUNK_SIZE):
+        sys.stdout.buffer.write(output[start:start + CHUNK_SIZE])
+        sys.stdout.buffer.flush()
+        time.sleep(0.005)
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
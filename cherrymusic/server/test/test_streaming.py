@@ -0,0 +1,236 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import contextlib
+import http.client
+import os
+import socket
+import threading
+from http import HTTPStatus
+from unittest import mock
+
+import pytest
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.media.data import Path
+from cherrymusic.server import streaming, transcoding
+from cherrymusic.server.test import encoder
+from cherrymusic.server.test.test_transcoding import ENCODER
+
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def server():
+    with tempdir('music/dir/', 'secret', 'cache/') as tmp_path:
+        (tmp_path / 'music' / 'dir' / 'Tïtle #1.mp3').write_bytes(CONTENT)
+        (tmp_path / 'music' / 'empty.ogg').write_bytes(b'')
+        (tmp_path / 'music' / 'broken.flac').write_bytes(b'FAIL')
+        loop = asyncio.new_event_loop()
+        transcoder = transcoding.Transcoder(
+            tmp_path / 'music', transcoding.TranscodeCache(tmp_path / 'cache'), command=ENCODER)
+        server = streaming.StreamingServer(tmp_path / 'music', keepalive_secs=5,
+                                           transcoder=transcoder)
+        loop.run_until_complete(server.start())
+        thread = threading.Thread(target=loop.run_forever, daemon=True)
+        thread.start()
+        try:
+            yield server
+        finally:
+            loop.call_soon_threadsafe(loop.stop)
+            thread.join()
+            loop.run_until_complete(server.close())
+            loop.run_until_complete(transcoder.close())
+            loop.close()
+
+
+def request(server, target, headers=None, *, method='GET', connection=None):
+    if connection is None:
+        with contextlib.closing(http.client.HTTPConnection(*server.address, timeout=5)) as new:
+            return request(server, target, headers, method=method, connection=new)
+    connection.request(method, target, headers=headers or {})
+    response = connection.getresponse()
+    return response, response.read()
+
+
+URL = '/stream/' + Path('dir/Tïtle #1.mp3').as_url
+
+
+def test_get_file(server):
+    response, body = request(server, URL)
+
+    assert response.status == HTTPStatus.OK
+    assert body == CONTENT
+    assert response.headers['Content-Length'] == str(len(CONTENT))
+    assert response.headers['Content-Type'] == 'audio/mpeg'
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    stat = os.stat(os.path.join(server.root, 'dir', 'Tïtle #1.mp3'))
+    assert response.headers['ETag'] == streaming.etag(stat)
+    assert response.headers['Last-Modified']
+
+
+def test_head_and_empty_file(server):
+    response, body = request(server, URL, method='HEAD')
+    assert (response.status, body) == (HTTPStatus.OK, b'')
+    assert response.headers['Content-Length'] == str(len(CONTENT))
+
+    response, body = request(server, '/stream/empty.ogg')
+    assert (response.status, body) == (HTTPStatus.OK, b'')
+
+
+@pytest.mark.parametrize('header, start, stop', [
+    ('bytes=10-19', 10, 20),
+    ('bytes=10000-', 10000, len(CONTENT)),
+    ('bytes=-100', len(CONTENT) - 100, len(CONTENT)),
+    ('bytes=10000-99999', 10000, len(CONTENT)),
+])
+def test_range_request(server, header, start, stop):
+    response, body = request(server, URL, {'Range': header})
+
+    assert response.status == HTTPStatus.PARTIAL_CONTENT
+    assert body == CONTENT[start:stop]
+    assert response.headers['Content-Range'] == f'bytes {start}-{stop - 1}/{len(CONTENT)}'
+
+
+def test_range_with_non_ascii_digits_is_ignored(server):
+    with contextlib.closing(http.client.HTTPConnection(*server.address, timeout=5)) as connection:
+        response, body = request(server, URL, {'Range': 'bytes=\xb2-'}, connection=connection)
+        assert (response.status, body) == (HTTPStatus.OK, CONTENT)
+        assert request(server, URL, connection=connection)[1] == CONTENT  # still connected
+
+
+def test_unsatisfiable_range(server):
+    response, _ = request(server, URL, {'Range': 'bytes=20000-'})
+
+    assert response.status == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
+    assert response.headers['Content-Range'] == f'bytes */{len(CONTENT)}'
+
+
+def test_conditional_requests(server):
+    response, _ = request(server, URL)
+    etag, last_modified = response.headers['ETag'], response.headers['Last-Modified']
+
+    assert request(server, URL, {'If-None-Match': etag})[0].status == HTTPStatus.NOT_MODIFIED
+    assert request(server, URL, {'If-None-Match': '"other"'})[0].status == HTTPStatus.OK
+    response, _ = request(server, URL, {'If-Modified-Since': last_modified})
+    assert response.status == HTTPStatus.NOT_MODIFIED
+
+    for if_range in (etag, last_modified):
+        response, _ = request(server, URL, {'Range': 'bytes=0-0', 'If-Range': if_range})
+        assert response.status == HTTPStatus.PARTIAL_CONTENT
+    response, body = request(server, URL, {'Range': 'bytes=0-0', 'If-Range': '"other"'})
+    assert (response.status, body) == (HTTPStatus.OK, CONTENT)
+
+
+@pytest.mark.parametrize('target', [
+    '/stream/missing.mp3', '/stream/dir', '/stream/', '/other/empty.ogg', '/stream/..%2Fsecret',
+    '/stream/dir%2F..%2F..%2Fsecret', '/stream/%2Fetc%2Fpasswd', '/stream/a%00b',
+])
+def test_not_found(server, target):
+    assert request(server, target)[0].status == HTTPStatus.NOT_FOUND
+
+
+def test_symlinks_must_stay_inside_root(server):
+    music = server.opener.root
+    os.symlink(os.path.join('..', 'secret'), os.path.join(music, 'leak.mp3'))
+    os.symlink(os.path.join('dir', 'Tïtle #1.mp3'), os.path.join(music, 'link.mp3'))
+
+    assert request(server, '/stream/leak.mp3')[0].status == HTTPStatus.NOT_FOUND
+    assert request(server, '/stream/leak.mp3?format=ogg')[0].status == HTTPStatus.NOT_FOUND
+    assert request(server, '/stream/link.mp3')[1] == CONTENT
+
+
+def test_method_not_allowed(server):
+    response, _ = request(server, URL, method='POST')
+
+    assert response.status == HTTPStatus.METHOD_NOT_ALLOWED
+    assert response.headers['Allow'] == 'GET, HEAD'
+
+
+def test_persistent_connection(server):
+    with contextlib.closing(http.client.HTTPConnection(*server.address, timeout=5)) as connection:
+        assert request(server, URL, connection=connection)[1] == CONTENT
+        assert request(server, '/stream/missing', connection=connection)[0].status == 404
+        assert request(server, URL + '?query', {'Range': 'bytes=0-9'},
+                       connection=connection)[1] == CONTENT[:10]
+
+
+def test_malformed_request(server):
+    with socket.create_connection(server.address, timeout=5) as sock:
+        sock.sendall(b'GARBAGE\r\n\r\n')
+        response = sock.makefile('rb').read()
+    assert response.startswith(b'HTTP/1.1 400 Bad Request\r\n')
+    assert b'Connection: close\r\n' in response
+
+
+def test_copies_file_without_sendfile(server):
+    with mock.patch.object(streaming, '_send_file', streaming._copy_file):
+        response, body = request(server, URL, {'Range': 'bytes=1-'})
+
+    assert body == CONTENT[1:]
+
+
+def test_transcode(server):
+    expected = encoder.encoded(CONTENT, 'ogg', 96)
+
+    response, body = request(server, URL + '?format=ogg&bitrate=96')
+    assert (response.status, body) == (HTTPStatus.OK, expected)
+    assert response.headers['Transfer-Encoding'] == 'chunked'
+    assert response.headers['Content-Type'] == 'audio/ogg'
+
+    # finished transcodes are served like files
+    response, body = request(server, URL + '?format=ogg&bitrate=96', {'Range': 'bytes=1-'})
+    assert (response.status, body) == (HTTPStatus.PARTIAL_CONTENT, expected[1:])
+    assert response.headers['ETag']
+
+
+def test_transcode_opens_source_once(server):
+    with mock.patch.object(server.opener, 'open', wraps=server.opener.open) as opener_open:
+        response, body = request(server, URL + '?format=mp3')
+
+    assert (response.status, body) == (HTTPStatus.OK, encoder.encoded(CONTENT, 'mp3', 128))
+    assert opener_open.call_count == 1
+
+
+@pytest.mark.parametrize('query, status', [
+    ('?format=wav', HTTPStatus.BAD_REQUEST),
+    ('?format=mp3&bitrate=loud', HTTPStatus.BAD_REQUEST),
+    ('?format=mp3&bitrate=1', HTTPStatus.BAD_REQUEST),
+])
+def test_transcode_bad_options(server, query, status):
+    assert request(server, URL + query)[0].status == status
+
+
+def test_transcode_errors(server):
+    response, _ = request(server, '/stream/missing.flac?format=mp3')
+    assert response.status == HTTPStatus.NOT_FOUND
+    response, _ = request(server, '/stream/dir?format=mp3')
+    assert response.status == HTTPStatus.NOT_FOUND
+    response, _ = request(server, '/stream/broken.flac?format=mp3')
+    assert response.status == HTTPStatus.INTERNAL_SERVER_ERROR
+
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-0', (0, 1)),
+    ('bytes=5-', (5, 100)),
+    ('bytes=-5', (95, 100)),
+    ('bytes=-500', (0, 100)),
+    ('bytes=99-500', (99, 100)),
+    ('bytes = 1-2', (1, 3)),
+    ('bytes=5-1', None),
+    ('bytes=1-2,4-5', None),
+    ('items=1-2', None),
+    ('bytes=a-b', None),
+    ('bytes=+1-2', None),
+    ('bytes=1', None),
+    ('bytes=\xb2-', None),
+    ('bytes=1-\u0663', None),
+])
+def test_parse_range(header, expected):
+    assert streaming.parse_range(header, 100) == expected
+
+
+@pytest.mark.parametrize('header, size', [('bytes=100-', 100), ('bytes=-0', 100), ('bytes=-1', 0)])
+def test_parse_range_unsatisfiable(header, size):
+    with pytest.raises(streaming.HTTPError) as error:
+        streaming.parse_range(header, size)
+    assert error.value.status == HTTPStatus.REQUESTED_RANGE_NOT_SATISFIABLE
@@ -0,0 +1,174 @@
+# -*- coding: UTF-8 -*-
+import asyncio
+import os
+import sys
+import threading
+from unittest import mock
+
+import pytest
+
+from cherrymusic.common.test.helpers import tempdir
+from cherrymusic.media.data import Path
+from cherrymusic.server import transcoding
+from cherrymusic.server.test import encoder
+
+ENCODER = (sys.executable, encoder.__file__, '{input}', '{format}', '{bitrate}')
+SOURCE = b'some audio data ' * 500
+
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)  # for the subprocess child watcher before Python 3.8
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def collect(chunks):
+    return b''.join([chunk async for chunk in chunks])
+
+
+@pytest.fixture
+def transcoder():
+    with tempdir('music/', 'cache/') as tmp_path:
+        (tmp_path / 'music' / 'song.flac').write_bytes(SOURCE)
+        (tmp_path / 'music' / 'broken.flac').write_bytes(b'FAIL')
+        cache = transcoding.TranscodeCache(tmp_path / 'cache', max_bytes=10 ** 6)
+        yield transcoding.Transcoder(tmp_path / 'music', cache, command=ENCODER)
+
+
+@pytest.fixture
+def count_encoders():
+    with mock.patch('asyncio.create_subprocess_exec',
+                    side_effect=asyncio.create_subprocess_exec) as create_subprocess_exec:
+        yield create_subprocess_exec
+
+
+def test_concurrent_streams_share_an_encoder(transcoder, count_encoders):
+    song = Path('song.flac')
+
+    async def late_stream():
+        await asyncio.sleep(0.02)  # joins while the encoder runs
+        return await collect(transcoder.stream(song, 'ogg', 96, chunk_size=100))
+
+    async def streams():
+        return await asyncio.gather(
+            collect(transcoder.stream(song, 'ogg', 96)),
+            collect(transcoder.stream(song, 'ogg', 96)),
+            late_stream(),
+        )
+
+    outputs = run(streams())
+
+    assert outputs == [encoder.encoded(SOURCE, 'ogg', 96)] * 3
+    assert count_encoders.call_count == 1
+    assert len(transcoder.cache) == 1
+    assert os.listdir(transcoder.cache.directory) == [transcoder._cache_name(song, 'ogg', 96)]
+
+
+def test_finished_transcodes_are_cached(transcoder, count_encoders):
+    song = Path('song.flac')
+    assert transcoder.cached(song, 'mp3', 128) is None
+
+    run(collect(transcoder.stream(song, 'mp3', 128)))
+    with open(transcoder.cached(song, 'mp3', 128), 'rb') as file:
+        assert file.read() == encoder.encoded(SOURCE, 'mp3', 128)
+    output = run(collect(transcoder.stream(song, 'mp3', 128)))
+    assert output == encoder.encoded(SOURCE, 'mp3', 128)
+    assert count_encoders.call_count == 1
+
+    run(collect(transcoder.stream(song, 'mp3', 64)))
+    source = os.path.join(transcoder.root, 'song.flac')
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+    assert transcoder.cached(song, 'mp3', 128) is None
+    assert count_encoders.call_count == 2
+
+
+def test_open_source_is_encoded(transcoder, count_encoders):
+    song = Path('song.flac')
+    filename = os.path.join(transcoder.root, 'song.flac')
+    with open(filename, 'rb') as source:
+        os.remove(filename)
+        with open(filename, 'wb') as replacement:  # swapped after the source was opened
+            replacement.write(b'other audio data')
+        output = run(collect(transcoder.stream(song, 'ogg', 96, source=source)))
+        assert transcoder.cached(song, 'ogg', 96, source=source) is not None
+
+    assert output == encoder.encoded(SOURCE, 'ogg', 96)
+    args, kwargs = count_encoders.call_args
+    assert args[2].startswith('/dev/fd/') and kwargs['pass_fds']
+
+
+def test_file_system_access_stays_out_of_the_event_loop(transcoder):
+    song = Path('song.flac')
+    loop_thread = threading.current_thread()
+    threads = []
+
+    def recording(func):
+        def record(*args, **kwargs):
+            threads.append((func.__name__, threading.current_thread()))
+            return func(*args, **kwargs)
+        return record
+
+    with mock.patch('os.replace', recording(os.replace)), \
+            mock.patch('os.utime', recording(os.utime)), \
+            mock.patch('os.pread', recording(os.pread)):
+        run(collect(transcoder.stream(song, 'mp3', 128)))
+        run(collect(transcoder.stream(song, 'mp3', 128)))
+
+    assert {name for name, _ in threads} == {'replace', 'utime', 'pread'}
+    assert loop_thread not in {thread for _, thread in threads}
+
+
+def test_encoder_failure(transcoder):
+    with pytest.raises(transcoding.TranscodeError, match='cannot encode this'):
+        run(collect(transcoder.stream(Path('broken.flac'), 'mp3', 128)))
+
+    assert transcoder.cached(Path('broken.flac'), 'mp3', 128) is None
+    assert os.listdir(transcoder.cache.directory) == []
+
+
+def test_unsupported_options_and_missing_source(transcoder):
+    with pytest.raises(ValueError):
+        transcoder.cached(Path('song.flac'), 'wav', 128)
+    with pytest.raises(ValueError):
+        transcoder.cached(Path('song.flac'), 'mp3', 10_000)
+    with pytest.raises(FileNotFoundError):
+        transcoder.cached(Path('missing.flac'), 'mp3', 128)
+
+
+def test_close_stops_encoders(transcoder):
+    async def close_while_streaming():
+        chunks = transcoder.stream(Path('song.flac'), 'mp3', 128)
+        await chunks.__anext__()
+        await transcoder.close()
+        await collect(chunks)
+
+    with pytest.raises(transcoding.TranscodeError, match='closed'):
+        run(close_while_streaming())
+    assert os.listdir(transcoder.cache.directory) == []
+
+
+def test_transcode_cache_evicts_least_recently_used():
+    with tempdir('cache/', 'cache/leftover.part') as tmp_path:
+        cache = transcoding.TranscodeCache(tmp_path / 'cache', max_bytes=25)
+        assert len(cache) == 0 and not (tmp_path / 'cache' / 'leftover.part').exists()
+
+        for name in ('a', 'b', 'c'):
+            (tmp_path / 'new.part').write_bytes(b'x' * 10)
+            cache.add(name, tmp_path / 'new.part')
+            os.utime(cache.path(name), ns=(0, len(cache) * 10 ** 9))  # distinct mtimes
+        assert cache.size == 20 and 'a' not in cache
+        assert not os.path.exists(cache.path('a'))
+
+        assert cache.get('b') == cache.path('b')  # now most recently used
+        (tmp_path / 'new.part').write_bytes(b'x' * 10)
+        cache.add('d', tmp_path / 'new.part')
+        assert {name for name in 'abcd' if name in cache} == {'b', 'd'}
+
+        reopened = transcoding.TranscodeCache(tmp_path / 'cache', max_bytes=15)
+        assert {name for name in 'abcd' if name in reopened} == {'d'}
+        assert reopened.get('a') is None
@@ -0,0 +1,353 @@
+# -*- coding: UTF-8 -*-
+"""Transcode media files with an external encoder, and keep the results in a disk cache"""
+import asyncio
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from subprocess import DEVNULL, PIPE
+
+log = logging.getLogger(__name__)
+
+DEFAULT_COMMAND = (
+    'ffmpeg', '-nostdin', '-v', 'error', '-i', '{input}', '-map', '0:a:0', '-vn',
+    '-b:a', '{bitrate}k', '-f', '{format}', '-',
+)
+DEFAULT_FORMATS = {'mp3': 'audio/mpeg', 'ogg': 'audio/ogg', 'opus': 'audio/ogg'}
+DEFAULT_BITRATE = 128
+MIN_BITRATE, MAX_BITRATE = 32, 320
+DEFAULT_MAX_CACHE_BYTES = 2 * 1024 ** 3
+CHUNK_SIZE = 64 * 1024
+
+_FD_DIRECTORY = '/dev/fd'  # where encoders can open descriptors passed to them by name
+_get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)  # Python 3.7+
+
+
+class TranscodeError(Exception):
+    """The encoder failed"""
+
+
+class TranscodeCache:
+    """A directory of finished transcodes that evicts the least recently used beyond a size limit
+
+    Files keep their recency in their modification time, so the order survives restarts. The
+    cache can be used from several threads, so coroutines can call it in an executor.
+
+    Args:
+        directory: The directory to keep the files in; created if necessary
+        max_bytes: The maximum total size of the files
+    """
+
+    PARTIAL_SUFFIX = '.part'
+
+    def __init__(self, directory, max_bytes=DEFAULT_MAX_CACHE_BYTES):
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries = OrderedDict()  # name -> size, least recently used first
+        self._lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+        existing = []
+        with os.scandir(self.directory) as dir_entries:
+            for entry in dir_entries:
+                if entry.name.endswith(self.PARTIAL_SUFFIX):
+                    os.unlink(entry.path)  # left over from an interrupted encode
+                elif entry.is_file(follow_symlinks=False):
+                    stat = entry.stat(follow_symlinks=False)
+                    existing.append((stat.st_mtime_ns, entry.name, stat.st_size))
+        for _, name, size in sorted(existing):
+            self._entries[name] = size
+            self.size += size
+        self._evict()
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.directory!r}, max_bytes={self.max_bytes!r})'
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def get(self, name):
+        """Return the filename of a cached file and mark it as recently used, or ``None``"""
+        with self._lock:
+            if name not in self._entries:
+                return None
+            self._entries.move_to_end(name)
+            filename = self.path(name)
+            try:
+                os.utime(filename)
+            except FileNotFoundError:
+                log.warning('Transcode %r vanished from the cache', name)
+                self.size -= self._entries.pop(name)
+                return None
+            return filename
+
+    def add(self, name, partial_filename):
+        """Move a finished file into the cache, then evict files beyond the size limit"""
+        filename = self.path(name)
+        with self._lock:
+            os.replace(partial_filename, filename)
+            if name in self._entries:
+                self.size -= self._entries.pop(name)
+            self._entries[name] = os.stat(filename).st_size
+            self.size += self._entries[name]
+            self._evict()
+
+    def _evict(self):
+        """Remove least recently used files beyond the size limit; lock must be held"""
+        while self.size > self.max_bytes and self._entries:
+            name, size = self._entries.popitem(last=False)
+            self.size -= size
+            log.debug('Evicting transcode %r (%d bytes)', name, size)
+            try:
+                os.unlink(self.path(name))  # open readers keep their data on POSIX
+            except FileNotFoundError:  # pragma: no cover
+                pass
+
+
+class Transcoder:
+    """Transcode files below a media root, sharing encoders and caching finished results
+
+    The encoder is an external program that writes the transcoded file to its standard output.
+    Its command line is given as a sequence of arguments, in which ``{input}``, ``{format}``
+    and ``{bitrate}`` (in kbit/s) are replaced for every transcode.
+
+    A transcode is identified by the source path, its modification time, the format and the
+    bitrate. All concurrent requests for the same transcode share a single encoder process:
+    its output goes to a partial file in the cache directory, which every stream reads from the
+    start while the encoder keeps appending to it. Once the encoder succeeds, the file is moved
+    into the :class:`TranscodeCache`. An encode runs to its end even if all streams go away, so
+    the result is cached for the next request. Coroutines leave all file system access to the
+    event loop's default executor; :meth:`cached` blocks, and is meant to be called there, too.
+
+    Sources are opened by their path below the root, unless the caller passes a ``source`` file
+    that it has opened already, e.g. with a :class:`~cherrymusic.media.opener.SecureOpener`.
+    Then the source is identified by that file's stat, and the encoder gets a duplicate of its
+    descriptor and reads it as ``/dev/fd/N``, so nothing opens the source by name again.
+
+    Args:
+        root: The media root that paths are relative to
+        cache: The :class:`TranscodeCache` for finished transcodes
+        command: The encoder's command line
+        formats: The supported output formats, mapped to their content types
+    """
+
+    def __init__(self, root, cache, *, command=DEFAULT_COMMAND, formats=None):
+        self.root = os.path.abspath(root)
+        self.cache = cache
+        self.command = tuple(command)
+        self.formats = dict(formats or DEFAULT_FORMATS)
+        self._jobs = {}  # cache name -> running _Job
+        self._has_fd_directory = os.path.isdir(_FD_DIRECTORY)
+
+    def __repr__(self):
+        clsname = type(self).__name__
+        return f'{clsname}({self.root!r}, {self.cache!r})'
+
+    def cached(self, path, format, bitrate, *, source=None):
+        """Return the filename of a finished transcode, or ``None``
+
+        Args:
+            source: The source file, opened by the caller; opened by path if ``None``
+
+        Raises:
+            ValueError: If the format or bitrate is not supported
+            FileNotFoundError: If the source file doesn't exist
+        """
+        return self.cache.get(self._cache_name(path, format, bitrate, source))
+
+    async def stream(self, path, format, bitrate, *, source=None, chunk_size=CHUNK_SIZE):
+        """Yield the chunks of a transcode while it is encoded, starting or joining its encoder
+
+        Args:
+            source: The source file, opened by the caller; opened by path if ``None``. The
+                encoder gets its own descriptor for it, so it may be closed once the first
+                chunk has arrived.
+
+        Raises:
+            ValueError: If the format or bitrate is not supported
+            FileNotFoundError: If the source file doesn't exist
+            TranscodeError: If the encoder fails
+        """
+        name = await _run(self._cache_name, path, format, bitrate, source)
+        job = self._jobs.get(name)
+        if job is None:
+            filename = await _run(self.cache.get, name)
+            if filename is not None:
+                with await _run(open, filename, 'rb', 0) as file:
+                    while True:
+                        chunk = await _run(file.read, chunk_size)
+                        if not chunk:
+                            return
+                        yield chunk
+            job = self._jobs.get(name)  # started while the cache was checked
+            if job is None:
+                partial_filename = self.cache.path(name) + TranscodeCache.PARTIAL_SUFFIX
+                job = self._jobs[name] = _Job(partial_filename)
+                if source is not None and self._has_fd_directory:
+                    job.source_fd = os.dup(source.fileno())
+                job.task = asyncio.ensure_future(self._encode(name, job, path, format, bitrate))
+        # The job's reader stays open while it is in use, even after the partial file has been
+        # moved into the cache; it is read at offsets, so the streams can share it.
+        job.readers += 1
+        try:
+            offset = 0
+            while True:
+                await job.wait_beyond(offset)
+                if job.reader is None:  # the partial file couldn't be created
+                    break
+                chunk = await _run(os.pread, job.reader.fileno(), chunk_size, offset)
+                if chunk:
+                    offset += len(chunk)
+                    yield chunk
+                elif job.done:
+                    break
+        finally:
+            job.release()
+        if job.error:
+            raise job.error
+
+    async def close(self):
+        """Stop all running encoders"""
+        tasks = [job.task for job in self._jobs.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for name, job in list(self._jobs.items()):  # cancelled before they started
+            await self._finish(name, job, TranscodeError('Transcoder closed'))
+
+    def _cache_name(self, path, format, bitrate, source=None):
+        if format not in self.formats:
+            raise ValueError(f'Unsupported format: {format!r}')
+        if not MIN_BITRATE <= bitrate <= MAX_BITRATE:
+            raise ValueError(f'Unsupported bitrate: {bitrate!r}')
+        if source is None:
+            mtime_ns = os.stat(os.path.join(self.root, path.path)).st_mtime_ns
+        else:
+            mtime_ns = os.fstat(source.fileno()).st_mtime_ns
+        key = repr((bytes(path), mtime_ns, format, bitrate)).encode()
+        return f'{hashlib.sha1(key).hexdigest()}.{format}'
+
+    async def _encode(self, name, job, path, format, bitrate):
+        if job.source_fd is None:
+            source, pass_fds = os.path.join(self.root, path.path), ()
+        else:
+            source, pass_fds = os.path.join(_FD_DIRECTORY, str(job.source_fd)), (job.source_fd,)
+        args = [arg.format(input=source, format=format, bitrate=bitrate) for arg in self.command]
+        log.info('Transcoding %r to %s at %d kbit/s', path.path, format, bitrate)
+        process = stderr = error = None
+        try:
+            job.output, job.reader = await _run(_open_partial, job.filename)
+            process = await asyncio.create_subprocess_exec(
+                *args, stdin=DEVNULL, stdout=PIPE, stderr=PIPE, pass_fds=pass_fds)
+            stderr = asyncio.ensure_future(process.stderr.read())
+            while True:
+                chunk = await process.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                await _run(job.output.write, chunk)
+                job.notify(len(chunk))
+            returncode = await process.wait()
+            if returncode:
+                message = (await stderr).decode(errors='replace').strip()
+                raise TranscodeError(f'Encoder exited with {returncode}: {message}')
+        except asyncio.CancelledError:  # before Exception, which it subclasses before Python 3.8
+            error = TranscodeError('Transcoder closed')
+            raise
+        except Exception as exc:
+            log.error('Transcoding %r failed: %s', path.path, exc)
+            error = exc if isinstance(exc, TranscodeError) else TranscodeError(exc)
+        finally:
+            if process is not None and process.returncode is None:
+                process.kill()
+                await process.wait()
+            if stderr is not None:
+                stderr.cancel()
+            await self._finish(name, job, error)
+
+    async def _finish(self, name, job, error):
+        """Move a job's output into the cache, or discard it on error; then wake its streams"""
+        if job.source_fd is not None:
+            os.close(job.source_fd)
+            job.source_fd = None
+        if job.output is not None:  # else the partial file was never created
+            job.output.close()
+            if error is None:
+                try:
+                    await _run(self.cache.add, name, job.filename)
+                except OSError as exc:
+                    log.error('Cannot cache transcode %r: %s', name, exc)
+                    error = TranscodeError(exc)
+            if error is not None:
+                try:
+                    await _run(os.unlink, job.filename)
+                except FileNotFoundError:  # pragma: no cover
+                    pass
+        job.error = error
+        del self._jobs[name]
+        job.finish()
+
+
+class _Job:
+    """The state of a running encoder, shared by all streams of its output"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.output = self.reader = None  # the partial file, opened by the encoder's task
+        self.readers = 0  # streams that use the reader
+        self.source_fd = None  # a duplicate of the caller's source file, for the encoder
+        self.size = 0
+        self.done = False
+        self.error = None
+        self.task = None
+        self._changed = asyncio.Event()
+
+    async def wait_beyond(self, offset):
+        """Wait until the output is longer than offset, or the encoder is done"""
+        while self.size <= offset and not self.done:
+            await self._changed.wait()
+
+    def notify(self, added):
+        self.size += added
+        self._wake()
+
+    def finish(self):
+        self.done = True
+        self._wake()
+        self._close_unused_reader()
+
+    def release(self):
+        """Stop using the reader; it gets closed once the encoder is done and no stream uses it"""
+        self.readers -= 1
+        self._close_unused_reader()
+
+    def _wake(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def _close_unused_reader(self):
+        if self.done and not self.readers and self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+
+def _open_partial(filename):
+    """Create a partial file; return it opened for writing, and opened for reading"""
+    output = open(filename, 'wb', buffering=0)
+    try:
+        return output, open(filename, 'rb', buffering=0)
+    except BaseException:
+        output.close()
+        raise
+
+
+async def _run(func, *args):
+    """Call a blocking function in the event loop's default executor"""
+    return await _get_running_loop().run_in_executor(None, func, *args)